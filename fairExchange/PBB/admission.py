@@ -0,0 +1,213 @@
+"""
+Admission control for the PBB.
+
+A post that cannot be taken is not logged and not parked: it is answered
+at once with "retry-after <seconds>" (status STATUS_RETRY in the binary
+protocol), so an overloaded PBB gives fast feedback instead of letting
+its backlog and pending table grow. A post is refused when
+
+    it would park and the pending table already holds max_pending posts
+    (posts that match or conflict never park and are always taken), or
+    its party has used up its token bucket of party_rate posts per
+    second, up to party_burst at once. A remove, or a post that completes
+    a parked one, is not rated: refusing a withdrawal would let the
+    exchange complete after its party was told it timed out.
+
+Buckets are kept for at most max_parties parties, least recently seen
+dropped first, so made-up party names cannot grow the server either.
+
+usage: python -m fairExchange.PBB.admission [posts] [--no-admission]
+floods a local asyncio PBB with one-sided posts on fresh tokens, which
+park forever unless refused, and reports the server's memory as it goes.
+       python -m fairExchange.PBB.admission check
+parks more legacy posts than max_connections and checks that the rest
+are refused until the parked ones are answered.
+"""
+import asyncio
+import collections
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+
+RETRY_AFTER = 1.0
+MAX_PARTIES = 65536
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        """0 if a post may go now, else the seconds until one may."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+
+class Admission:
+
+    def __init__(self, max_pending=None, party_rate=None, party_burst=None, retry_after=RETRY_AFTER,
+                 max_parties=MAX_PARTIES):
+        self.max_pending = max_pending
+        self.party_rate = party_rate
+        self.party_burst = party_burst if party_burst is not None else max(1, party_rate or 1)
+        self.retry_after = retry_after
+        self.max_parties = max_parties
+        # client_name -> TokenBucket, least recently seen first
+        self.buckets = collections.OrderedDict()
+
+    def admit(self, client_name, parks, pending, now=None, rated=True):
+        """
+        None if the post is taken, else (reason, seconds to wait). parks
+        tells whether the post would wait for its counterpart, pending is
+        the size of the pending table, rated whether the post counts
+        against its party's rate.
+        """
+        if parks and self.max_pending is not None and pending >= self.max_pending:
+            return 'pending', self.retry_after
+        if self.party_rate is None or not rated:
+            return None
+        if now is None:
+            now = time.monotonic()
+        bucket = self.buckets.get(client_name)
+        if bucket is None:
+            bucket = self.buckets[client_name] = TokenBucket(self.party_burst, now)
+            if len(self.buckets) > self.max_parties:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client_name)
+        wait = bucket.take(self.party_rate, self.party_burst, now)
+        if wait:
+            return 'rate', wait
+        return None
+
+
+def rss_kb(pid='self'):
+    """Resident memory of a process in kB (Linux only)."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def serve(port, sent_messages_file, admission):
+    from fairExchange.PBB.async_pbb import start_async_server
+    start_async_server('127.0.0.1', port, sent_messages_file, False, admission=admission)
+
+
+async def flood(posts, port, pid, parties=100, wave=2000):
+    from fairExchange.PBB.async_client import AsyncPBBClient, RETRY
+    from fairExchange.PBB.bench_pbb import percentile
+
+    client = AsyncPBBClient('127.0.0.1', port)
+    refused = []
+
+    async def timed_post(i):
+        sent = time.perf_counter()
+        outcome = await client.post(f"Mallory{i % parties}", f"flood-{pid}-{i}", "Sync_A")
+        if outcome.status == RETRY:
+            refused.append(time.perf_counter() - sent)
+
+    start_rss = rss_kb(pid)
+    start = time.perf_counter()
+    for first in range(0, posts, wave):
+        # the posts that are taken park forever, only refusals come back
+        waits = [asyncio.ensure_future(timed_post(i)) for i in range(first, min(posts, first + wave))]
+        _, waiting = await asyncio.wait(waits, timeout=1)
+        for wait in waiting:
+            wait.cancel()
+        if (first + len(waits)) % (wave * 10) == 0 or first + wave >= posts:
+            print(f"{first + len(waits):9d} posts  {len(refused):9d} refused  "
+                  f"server rss {rss_kb(pid) - start_rss:+8d} kB")
+    print(f"{posts} posts in {time.perf_counter() - start:.1f} s")
+    if refused:
+        print(f"refusals answered in p50 {percentile(refused, 50) * 1000:.1f} ms, "
+              f"p99 {percentile(refused, 99) * 1000:.1f} ms")
+    await client.close()
+
+
+async def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return condition()
+
+
+async def check_connections(max_connections=4, extra=6, post_timeout=0.5):
+    """Returns the failed checks, as messages."""
+    from fairExchange.PBB.async_pbb import AsyncPBBServer
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        server = AsyncPBBServer('127.0.0.1', 0, os.path.join(tmp, "check.txt"), False, post_timeout=post_timeout,
+                                max_connections=max_connections)
+        await server.start()
+
+        async def post(i):
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(f"Alice{i},parked-{i},Sync_A".encode())
+            answer = await reader.read()
+            writer.close()
+            return answer.decode()
+
+        try:
+            parked = [asyncio.ensure_future(post(i)) for i in range(max_connections)]
+            if not await wait_until(lambda: server.board.pending() == max_connections):
+                failures.append(f"{server.board.pending()} of {max_connections} posts parked")
+            answers = await asyncio.gather(*(post(i) for i in range(max_connections, max_connections + extra)))
+            refused = sum(answer.startswith('retry-after') for answer in answers)
+            if refused != extra:
+                failures.append(f"{refused} of {extra} posts refused with {max_connections} parked, "
+                                f"{server.connections} connections counted")
+            await asyncio.gather(*parked)
+            if not await wait_until(lambda: server.connections == 0):
+                failures.append(f"{server.connections} connections still counted after the parked posts expired")
+            late = await post(max_connections + extra)
+            if late.startswith('retry-after'):
+                failures.append("a post was refused once the parked ones were answered")
+        finally:
+            server.close()
+    return failures
+
+
+def main():
+    from fairExchange.PBB.bench_pbb import free_port
+    from fairExchange.PBB.loadgen import wait_until_ready
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    posts = int(args[0]) if args else 100000
+    admission = None if '--no-admission' in sys.argv else Admission(max_pending=10000, party_rate=50)
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port('127.0.0.1')
+        server = multiprocessing.get_context('fork').Process(
+            target=serve, args=(port, os.path.join(tmp, "flood.txt"), admission), daemon=True)
+        server.start()
+        try:
+            wait_until_ready('127.0.0.1', port)
+            asyncio.run(flood(posts, port, server.pid))
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        failed = asyncio.run(check_connections())
+        for failure in failed:
+            print(f"FAIL {failure}")
+        print(f"{len(failed)} failed")
+        sys.exit(1 if failed else 0)
+    main()
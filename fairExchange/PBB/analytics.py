@@ -0,0 +1,223 @@
+"""
+Reports over a columnar export of the PBB board log (see columnar.py).
+
+    exchanges      tokens with two posts, i.e. decided; the rest still wait
+    cancel rate    decided exchanges where either deciding post was a
+                   Cancel or a remove
+    time to match  seconds from a token's first post to its second
+                   (p50/p90/p99/max; needs a log with times, e.g. a WAL)
+    conflicts      posts that came after the decision, per party
+    repeats        posts a party had already made on the same token
+
+With numpy every aggregate is a handful of whole-column operations over
+the memory-mapped columns, so a report over hundreds of millions of posts
+takes seconds. Without numpy the same report is computed in one Python
+pass over the columns, still without parsing a line of the log (about
+1.5 million posts/s on one core).
+
+usage: python -m fairExchange.PBB.analytics <columns dir> [--top N]
+       python -m fairExchange.PBB.analytics bench [posts]
+writes a synthetic WAL, exports it and times the report.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fairExchange.PBB.columnar import export, open_columns, numpy, REPEAT
+from fairExchange.PBB.protocol import SYNC
+
+PERCENTILES = (50, 90, 99)
+
+
+def report(columns, top=10):
+    """The aggregates of a Columns as a dict."""
+    if numpy is not None:
+        return vectorized_report(columns, top)
+    return scan_report(columns, top)
+
+
+def vectorized_report(columns, top):
+    np = numpy
+    ts = columns.column('ts')
+    token = columns.column('token')
+    party = columns.column('party')
+    rank = columns.column('rank')
+    signal = np.asarray(columns.signals() or [0], dtype=np.uint8)[columns.column('message')]
+
+    first = rank == 0
+    second = rank == 1
+    deciding = rank < 2
+    decided_tokens = token[second]
+    exchanges = len(decided_tokens)
+
+    cancelled = np.zeros(columns.tokens, dtype=bool)
+    cancelled[token[deciding & (signal != SYNC)]] = True
+    cancels = int(np.count_nonzero(cancelled[decided_tokens]))
+
+    # rank 0 posts come in token id order, so this indexes first times by token
+    first_ts = ts[first]
+    waits = ts[second] - first_ts[decided_tokens]
+    waits = waits[~np.isnan(waits)]
+
+    late = (rank >= 2) & (rank != REPEAT)
+    per_party = np.bincount(party[late], minlength=len(columns.parties))
+    worst = np.argsort(per_party, kind='stable')[::-1][:top]
+
+    return {
+        'posts': columns.posts,
+        'tokens': columns.tokens,
+        'exchanges': exchanges,
+        'waiting': columns.tokens - exchanges,
+        'cancelled': cancels,
+        'cancel_rate': cancels / exchanges if exchanges else 0.0,
+        'time_to_match': ({p: float(np.percentile(waits, p, method='lower')) for p in PERCENTILES}
+                          | {'max': float(waits.max())}) if len(waits) else None,
+        'conflicts': int(np.count_nonzero(late)),
+        'repeats': int(np.count_nonzero(rank == REPEAT)),
+        'conflicts_by_party': [(columns.parties[i], int(per_party[i])) for i in worst if per_party[i]],
+    }
+
+
+CANCELLED = 1
+DECIDED = 2
+
+
+def scan_report(columns, top):
+    signals = columns.signals()
+    first_ts = []
+    # per token id: CANCELLED and DECIDED flags
+    flags = bytearray(columns.tokens)
+    waits = []
+    conflicts = repeats = 0
+    per_party = [0] * len(columns.parties)
+    for ts, token, party, message, rank in zip(columns.column('ts'), columns.column('token'),
+                                               columns.column('party'), columns.column('message'),
+                                               columns.column('rank')):
+        if rank == REPEAT:
+            repeats += 1
+            continue
+        if rank >= 2:
+            conflicts += 1
+            per_party[party] += 1
+            continue
+        if signals[message] != SYNC:
+            flags[token] |= CANCELLED
+        if rank == 0:
+            first_ts.append(ts)
+        else:
+            flags[token] |= DECIDED
+            wait = ts - first_ts[token]
+            if not math.isnan(wait):
+                waits.append(wait)
+
+    exchanges = columns.tokens - flags.count(0) - flags.count(CANCELLED)
+    cancels = flags.count(CANCELLED | DECIDED)
+    waits.sort()
+    worst = sorted(range(len(per_party)), key=lambda i: per_party[i], reverse=True)[:top]
+    return {
+        'posts': columns.posts,
+        'tokens': columns.tokens,
+        'exchanges': exchanges,
+        'waiting': columns.tokens - exchanges,
+        'cancelled': cancels,
+        'cancel_rate': cancels / exchanges if exchanges else 0.0,
+        'time_to_match': ({p: waits[(len(waits) - 1) * p // 100] for p in PERCENTILES}
+                          | {'max': waits[-1]}) if waits else None,
+        'conflicts': conflicts,
+        'repeats': repeats,
+        'conflicts_by_party': [(columns.parties[i], per_party[i]) for i in worst if per_party[i]],
+    }
+
+
+def print_report(result):
+    print(f"{result['posts']} posts on {result['tokens']} tokens")
+    print(f"{result['exchanges']} exchanges decided, {result['waiting']} tokens still waiting")
+    print(f"{result['cancelled']} cancelled ({result['cancel_rate']:.2%})")
+    if result['time_to_match'] is None:
+        print("time to match: the log has no times")
+    else:
+        print("time to match: " + ", ".join(f"{'p' + str(p) if p != 'max' else p} {seconds * 1000:.1f} ms"
+                                            for p, seconds in result['time_to_match'].items()))
+    print(f"{result['conflicts']} conflicting posts, {result['repeats']} repeated posts")
+    for client_name, count in result['conflicts_by_party']:
+        print(f"  {client_name:20s} {count:8d} conflicts")
+
+
+def synthetic_wal(file_path, posts, parties=1000, seed=1):
+    """
+    A WAL of Alice/Bob exchanges in sequence: mostly Sync pairs, some
+    cancelled, some with a third, conflicting post.
+    """
+    from fairExchange.PBB.wal import MAGIC, encode_record
+    rng = random.Random(seed)
+    now = 1_700_000_000.0
+    written = 0
+    exchange = 0
+    with open(file_path, 'wb') as file:
+        file.write(MAGIC)
+        records = []
+        while written < posts:
+            token = f"{exchange:064x}"
+            pair = exchange % parties
+            kind = rng.random()
+            second = "Cancel_B" if kind < 0.1 else "Sync_B"
+            exchange_posts = [(f"Alice{pair}", "Sync_A"), (f"Bob{pair}", second)]
+            if kind > 0.98:
+                exchange_posts.append((f"Mallory{pair % 10}", "Sync_A"))
+            for client_name, message in exchange_posts:
+                now += rng.expovariate(1000)
+                records.append(encode_record(client_name, token, message, now))
+            written += len(exchange_posts)
+            exchange += 1
+            if len(records) >= 65536:
+                file.write(b''.join(records))
+                records = []
+        file.write(b''.join(records))
+    return written
+
+
+def bench(posts):
+    with tempfile.TemporaryDirectory() as tmp:
+        wal_path = os.path.join(tmp, "bench.wal")
+        out_dir = os.path.join(tmp, "columns")
+        start = time.perf_counter()
+        written = synthetic_wal(wal_path, posts)
+        print(f"{written} posts written to a WAL in {time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        export(wal_path, out_dir)
+        elapsed = time.perf_counter() - start
+        print(f"exported in {elapsed:.1f} s ({written / elapsed:,.0f} posts/s)")
+
+        columns = open_columns(out_dir)
+        start = time.perf_counter()
+        result = report(columns)
+        elapsed = time.perf_counter() - start
+        print(f"report in {elapsed:.2f} s ({written / elapsed:,.0f} posts/s, "
+              f"{'numpy' if numpy is not None else 'no numpy'})")
+        print_report(result)
+        del result
+        columns.close()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000)
+        return
+    parser = argparse.ArgumentParser(description="Report on a columnar export of the PBB log")
+    parser.add_argument("columns", help="directory written by columnar.py export")
+    parser.add_argument("--top", type=int, default=10, help="parties to list by conflicts")
+    args = parser.parse_args()
+    columns = open_columns(args.columns)
+    start = time.perf_counter()
+    result = report(columns, args.top)
+    print_report(result)
+    print(f"report in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
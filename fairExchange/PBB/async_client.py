@@ -0,0 +1,383 @@
+"""
+Asyncio client library for the PBB.
+
+An AsyncPBBClient keeps a small pool of persistent binary-protocol
+connections (see protocol.py) and pipelines every post over them, so one
+process can drive thousands of concurrent exchanges without a thread or
+a connection each. The PBB's address is resolved once and cached.
+
+    client = AsyncPBBClient(port=12345)
+    outcome = await client.post("Alice", key, "Sync_A", timeout=5)
+    if outcome.status == SUCCESS: ...
+
+A post given a timeout that has not been decided when it runs out sends
+the party's remove message for the token, as start_client does, and
+returns a TIMEOUT outcome; if the counterpart came in meanwhile, the
+real decision is returned instead. A withdrawal the PBB refuses is sent
+again after its retry-after, and Overloaded is raised if that does not
+fit in another timeout.
+
+A party that does not want to hold a connection while its counterpart
+takes its time posts detached and picks the decision up later, from any
+connection, even after a reconnect:
+
+    offset = await client.post_detached("Alice", key, "Sync_A")
+    ...
+    outcome = await client.watch(key)
+
+feed() follows every decision of the board in order. Offsets count the
+decisions since the PBB started; a feed resumes from the last one it saw
+when its connection drops.
+
+usage: python -m fairExchange.PBB.async_client [pairs]
+runs that many concurrent Alice/Bob exchanges against a local asyncio PBB.
+"""
+import asyncio
+import hashlib
+import itertools
+import socket
+import sys
+import tempfile
+import time
+
+from fairExchange.PBB.protocol import (FrameDecoder, ProtocolError, encode_post, decode_result, RESULT,
+                                       ACK, decode_ack, EVENT, decode_event, encode_watch,
+                                       STATUS_SUCCESS, STATUS_CANCEL, STATUS_CONFLICT, STATUS_RETRY, STATUS_FAILED,
+                                       retry_after)
+
+SUCCESS = 'Success'
+CANCEL = 'Cancel'
+CONFLICT = 'Conflict'
+TIMEOUT = 'Timeout'
+RETRY = 'Retry'
+FAILED = 'Failed'
+
+STATUSES = {STATUS_SUCCESS: SUCCESS, STATUS_CANCEL: CANCEL, STATUS_CONFLICT: CONFLICT, STATUS_RETRY: RETRY,
+            STATUS_FAILED: FAILED}
+
+
+class Overloaded(Exception):
+    """
+    The PBB refused a detached post, or the withdrawal of a timed out post
+    until its timeout ran out again; it may be sent again after
+    retry_after seconds.
+    """
+
+    def __init__(self, response):
+        super().__init__(response)
+        self.retry_after = retry_after(response)
+
+
+class LogFailed(Exception):
+    """The PBB could not log a detached post."""
+
+
+class Outcome:
+    """
+    The PBB's decision on one post: status is SUCCESS, CANCEL, CONFLICT or
+    TIMEOUT, RETRY if the PBB refused the post under load, or FAILED if
+    it could not log it (abort). offset is the decision's place in the board's decision log
+    when it came from a watch, None otherwise.
+    """
+    __slots__ = ('status', 'response', 'offset')
+
+    def __init__(self, status, response=None, offset=None):
+        self.status = status
+        self.response = response
+        self.offset = offset
+
+    @property
+    def messages(self):
+        """The messages the decision was made on, e.g. ['Sync_A', 'Sync_B']."""
+        if not self.response:
+            return []
+        return [message.strip() for message in self.response.split(',')]
+
+    @property
+    def retry_after(self):
+        """Seconds the PBB asked to wait before posting again, for a RETRY outcome."""
+        return retry_after(self.response) if self.status == RETRY else None
+
+    def __repr__(self):
+        return f"Outcome({self.status}, {self.response!r})"
+
+
+class PBBConnection:
+    """
+    One persistent binary connection; results and acks are matched to posts
+    by request id, the EVENT frames of a watch are queued by its request id.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.watches = {}
+        self.closed = False
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    def request(self, client_name, digest, message, detached=False):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_post(request_id, client_name, digest, message, detached))
+        return future
+
+    def watch(self, digest=None, offset=0):
+        """Queue of the (offset, key, status, result) events of a new watch; the error once the connection is lost."""
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        queue = self.watches[request_id] = asyncio.Queue()
+        self.writer.write(encode_watch(request_id, digest, offset))
+        return queue
+
+    def unwatch(self, queue):
+        """Stop queueing the events of a watch; the PBB drops it with the connection."""
+        for request_id, watched in list(self.watches.items()):
+            if watched is queue:
+                del self.watches[request_id]
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        error = ConnectionResetError("PBB connection closed")
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for frame_type, arg, request_id, body in decoder.feed(data):
+                    if frame_type == EVENT:
+                        queue = self.watches.get(request_id)
+                        if queue is not None:
+                            queue.put_nowait(decode_event(arg, body))
+                        continue
+                    future = self.pending.pop(request_id, None)
+                    if future is None or future.done():
+                        continue
+                    if frame_type == RESULT:
+                        future.set_result(decode_result(arg, body))
+                    elif frame_type == ACK:
+                        future.set_result(decode_ack(body))
+        except (OSError, ProtocolError) as e:
+            error = e
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+        watches, self.watches = self.watches, {}
+        for queue in watches.values():
+            queue.put_nowait(error)
+
+    async def close(self):
+        self.closed = True
+        self.writer.close()
+        # the PBB closes its side once it has seen ours
+        await self.read_task
+
+
+class AsyncPBBClient:
+
+    def __init__(self, host=None, port=12345, pool_size=4, resolve_ttl=300):
+        if host is None:
+            host = socket.gethostname()
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.resolve_ttl = resolve_ttl
+        self.address = None
+        self.resolved_at = 0.0
+        self.connections = []
+        self.next = 0
+        self.lock = None
+
+    async def resolve(self):
+        """The PBB's (ip, port), looked up again only once resolve_ttl has passed."""
+        if self.address is None or time.monotonic() - self.resolved_at > self.resolve_ttl:
+            infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+            self.address = infos[0][4][:2]
+            self.resolved_at = time.monotonic()
+        return self.address
+
+    async def open_connection(self):
+        host, port = await self.resolve()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            # the address may have changed, look it up again next time
+            self.address = None
+            raise
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return PBBConnection(reader, writer)
+
+    async def connection(self):
+        """Next connection of the pool, round-robin, (re)opening it if needed."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        index = self.next
+        self.next = (self.next + 1) % self.pool_size
+        if index < len(self.connections) and not self.connections[index].closed:
+            return self.connections[index]
+        async with self.lock:
+            if index < len(self.connections) and not self.connections[index].closed:
+                return self.connections[index]
+            connection = await self.open_connection()
+            if index < len(self.connections):
+                self.connections[index] = connection
+            else:
+                self.connections.append(connection)
+            return connection
+
+    async def post(self, client_name, key, option, timeout=None):
+        """Post option for the token of key and return the PBB's Outcome."""
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        connection = await self.connection()
+        future = connection.request(client_name, digest, option)
+        try:
+            status, response = await asyncio.wait_for(asyncio.shield(future), timeout)
+            return Outcome(STATUSES.get(status, CANCEL), response)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # nobody is left to take the result
+            future.cancel()
+            raise
+
+        # withdraw the post; the board answers it right away, with the
+        # counterpart's decision if it arrived in the meantime
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not future.done():
+            withdrawal = connection.request(client_name, digest, 'remove')
+            await asyncio.wait((future, withdrawal), timeout=None if deadline is None else deadline - loop.time(),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if future.done() or not withdrawal.done() or withdrawal.result()[0] != STATUS_RETRY:
+                break
+            # refused: the post is still parked, and reporting a timeout
+            # now would let a late counterpart complete the exchange
+            wait = retry_after(withdrawal.result()[1])
+            if deadline is not None and loop.time() + wait > deadline:
+                future.cancel()
+                raise Overloaded(withdrawal.result()[1])
+            await asyncio.sleep(wait)
+        try:
+            status, response = await asyncio.wait_for(future, None if deadline is None else deadline - loop.time())
+        except asyncio.TimeoutError:
+            return Outcome(TIMEOUT)
+        if 'remove' in response:
+            return Outcome(TIMEOUT, response)
+        return Outcome(STATUSES.get(status, CANCEL), response)
+
+    async def post_detached(self, client_name, key, option):
+        """
+        Post option for the token of key without waiting for the decision.
+        Returns once the post is logged, with the offset from which the
+        board's decision log holds its decision. Raises Overloaded if the
+        PBB refused it, LogFailed if it could not log it.
+        """
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        connection = await self.connection()
+        answer = await connection.request(client_name, digest, option, detached=True)
+        if isinstance(answer, tuple):
+            if answer[0] == STATUS_FAILED:
+                raise LogFailed(answer[1])
+            raise Overloaded(answer[1])
+        return answer
+
+    async def watch(self, key, timeout=None, retry=0.5):
+        """
+        Wait for the PBB's decision on the token of key, already made or
+        not, and return its Outcome; a TIMEOUT Outcome if there is none
+        within timeout. A lost connection is reopened and the watch sent
+        again.
+        """
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                connection = await asyncio.wait_for(self.connection(), remaining)
+            except asyncio.TimeoutError:
+                return Outcome(TIMEOUT)
+            except OSError:
+                # the PBB is not reachable (yet), try again shortly
+                connection = None
+            event = None
+            if connection is not None:
+                queue = connection.watch(digest)
+                try:
+                    event = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    return Outcome(TIMEOUT)
+                finally:
+                    connection.unwatch(queue)
+            if isinstance(event, tuple):
+                offset, _, status, response = event
+                return Outcome(STATUSES.get(status, CANCEL), response, offset)
+            if deadline is not None and loop.time() + retry > deadline:
+                return Outcome(TIMEOUT)
+            await asyncio.sleep(retry)
+
+    async def feed(self, offset=0, retry=0.5):
+        """
+        Yield (token key, Outcome) for every decision of the board from
+        offset on, in order, over a connection of its own. When the
+        connection drops the feed reconnects and resumes after the last
+        decision it yielded.
+        """
+        while True:
+            try:
+                connection = await self.open_connection()
+            except OSError:
+                await asyncio.sleep(retry)
+                continue
+            try:
+                queue = connection.watch(None, offset)
+                while True:
+                    event = await queue.get()
+                    if not isinstance(event, tuple):
+                        break
+                    event_offset, key, status, response = event
+                    offset = event_offset + 1
+                    yield key.hex(), Outcome(STATUSES.get(status, CANCEL), response, event_offset)
+            finally:
+                await connection.close()
+
+    async def exchange(self, posts, timeout=None):
+        """Send several posts concurrently, e.g. both sides of an exchange, and return their Outcomes in order."""
+        return await asyncio.gather(*(self.post(client_name, key, option, timeout)
+                                      for client_name, key, option in posts))
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        await asyncio.gather(*(connection.close() for connection in connections))
+
+
+async def demo(pairs):
+    from fairExchange.PBB.async_pbb import AsyncPBBServer
+
+    with tempfile.NamedTemporaryFile(suffix='.txt') as log:
+        server = AsyncPBBServer('127.0.0.1', 0, log.name, False)
+        await server.start()
+        client = AsyncPBBClient('127.0.0.1', server.port)
+        start = time.perf_counter()
+        exchanges = [client.exchange([(f"Alice{i}", f"demo-{i}", "Sync_A"),
+                                      (f"Bob{i}", f"demo-{i}", "Cancel_B" if i % 10 == 0 else "Sync_B")], timeout=10)
+                     for i in range(pairs)]
+        # a party whose counterpart never comes
+        exchanges.append(client.exchange([("Carol", "demo-abandoned", "Sync_A")], timeout=0.2))
+        results = await asyncio.gather(*exchanges)
+        elapsed = time.perf_counter() - start
+        counts = {}
+        for outcomes in results:
+            for outcome in outcomes:
+                counts[outcome.status] = counts.get(outcome.status, 0) + 1
+        print(f"{pairs} concurrent exchanges over {client.pool_size} connections in {elapsed:.2f} s: {counts}")
+        print(f"abandoned post: {results[-1][0]}")
+        await client.close()
+        server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(demo(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
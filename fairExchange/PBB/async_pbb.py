@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import socket
+
+from fairExchange.PBB import metrics
+from fairExchange.PBB.board_index import token_key
+from fairExchange.PBB.main_pbb import Board, BatchReply, failed_outcomes, freeze_startup
+from fairExchange.PBB.admission import Admission, RETRY_AFTER
+from fairExchange.PBB.protocol import (FrameDecoder, is_binary, decode_post, encode_result, BATCH, decode_batch,
+                                       WATCH, decode_watch, encode_event, is_detached, encode_ack,
+                                       encode_batch_result, retry_result, ProtocolError)
+from fairExchange.PBB.snapshot import BoardStore, Compactor
+from fairExchange.PBB.wal import WriteAheadLog, FSYNC_ALWAYS
+
+# A post is a single "name,hexhash,message" string; anything longer is
+# not a valid post, so no connection ever buffers more than this.
+MAX_POST_SIZE = 1024
+BACKLOG = 4096
+
+# Multiplexed connections open with this byte and carry one post per line,
+# "@<request id>,name,hexhash,message\n"; results come back as
+# "@<request id>,<result>\n" in whatever order the board decides them.
+MUX_PREFIX = b'@'
+MUX_READ_SIZE = 65536
+# a watcher further behind than this is dropped with its connection; it
+# resumes from the last offset it got
+MAX_WATCH_BUFFER = 1 << 20
+
+
+def decode_legacy_post(data):
+    """(client_name, client_hash, message) of a legacy post, refused unless it has exactly those three fields."""
+    fields = data.decode().split(',')
+    if len(fields) != 3:
+        raise ProtocolError(f"Malformed post {data[:64]!r}")
+    return fields
+
+
+class StreamReply:
+    """A legacy connection: one post, one result, then the connection is closed."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, result):
+        self.writer.write(result.encode())
+        self.writer.close()
+
+
+class MuxReply:
+    """One post of a multiplexed connection, answered with its request id."""
+
+    def __init__(self, writer, request_id):
+        self.writer = writer
+        self.request_id = request_id
+
+    def send(self, result):
+        if not self.writer.is_closing():
+            self.writer.write(f"@{self.request_id},{result}\n".encode())
+
+
+class BinaryReply:
+    """One post of a binary connection, answered with a RESULT frame."""
+
+    def __init__(self, writer, request_id):
+        self.writer = writer
+        self.request_id = request_id
+
+    def send(self, result):
+        if not self.writer.is_closing():
+            self.writer.write(encode_result(self.request_id, result))
+
+
+class AckReply:
+    """A detached post, acknowledged once it is logged."""
+
+    def __init__(self, writer, request_id):
+        self.writer = writer
+        self.request_id = request_id
+
+    def send(self, offset):
+        if not self.writer.is_closing():
+            self.writer.write(encode_ack(self.request_id, offset))
+
+
+class WatchReply:
+    """A WATCH of a binary connection, pushed an EVENT frame per decision."""
+
+    def __init__(self, writer, request_id):
+        self.writer = writer
+        self.request_id = request_id
+
+    def send(self, event):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_WATCH_BUFFER:
+            self.writer.close()
+            return
+        offset, client_hash, result = event
+        self.writer.write(encode_event(self.request_id, offset, token_key(client_hash), result))
+
+
+class AsyncPBBServer:
+    """
+    Event-loop PBB. Same post/match semantics as main_pbb.start_server,
+    but a parked first party only costs a StreamWriter in the board's
+    pending table, and a slow client never blocks the other posts.
+
+    Beyond max_connections open connections, a new connection has the
+    posts of its first read refused with a retry-after and is closed. A
+    connection counts until it is closed, parked legacy posts included.
+    """
+
+    def __init__(self, host=None, port=12345, sent_messages_file='sent_messages.txt', verbose=True, wal=None,
+                 post_timeout=None, admission=None, max_connections=None, backlog=BACKLOG):
+        if host is None:
+            host = socket.gethostname()
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.board = Board(sent_messages_file, wal, post_timeout, admission=admission)
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.connections = 0
+        # wait_closed() tasks of the connections still open after their handler returned
+        self.held = set()
+        self.server = None
+        self.loop = None
+        # token -> [(count, future)] of wait_for_posts
+        self.post_waiters = {}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                 limit=MAX_POST_SIZE, backlog=self.backlog,
+                                                 reuse_address=True)
+        # port 0 asks the OS for a free port, report the one we got
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.watch_deadlines()
+        return self.server
+
+    def watch_deadlines(self):
+        """Expire abandoned posts once per tick of the board's timing wheel."""
+        if self.board.deadlines is None:
+            return
+        outcomes, commit = self.board.expire()
+        if outcomes:
+            self.settle(outcomes, commit)
+        self.loop.call_later(self.board.deadlines.tick, self.watch_deadlines)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.verbose:
+            print("Got a connection from %s" % str(addr))
+        self.connections += 1
+        try:
+            data = await reader.read(MAX_POST_SIZE)
+            if not data:
+                writer.close()
+            elif self.max_connections is not None and self.connections > self.max_connections:
+                self.refuse(data, writer)
+            elif is_binary(data):
+                await self.handle_binary(data, reader, writer)
+            elif data.startswith(MUX_PREFIX):
+                await self.handle_mux(data, reader, writer)
+            else:
+                await self.handle_post(data, writer)
+        except Exception as e:
+            metrics.CLIENT_ERRORS.value += 1
+            print(f"Error handling client {addr}: {e}")
+            writer.close()
+        finally:
+            if writer.is_closing():
+                self.connections -= 1
+            else:
+                # a parked legacy post keeps its connection, and its descriptor, until it is answered
+                task = asyncio.ensure_future(self.release(writer))
+                self.held.add(task)
+                task.add_done_callback(self.held.discard)
+
+    async def release(self, writer):
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        finally:
+            self.connections -= 1
+
+    def refuse(self, data, writer):
+        """Answer the posts of a connection the server has no room for with a retry-after, then close it."""
+        metrics.REJECTED_CONNECTIONS.value += 1
+        admission = self.board.admission
+        refusal = retry_result(admission.retry_after if admission is not None else RETRY_AFTER)
+        if is_binary(data):
+            # frames cut off by the end of the read are never answered
+            for frame_type, arg, request_id, body in FrameDecoder(MAX_POST_SIZE).feed(data):
+                if frame_type == BATCH:
+                    writer.write(encode_batch_result(request_id, [refusal] * len(decode_batch(body))))
+                else:
+                    writer.write(encode_result(request_id, refusal))
+        elif data.startswith(MUX_PREFIX):
+            for line in data.split(b'\n')[:-1]:
+                writer.write(b"@" + line[1:].split(b',', 1)[0] + f",{refusal}\n".encode())
+        else:
+            writer.write(refusal.encode())
+        writer.close()
+
+    async def handle_post(self, data, writer):
+        client_name, client_hash, message = decode_legacy_post(data)
+        self.submit(client_name, client_hash, message, StreamReply(writer))
+
+    async def handle_mux(self, data, reader, writer):
+        buffer = data
+        while True:
+            lines = buffer.split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                request_id, client_name, client_hash, message = line[1:].decode().split(',')
+                self.submit(client_name, client_hash, message, MuxReply(writer, request_id))
+            if len(buffer) > MAX_POST_SIZE:
+                raise ValueError("post too long")
+            data = await reader.read(MUX_READ_SIZE)
+            if not data:
+                break
+            buffer += data
+        writer.close()
+
+    async def handle_binary(self, data, reader, writer):
+        decoder = FrameDecoder(MAX_POST_SIZE)
+        # (watcher, token or None) of the WATCH frames of this connection
+        watching = []
+        try:
+            while data:
+                for frame_type, arg, request_id, body in decoder.feed(data):
+                    if frame_type == BATCH:
+                        self.submit_batch(request_id, decode_batch(body), writer)
+                        continue
+                    if frame_type == WATCH:
+                        offset, client_hash = decode_watch(body)
+                        watcher = WatchReply(writer, request_id)
+                        watching.append((watcher, client_hash))
+                        self.watch(watcher, client_hash, offset)
+                        continue
+                    client_name, client_hash, message = decode_post(frame_type, arg, body)
+                    if is_detached(frame_type):
+                        self.submit_detached(client_name, client_hash, message, AckReply(writer, request_id))
+                    else:
+                        self.submit(client_name, client_hash, message, BinaryReply(writer, request_id))
+                data = await reader.read(MUX_READ_SIZE)
+        finally:
+            for watcher, client_hash in watching:
+                self.board.unwatch(watcher, client_hash)
+        writer.close()
+
+    def submit(self, client_name, client_hash, message, reply):
+        if self.verbose:
+            print(f"The PBB Received the {message} message from {client_name} with token {client_hash}")
+
+        self.settle(*self.board.post(client_name, client_hash, message, reply))
+        if client_hash in self.post_waiters:
+            self.wake(client_hash)
+
+    def submit_detached(self, client_name, client_hash, message, ack):
+        """
+        Post without waiting for the decision: ack is sent the offset the
+        board's next decision will get as soon as the post is logged, and
+        the decision itself only goes to the watchers.
+        """
+        refusal = self.board.admit(client_name, client_hash, message)
+        if refusal is not None:
+            self.settle([(BinaryReply(ack.writer, ack.request_id), refusal)], None)
+            return
+        offset = self.board.next_offset
+        outcomes, commit = self.board.post(client_name, client_hash, message, None, admitted=True)
+        outcomes.append((ack, offset))
+        self.settle(outcomes, commit)
+        if client_hash in self.post_waiters:
+            self.wake(client_hash)
+
+    def watch(self, watcher, client_hash=None, offset=0):
+        """Push the decision on client_hash to watcher, or every decision from offset on without a token."""
+        if client_hash is None:
+            self.settle(self.board.watch_feed(watcher, offset), None)
+        else:
+            self.settle(self.board.watch(client_hash, watcher), None)
+
+    def wait_for_posts(self, client_hash, count):
+        """
+        Future resolved once the board holds count messages for the token,
+        so a caller can order its posts on the board without sleeping.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.post_waiters.setdefault(client_hash, []).append((count, future))
+        self.wake(client_hash)
+        return future
+
+    def wake(self, client_hash):
+        posted = self.board.sent_messages.count(client_hash)
+        waiting = []
+        for count, future in self.post_waiters.pop(client_hash, []):
+            if future.done():
+                continue
+            if posted >= count:
+                future.set_result(posted)
+            else:
+                waiting.append((count, future))
+        if waiting:
+            self.post_waiters[client_hash] = waiting
+
+    def submit_batch(self, request_id, posts, writer):
+        """Apply the posts of a BATCH frame and answer with its BATCH_RESULT."""
+        if self.verbose:
+            for client_name, client_hash, message in posts:
+                print(f"The PBB Received the {message} message from {client_name} with token {client_hash}")
+
+        def write(data):
+            if not writer.is_closing():
+                writer.write(data)
+
+        batch = BatchReply(request_id, len(posts), write)
+        outcomes, commit = self.apply_batch([post + (batch.item(i),) for i, post in enumerate(posts)])
+        outcomes.append((batch, None))
+        self.settle(outcomes, commit)
+        for _, client_hash, _ in posts:
+            if client_hash in self.post_waiters:
+                self.wake(client_hash)
+
+    def apply_batch(self, posts):
+        return self.board.post_batch(posts)
+
+    def settle(self, outcomes, commit):
+        if commit is None:
+            self.deliver(outcomes, None)
+        else:
+            # posts arriving meanwhile join the same group commit
+            commit.add_done_callback(lambda done: self.loop.call_soon_threadsafe(self.deliver, outcomes, done))
+
+    def deliver(self, outcomes, commit):
+        if commit is not None and commit.exception() is not None:
+            print(f"Could not log post: {commit.exception()}")
+            # a detached post is answered with the failure instead of its ack
+            outcomes = failed_outcomes([(BinaryReply(replyIt.writer, replyIt.request_id), '')
+                                        if isinstance(replyIt, AckReply) else (replyIt, result)
+                                        for replyIt, result in outcomes], commit.exception())
+            outcomes += self.board.unlog_failed()
+        for replyIt, result in outcomes:
+            replyIt.send(result)
+
+
+def start_async_server(host=None, port=12345, sent_messages_file='sent_messages.txt', verbose=True, wal=None,
+                       post_timeout=None, metrics_port=None, admission=None, max_connections=None, backlog=BACKLOG):
+    if metrics_port is not None:
+        metrics.start_metrics_server(metrics_port)
+    server = AsyncPBBServer(host, port, sent_messages_file, verbose, wal, post_timeout, admission, max_connections,
+                            backlog)
+    freeze_startup()
+    asyncio.run(server.serve_forever())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Asyncio PBB server")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--log", default='sent_messages.txt', help="text log of the board")
+    parser.add_argument("--wal", help="use a binary write-ahead log at this path instead of the text log")
+    parser.add_argument("--data-dir", help="keep the board as WAL segments plus snapshots in this directory")
+    parser.add_argument("--compact-interval", type=int, default=60, help="seconds between compactions of --data-dir")
+    parser.add_argument("--fsync", default=FSYNC_ALWAYS, choices=["always", "interval", "never"])
+    parser.add_argument("--fsync-interval-ms", type=int, default=10)
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on localhost at this port")
+    parser.add_argument("--post-timeout", type=float, help="seconds a post waits for its counterpart before it is cancelled")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="connections the kernel queues before accept")
+    parser.add_argument("--max-connections", type=int, help="refuse new connections beyond this many open ones")
+    parser.add_argument("--max-pending", type=int, help="refuse posts that would park beyond this many pending ones")
+    parser.add_argument("--party-rate", type=float, help="posts per second allowed to each party")
+    parser.add_argument("--party-burst", type=int, help="posts a party may send at once (default: --party-rate)")
+    parser.add_argument("--retry-after", type=float, default=RETRY_AFTER,
+                        help="seconds a party refused for a full pending table is told to wait")
+    parser.add_argument("--replicate-port", type=int, help="ship the --wal log to followers on this port")
+    parser.add_argument("--replicate-host", default='127.0.0.1',
+                        help="interface of the replication port; followers are not authenticated, "
+                             "so only widen it on a trusted network")
+    parser.add_argument("--min-acks", type=int, default=1,
+                        help="followers that must hold a post before it is answered (0: asynchronous)")
+    args = parser.parse_args()
+
+    wal = None
+    if args.data_dir:
+        wal = BoardStore(args.data_dir, args.fsync, args.fsync_interval_ms)
+        Compactor(wal, args.compact_interval).start()
+    elif args.wal:
+        wal = WriteAheadLog(args.wal, args.fsync, args.fsync_interval_ms)
+        if args.replicate_port is not None:
+            from fairExchange.PBB.replication import ReplicatedLog
+            wal = ReplicatedLog(wal, args.min_acks, args.replicate_host, args.replicate_port)
+    admission = None
+    if args.max_pending is not None or args.party_rate is not None:
+        admission = Admission(args.max_pending, args.party_rate, args.party_burst, args.retry_after)
+    start_async_server(port=args.port, sent_messages_file=args.log, wal=wal, post_timeout=args.post_timeout,
+                       metrics_port=args.metrics_port, admission=admission, max_connections=args.max_connections,
+                       backlog=args.backlog)
@@ -0,0 +1,184 @@
+"""
+Compare the blocking PBB (main_pbb.start_server) with the asyncio PBB
+(async_pbb.AsyncPBBServer): both servers run locally on free ports with
+a throw-away log, and N Alice/Bob pairs post Sync_A/Sync_B concurrently.
+The batch runs send the same pairs as BATCH frames of [batch] posts, the
+Alice and the Bob side of each group of pairs in two concurrent batches.
+
+usage: python -m fairExchange.PBB.bench_pbb [pairs] [concurrency] [batch]
+"""
+import asyncio
+import hashlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from fairExchange.PBB.async_pbb import AsyncPBBServer
+from fairExchange.PBB.main_pbb import start_server
+from fairExchange.PBB.protocol import FrameDecoder, encode_batch, decode_batch_result, BATCH_RESULT
+from fairExchange.PBB.wal import WriteAheadLog
+
+
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def post_once(host, port, client_name, hex_dig, option):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'{client_name},{hex_dig},{option}'.encode())
+        await writer.drain()
+        return await reader.read(1024)
+    finally:
+        writer.close()
+
+
+async def post(host, port, client_name, hex_dig, option, timeout=5):
+    try:
+        response = await asyncio.wait_for(post_once(host, port, client_name, hex_dig, option), timeout)
+    except (ConnectionError, asyncio.TimeoutError):
+        # the blocking server drops connections once its listen backlog is
+        # full, and the counterpart of a dropped post then waits forever
+        return None
+    return response.decode()
+
+
+async def run_pairs(host, port, pairs, concurrency, first=0):
+    """Post Sync_A/Sync_B for every pair and time each pair until both parties have an answer."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = []
+
+    async def one_pair(i):
+        # one party name per pair keeps the exchanges independent on the board
+        hex_dig = hashlib.sha256(f'bench-{i}'.encode()).hexdigest()
+        async with semaphore:
+            start = time.perf_counter()
+            responses = await asyncio.gather(post(host, port, f"Alice{i}", hex_dig, "Sync_A"),
+                                             post(host, port, f"Bob{i}", hex_dig, "Sync_B"))
+            if None in responses:
+                failures.append(i)
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_pair(i) for i in range(first, first + pairs)))
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies, len(failures)
+
+
+async def post_batch_once(host, port, posts):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(encode_batch(0, posts))
+        await writer.drain()
+        decoder = FrameDecoder()
+        responses = []
+        waiting = None
+        while waiting != 0:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionResetError("batch connection closed")
+            for frame_type, _, request_id, body in decoder.feed(data):
+                if frame_type == BATCH_RESULT:
+                    responses.extend(response for _, response in decode_batch_result(body))
+                    if len(responses) == len(posts):
+                        waiting = sum(response is None for response in responses)
+                else:
+                    responses[request_id] = body.decode()
+                    waiting -= 1
+        return responses
+    finally:
+        writer.close()
+
+
+async def post_batch(host, port, posts, timeout=30):
+    try:
+        return await asyncio.wait_for(post_batch_once(host, port, posts), timeout)
+    except (ConnectionError, asyncio.TimeoutError):
+        return None
+
+
+async def run_batches(host, port, pairs, batch, concurrency):
+    """Post the pairs as batches; the latency of a pair is that of its two batches."""
+    semaphore = asyncio.Semaphore(max(1, concurrency // batch))
+    latencies = []
+    failures = []
+
+    async def one_group(first):
+        group = range(first, min(first + batch, pairs))
+        digests = [hashlib.sha256(f'bench-{i}'.encode()).digest() for i in group]
+        async with semaphore:
+            start = time.perf_counter()
+            responses = await asyncio.gather(
+                post_batch(host, port, [(f"Alice{i}", digest, "Sync_A") for i, digest in zip(group, digests)]),
+                post_batch(host, port, [(f"Bob{i}", digest, "Sync_B") for i, digest in zip(group, digests)]))
+            if None in responses:
+                failures.extend(group)
+            else:
+                latencies.extend([time.perf_counter() - start] * len(group))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_group(first) for first in range(0, pairs, batch)))
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies, len(failures)
+
+
+def report(name, pairs, elapsed, latencies, failures):
+    print(f"{name:>14}: {2 * pairs / elapsed:10.0f} posts/sec   "
+          f"p50 {percentile(latencies, 50) * 1000:8.2f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:8.2f} ms   "
+          f"{failures} failed pairs")
+
+
+def bench_blocking(host, pairs, concurrency, log_file):
+    port = free_port(host)
+    threading.Thread(target=start_server, args=(host, port, log_file, False), daemon=True).start()
+    time.sleep(0.5)
+    elapsed, latencies, failures = asyncio.run(run_pairs(host, port, pairs, concurrency))
+    report("blocking", pairs, elapsed, latencies, failures)
+
+
+def bench_async(host, pairs, concurrency, log_file, wal=None, name="asyncio", batch=None):
+    server = AsyncPBBServer(host, 0, log_file, False, wal)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    if batch:
+        elapsed, latencies, failures = asyncio.run(run_batches(host, server.port, pairs, batch, concurrency))
+    else:
+        elapsed, latencies, failures = asyncio.run(run_pairs(host, server.port, pairs, concurrency))
+    report(name, pairs, elapsed, latencies, failures)
+    loop.call_soon_threadsafe(server.close)
+    if wal is not None:
+        wal.close()
+
+
+if __name__ == "__main__":
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    batch = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    host = "127.0.0.1"
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{pairs} pairs, {concurrency} pairs in flight")
+        bench_blocking(host, pairs, concurrency, os.path.join(tmp, "blocking.txt"))
+        bench_async(host, pairs, concurrency, os.path.join(tmp, "async.txt"))
+        for fsync in ("always", "interval", "never"):
+            wal = WriteAheadLog(os.path.join(tmp, f"{fsync}.wal"), fsync)
+            bench_async(host, pairs, concurrency, None, wal, f"wal-{fsync}")
+        bench_async(host, pairs, concurrency, os.path.join(tmp, "batch.txt"), name=f"batch-{batch}", batch=batch)
+        wal = WriteAheadLog(os.path.join(tmp, "batch.wal"), "always")
+        bench_async(host, pairs, concurrency, None, wal, f"wal-batch-{batch}", batch)
@@ -0,0 +1,339 @@
+"""
+Token-keyed index of the PBB board.
+
+The board used to be a dict client -> hash -> set(messages) and every post
+walked all of it to find the messages posted under one token. The index
+keeps, for every token, the messages of each party that posted it and a
+running count, so the "more than 2 messages with this hash" check and the
+matching step only touch the entries of that token.
+
+usage: python -m fairExchange.PBB.board_index [sent_messages.txt]
+replays a recorded log through the index and through the original
+full-board scan and reports any post on which the two disagree (see
+compare_with_scan for the one intended difference).
+
+usage: python -m fairExchange.PBB.board_index check
+does the same on a fixed log, and checks that the write-ahead log gives
+back every token of it as posted.
+
+usage: python -m fairExchange.PBB.board_index bench [posts ...]
+measures the memory per post of the board layouts.
+"""
+import gc
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+
+# one post of a token: interned party id, interned message code
+POST = struct.Struct('<II')
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def is_digest(client_hash):
+    """
+    A token in the form hexdigest() gives it. Tokens are compared as text,
+    so only this form can be stored as its bytes: "AB..." and "ab..." are
+    two tokens.
+    """
+    return len(client_hash) == 64 and HEX_DIGITS.issuperset(client_hash)
+
+
+def token_key(client_hash):
+    """32-byte key of a token: the digest itself, or a hash of a non-digest token."""
+    if is_digest(client_hash):
+        return bytes.fromhex(client_hash)
+    return hashlib.sha256(b'\0' + client_hash.encode()).digest()
+
+
+class BoardIndex:
+    """
+    With a base (a snapshot.Snapshot), the index only holds the tokens
+    posted since the snapshot was taken; a token that is only in the
+    snapshot is pulled into memory the first time it is looked up.
+
+    The board is kept compact: a token is its 32-byte digest, party names
+    and messages are interned once as small integers, and the posts of a
+    token are packed (party, message) pairs in one bytes object. A dict
+    holding only bytes is never tracked by the garbage collector, so the
+    board costs the GC nothing however large it grows.
+    """
+
+    def __init__(self, base=None):
+        # token key -> POST records of the token, in posting order
+        self.tokens = {}
+        self.base = base
+        # token key -> last WAL segment that changed it, for eviction
+        self.generations = {}
+        self.party_ids = {}
+        self.party_names = []
+        self.message_codes = {}
+        self.messages = []
+        # the board looks up the same token several times per post
+        self.last_hash = None
+        self.last_key = None
+
+    def key(self, client_hash):
+        if client_hash != self.last_hash:
+            self.last_key = token_key(client_hash)
+            self.last_hash = client_hash
+        return self.last_key
+
+    def party_id(self, client_name):
+        party = self.party_ids.get(client_name)
+        if party is None:
+            party = self.party_ids[sys.intern(client_name)] = len(self.party_names)
+            self.party_names.append(client_name)
+        return party
+
+    def message_code(self, message):
+        code = self.message_codes.get(message)
+        if code is None:
+            code = self.message_codes[sys.intern(message)] = len(self.messages)
+            self.messages.append(message)
+        return code
+
+    def load(self, client_hash):
+        key = self.key(client_hash)
+        posts = self.tokens.get(key)
+        if posts is None and self.base is not None:
+            entries = self.base.lookup(client_hash)
+            if entries:
+                posts = self.tokens[key] = b''.join(POST.pack(self.party_id(client_name), self.message_code(message))
+                                                    for client_name, message in entries)
+        return posts
+
+    def add(self, client_name, client_hash, message):
+        """Record a post. Returns False if the party already posted this message for this token."""
+        posts = self.load(client_hash) or b''
+        post = POST.pack(self.party_id(client_name), self.message_code(message))
+        found = posts.find(post)
+        while found != -1:
+            if found % POST.size == 0:
+                return False
+            found = posts.find(post, found + 1)
+        self.tokens[self.key(client_hash)] = posts + post
+        return True
+
+    def remove(self, client_name, client_hash, message):
+        """Take back a post add() recorded, one the log failed to commit."""
+        posts = self.load(client_hash) or b''
+        post = POST.pack(self.party_id(client_name), self.message_code(message))
+        found = posts.find(post)
+        while found != -1:
+            if found % POST.size == 0:
+                rest = posts[:found] + posts[found + POST.size:]
+                if rest:
+                    self.tokens[self.key(client_hash)] = rest
+                else:
+                    del self.tokens[self.key(client_hash)]
+                return True
+            found = posts.find(post, found + 1)
+        return False
+
+    def count(self, client_hash):
+        posts = self.load(client_hash)
+        return len(posts) // POST.size if posts else 0
+
+    def grouped(self, client_hash):
+        """{party id: [message, ...]} of a token, parties in the order they first posted."""
+        groups = {}
+        for party, code in POST.iter_unpack(self.load(client_hash) or b''):
+            groups.setdefault(party, []).append(self.messages[code])
+        return groups
+
+    def messages_with_hash(self, client_hash):
+        return [msg for messages in self.grouped(client_hash).values() for msg in messages]
+
+    def parties(self, client_hash):
+        return [self.party_names[party] for party in self.grouped(client_hash)]
+
+    def posted(self, client_hash):
+        """[(client_name, message)] of a token in posting order."""
+        return [(self.party_names[party], self.messages[code])
+                for party, code in POST.iter_unpack(self.load(client_hash) or b'')]
+
+    def touch(self, client_hash, generation):
+        self.generations[self.key(client_hash)] = generation
+
+    def install(self, base, covered):
+        """
+        Switch to a newer snapshot that holds every post of the segments
+        before covered, and drop the tokens it makes redundant.
+        """
+        self.base = base
+        for key in [k for k in self.tokens if self.generations.get(k, -1) < covered]:
+            del self.tokens[key]
+            self.generations.pop(key, None)
+
+
+def baseline_messages_with_hash(sent_messages, client_hash):
+    """The scan of the original main_pbb, verbatim, over its client -> hash -> set(messages) layout."""
+    all_messages_with_hash = [msg for msgs in sent_messages.values() for hash_msgs in msgs.values() for msg in hash_msgs if client_hash in msgs]
+    return all_messages_with_hash
+
+
+def compare_with_scan(file_path):
+    """
+    Replay a recorded log and check that, after every post, the index and
+    the original full-board scan take the same conflict decision on the
+    same messages (in any order).
+
+    One difference is intended: the original scan collects every message
+    of every party that posted the token, under any token, so a party's
+    second exchange looked like a conflict. Where a party of the token
+    has posted other tokens too, the index is checked against the scan
+    restricted to the token instead, and the post is counted as an
+    intended difference if the original scan disagrees.
+    Returns (mismatches, intended): the (line_number, line) where the two
+    disagree, and the number of intended differences.
+    """
+    sent_messages = {}
+    index = BoardIndex()
+    mismatches = []
+    intended = 0
+    if not os.path.exists(file_path):
+        return mismatches, intended
+    with open(file_path, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            parts = line.strip().split(',')
+            if len(parts) != 3:
+                continue
+            client_name, client_hash, message = parts
+            sent_messages.setdefault(client_name, {}).setdefault(client_hash, set()).add(message)
+            index.add(client_name, client_hash, message)
+
+            indexed = index.messages_with_hash(client_hash)
+            scanned = baseline_messages_with_hash(sent_messages, client_hash)
+            if (len(scanned) > 2) == (index.count(client_hash) > 2) and sorted(scanned) == sorted(indexed):
+                continue
+            if any(len(sent_messages[name]) > 1 for name in index.parties(client_hash)):
+                restricted = [msg for msgs in sent_messages.values() for msg in msgs.get(client_hash, ())]
+                if (len(restricted) > 2) == (index.count(client_hash) > 2) and sorted(restricted) == sorted(indexed):
+                    intended += 1
+                    continue
+            mismatches.append((line_number, line.strip()))
+    return mismatches, intended
+
+
+DIGEST = hashlib.sha256(b'fixed log').hexdigest()
+# every kind of token: a digest, the same digest in upper case, text that
+# only differs in case and 64 characters that are not hex
+FIXED_LOG = [
+    f"Alice,{DIGEST},Sync_A",
+    f"Bob,{DIGEST.upper()},Sync_B",
+    f"Bob,{DIGEST},Sync_B",
+    f"Carol,{DIGEST.upper()},Sync_A",
+    f"Dave,{DIGEST},Cancel_A",
+    "Erin,exchange-1,Sync_A",
+    "Frank,EXCHANGE-1,Sync_B",
+    "Frank,exchange-1,Sync_B",
+    f"Gina,{'g' * 64},Sync_A",
+    f"Gina,{'g' * 64},remove",
+]
+
+
+def check():
+    """Returns the failed checks, as messages."""
+    from fairExchange.PBB.wal import WriteAheadLog, read_records
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sent_messages.txt')
+        with open(path, 'w') as file:
+            file.write("\n".join(FIXED_LOG) + "\n")
+        mismatches, _ = compare_with_scan(path)
+        failures.extend(f"decision differs after line {line_number}: {line}" for line_number, line in mismatches)
+
+        posts = [tuple(line.split(',')) for line in FIXED_LOG]
+        wal_path = os.path.join(tmp, 'board.wal')
+        log = WriteAheadLog(wal_path)
+        for post in posts:
+            log.append(*post).result()
+        log.close()
+        recovered = [(name, token, message) for _, (_, name, token, message) in read_records(wal_path)]
+        failures.extend(f"write-ahead log gave back {got} for {posted}"
+                        for posted, got in zip(posts, recovered) if got != posted)
+    return failures
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def synthetic_posts(posts, parties=10000):
+    """Alice/Bob pairs of posts, a fresh token string per post as if parsed from the network."""
+    for i in range(posts):
+        pair = i // 2
+        digest = hashlib.sha256(str(pair).encode()).digest()
+        if i % 2 == 0:
+            yield f"Alice{pair % parties}", digest.hex(), "Sync_A"
+        else:
+            yield f"Bob{pair % parties}", digest.hex(), "Sync_B"
+
+
+def build_layout(layout, posts):
+    """Build a board of posts in one layout and return it."""
+    if layout == 'legacy':
+        # main_pbb before the index: client -> hash -> set(messages)
+        board = {}
+        for client_name, client_hash, message in synthetic_posts(posts):
+            board.setdefault(client_name, {}).setdefault(client_hash, set()).add(message)
+    elif layout == 'dicts':
+        # the first BoardIndex: token -> {party: {message: None}} and token -> count
+        tokens, counts = {}, {}
+        for client_name, client_hash, message in synthetic_posts(posts):
+            tokens.setdefault(client_hash, {}).setdefault(client_name, {})[message] = None
+            counts[client_hash] = counts.get(client_hash, 0) + 1
+        board = tokens, counts
+    else:
+        board = BoardIndex()
+        for client_name, client_hash, message in synthetic_posts(posts):
+            board.add(client_name, client_hash, message)
+    return board
+
+
+def measure(layout, posts, results):
+    gc.collect()
+    before = resident_bytes()
+    board = build_layout(layout, posts)
+    gc.collect()
+    used = resident_bytes() - before
+    tracked = sum(1 for _ in gc.get_objects())
+    results.put((used, tracked))
+    del board
+
+
+def bench(post_counts, layouts=('legacy', 'dicts', 'compact')):
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    for posts in post_counts:
+        for layout in layouts:
+            # a fresh process per layout, so one layout's freed memory does not hide the next one's
+            results = context.Queue()
+            worker = context.Process(target=measure, args=(layout, posts, results))
+            worker.start()
+            used, tracked = results.get()
+            worker.join()
+            print(f"{posts:>10} posts  {layout:>8}: {used / posts:8.1f} bytes/post  "
+                  f"{used / 2 ** 20:9.1f} MB  {tracked:>10} GC-tracked objects")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench([int(n) for n in sys.argv[2:]] or [1000000])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        failed = check()
+        for failure in failed:
+            print(f"FAIL {failure}")
+        print(f"{len(failed)} failed")
+        sys.exit(1 if failed else 0)
+    file_path = sys.argv[1] if len(sys.argv) > 1 else 'sent_messages.txt'
+    mismatches, intended = compare_with_scan(file_path)
+    for line_number, line in mismatches:
+        print(f"Decision differs after line {line_number}: {line}")
+    print(f"{len(mismatches)} mismatches in {file_path}, {intended} intended differences "
+          f"(a party that posted other tokens too)")
+    sys.exit(1 if mismatches else 0)
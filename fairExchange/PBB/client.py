@@ -1,10 +1,19 @@
 import hashlib
 import socket
 
-import hashlib
-import socket
+from fairExchange.PBB.protocol import (FrameDecoder, encode_post, recv_frame, decode_result,
+                                       encode_batch, decode_batch_result, BATCH_RESULT, RETRY_AFTER,
+                                       result_status, STATUS_SUCCESS)
 
-def start_client(client_name, key, option):
+def response_action(client_name, response):
+    if response.startswith(RETRY_AFTER):
+        return "The PBB is overloaded and did not take the signal. \n"+client_name+" should send it again in "+response[len(RETRY_AFTER):].strip()+" s"
+    # a cancel, a withdrawal (remove) and a conflict all abort
+    if result_status(response) != STATUS_SUCCESS:
+        return "Abort exchange. \n"+client_name+"'s attestable sends notification of abort to "+client_name+"'s application"
+    return "The exchange can be successfully completed. \n"+client_name+"'s attestable sends D_B to "+client_name+"'s application."
+
+def start_client(client_name, key, option, binary=False):
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     host = socket.gethostname()
     port = 12345
@@ -14,26 +23,68 @@ def start_client(client_name, key, option):
     hash_object = hashlib.sha256(key_bytes)
     hex_dig = hash_object.hexdigest()
 
-    message = f'{client_name},{hex_dig},{option}'
     print(f"\n{client_name} sent: {option} to PBB\n")
-    client_socket.send(message.encode())
+    if binary:
+        client_socket.sendall(encode_post(0, client_name, hash_object.digest(), option))
+    else:
+        message = f'{client_name},{hex_dig},{option}'
+        client_socket.send(message.encode())
 
     try:
         responseAction = None
-        response = client_socket.recv(1024).decode()
-        if "cancel" in response.lower():
-            acao = "Abort exchange. \n"+client_name+"'s attestable sends notification of abort to "+client_name+"'s application"
+        if binary:
+            _, arg, _, body = recv_frame(client_socket, FrameDecoder())
+            _, response = decode_result(arg, body)
         else:
-            acao = "The exchange can be successfully completed. \n"+client_name+"'s attestable sends D_B to "+client_name+"'s application."
+            response = client_socket.recv(1024).decode()
+        acao = response_action(client_name, response)
         print(f"\n The PBB responded with: {response}. {acao}")
     except ConnectionResetError:
         print(f"Connection reset by peer while receiving response for {option}")
     except socket.timeout:
         print('Timeout occurred, the message will be removed...')
-        remove_message = f'{client_name},{hex_dig},remove'
-        client_socket.send(remove_message.encode())
+        if binary:
+            client_socket.sendall(encode_post(0, client_name, hash_object.digest(), 'remove'))
+        else:
+            remove_message = f'{client_name},{hex_dig},remove'
+            client_socket.send(remove_message.encode())
 
     return client_socket, responseAction
 
+def send_batch(posts, verbose=True):
+    """
+    Send posts [(client_name, key, option)] to the PBB in a single BATCH
+    frame. They are applied in order, and the PBB's response to each one
+    is returned in the same order; posts that have to wait for their
+    counterpart are answered on the same connection once decided.
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    host = socket.gethostname()
+    port = 12345
+    client_socket.connect((host, port))
+
+    frames = [(client_name, hashlib.sha256(key.encode('utf-8')).digest(), option) for client_name, key, option in posts]
+    client_socket.sendall(encode_batch(0, frames))
+
+    decoder = FrameDecoder()
+    responses = []
+    try:
+        while len(responses) < len(posts):
+            frame_type, _, _, body = recv_frame(client_socket, decoder)
+            if frame_type == BATCH_RESULT:
+                responses.extend(response for _, response in decode_batch_result(body))
+        waiting = sum(response is None for response in responses)
+        while waiting:
+            _, arg, request_id, body = recv_frame(client_socket, decoder)
+            _, responses[request_id] = decode_result(arg, body)
+            waiting -= 1
+    finally:
+        client_socket.close()
+
+    if verbose:
+        for (client_name, _, option), response in zip(posts, responses):
+            print(f"\n The PBB responded to {client_name}'s {option} with: {response}. {response_action(client_name, response)}")
+    return responses
+
 if __name__ == "__main__":
     start_client("ClientName", "key123", "Message1")
\ No newline at end of file
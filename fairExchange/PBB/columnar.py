@@ -0,0 +1,246 @@
+"""
+Columnar export of the PBB board log.
+
+export() reads a board log (a sent_messages.txt text log, a write-ahead
+log, or a snapshot.BoardStore directory) once and writes it as a
+directory of flat column files, one value per post in posting order:
+
+    ts.f8       f64 posting time (NaN when the log has none)
+    token.u4    u32 token id, ids given in order of first post
+    party.u4    u32 party id
+    message.u2  u16 message id
+    rank.u1     u8 position of the post on its token (0 and 1 decide,
+                2.. are conflicts, REPEAT for a post the board already had)
+
+plus the dictionaries behind the ids (tokens.key: the 32-byte token keys
+in id order, parties.txt, messages.txt) and columns.json describing it
+all. The files are raw native-endian arrays, so open_columns() maps them
+without parsing or copying: as numpy arrays when numpy is installed,
+else as typed memoryviews. Because token ids follow first posts, the
+rank 0 posts are in token id order, which is what lets analytics.py
+join a token's posts without sorting.
+
+usage: python -m fairExchange.PBB.columnar export <log, wal or board dir> <columns dir>
+"""
+import array
+import json
+import math
+import mmap
+import os
+import sys
+import time
+
+from fairExchange.PBB import wal
+from fairExchange.PBB.board_index import token_key
+from fairExchange.PBB.protocol import OPCODES
+from fairExchange.PBB.snapshot import (Snapshot, list_files, segment_path, snapshot_path,
+                                       SEGMENT_PREFIX, SEGMENT_SUFFIX, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+
+# column name -> array typecode
+COLUMNS = {'ts': 'd', 'token': 'I', 'party': 'I', 'message': 'H', 'rank': 'B'}
+SUFFIXES = {'d': 'f8', 'I': 'u4', 'H': 'u2', 'B': 'u1'}
+META = 'columns.json'
+REPEAT = 0xFF
+MAX_RANK = REPEAT - 1
+FLUSH_POSTS = 1 << 16
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def column_file(name):
+    return f"{name}.{SUFFIXES[COLUMNS[name]]}"
+
+
+def read_text_log(file_path):
+    """Yield (timestamp, client_name, client_hash, message) of a sent_messages.txt log."""
+    with open(file_path, 'r') as file:
+        for line in file:
+            parts = line.strip().split(',')
+            if len(parts) == 3:
+                yield (math.nan,) + tuple(parts)
+
+
+def read_board_dir(data_dir):
+    """Yield the posts of a BoardStore directory: the snapshot's, then the segments after it."""
+    snapshots = list_files(data_dir, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+    covered = 0
+    if snapshots:
+        snapshot = Snapshot(snapshot_path(data_dir, snapshots[-1]))
+        covered = snapshot.covered
+        try:
+            for key, entries in snapshot.groups():
+                # a snapshot keeps neither times nor the order across tokens
+                for client_name, message in entries:
+                    yield math.nan, client_name, key.hex(), message
+        finally:
+            snapshot.close()
+    for seq in list_files(data_dir, SEGMENT_PREFIX, SEGMENT_SUFFIX):
+        if seq >= covered:
+            for _, record in wal.read_records(segment_path(data_dir, seq)):
+                yield record
+
+
+def read_log(source):
+    if os.path.isdir(source):
+        return read_board_dir(source)
+    with open(source, 'rb') as file:
+        is_wal = wal.is_log(file.read(len(wal.MAGIC)))
+    if is_wal:
+        return (record for _, record in wal.read_records(source))
+    return read_text_log(source)
+
+
+class Interner:
+    """Dense ids for strings, in order of first use."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.ids)
+        return i
+
+    def values(self):
+        return list(self.ids)
+
+
+def export(source, out_dir):
+    """Write the columns of the log at source to out_dir. Returns the number of posts."""
+    os.makedirs(out_dir, exist_ok=True)
+    files = {name: open(os.path.join(out_dir, column_file(name)), 'wb') for name in COLUMNS}
+    buffers = {name: array.array(typecode) for name, typecode in COLUMNS.items()}
+    parties, messages = Interner(), Interner()
+    tokens = {}
+    keys = open(os.path.join(out_dir, 'tokens.key'), 'wb')
+    # per token id: posts so far, and the (party, message) of its first two;
+    # tokens past two posts keep the rest in later, which conflicts keep small
+    counts = bytearray()
+    firsts = array.array('Q')
+    seconds = array.array('Q')
+    later = {}
+    posts = 0
+    try:
+        for timestamp, client_name, client_hash, message in read_log(source):
+            key = token_key(client_hash)
+            token = tokens.get(key)
+            if token is None:
+                token = tokens[key] = len(counts)
+                keys.write(key)
+                counts.append(0)
+                firsts.append(0)
+                seconds.append(0)
+            party = parties(client_name)
+            code = messages(message)
+            post = party << 16 | code
+            count = counts[token]
+            # the board keeps a party's message on a token only once
+            if count and (post == firsts[token] or (count > 1 and post == seconds[token])
+                          or post in later.get(token, ())):
+                rank = REPEAT
+            else:
+                rank = min(count, MAX_RANK)
+                if count == 0:
+                    firsts[token] = post
+                elif count == 1:
+                    seconds[token] = post
+                else:
+                    later.setdefault(token, set()).add(post)
+                counts[token] = min(count + 1, MAX_RANK)
+
+            buffers['ts'].append(timestamp)
+            buffers['token'].append(token)
+            buffers['party'].append(party)
+            buffers['message'].append(code)
+            buffers['rank'].append(rank)
+            posts += 1
+            if posts % FLUSH_POSTS == 0:
+                for name, buffer in buffers.items():
+                    buffer.tofile(files[name])
+                    del buffer[:]
+        for name, buffer in buffers.items():
+            buffer.tofile(files[name])
+    finally:
+        keys.close()
+        for file in files.values():
+            file.close()
+
+    with open(os.path.join(out_dir, 'parties.txt'), 'w') as file:
+        file.writelines(f"{name}\n" for name in parties.values())
+    with open(os.path.join(out_dir, 'messages.txt'), 'w') as file:
+        file.writelines(f"{message}\n" for message in messages.values())
+    meta = {
+        'source': os.path.abspath(source),
+        'posts': posts,
+        'tokens': len(counts),
+        'byteorder': sys.byteorder,
+        'columns': {name: column_file(name) for name in COLUMNS},
+    }
+    with open(os.path.join(out_dir, META), 'w') as file:
+        json.dump(meta, file, indent=1)
+    return posts
+
+
+class Columns:
+    """A columns directory written by export(), memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as file:
+            self.meta = json.load(file)
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path} was exported on a {self.meta['byteorder']}-endian host")
+        self.posts = self.meta['posts']
+        self.tokens = self.meta['tokens']
+        self.parties = self.read_lines('parties.txt')
+        self.messages = self.read_lines('messages.txt')
+        self.maps = []
+
+    def read_lines(self, name):
+        with open(os.path.join(self.path, name)) as file:
+            return [line.rstrip('\n') for line in file]
+
+    def signals(self):
+        """Opcode (protocol.SYNC, CANCEL, REMOVE, or 0) of every message id."""
+        return [OPCODES.get(message.partition('_')[0], 0) for message in self.messages]
+
+    def column(self, name):
+        """The column as a read-only numpy array, or a typed memoryview without numpy."""
+        typecode = COLUMNS[name]
+        with open(os.path.join(self.path, self.meta['columns'][name]), 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                data = b''
+            else:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps.append(data)
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype=typecode)
+        return memoryview(data).cast(typecode)
+
+    def close(self):
+        # the columns handed out must be dropped first, or the maps stay open
+        for data in self.maps:
+            try:
+                data.close()
+            except BufferError:
+                pass
+        self.maps = []
+
+
+def open_columns(path):
+    return Columns(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == 'export':
+        start = time.perf_counter()
+        exported = export(sys.argv[2], sys.argv[3])
+        elapsed = time.perf_counter() - start
+        print(f"{exported} posts exported to {sys.argv[3]} in {elapsed:.1f} s "
+              f"({exported / max(elapsed, 1e-9):,.0f} posts/s)")
+    else:
+        print(__doc__)
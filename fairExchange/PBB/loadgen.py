@@ -0,0 +1,196 @@
+"""
+Load generator for the PBB. Starts a local main_pbb server (or targets a
+running one with --port) and drives N Alice/Bob pairs through a mix of
+orderings, checking every response:
+
+    sync         Sync_A and Sync_B concurrently              -> exchange
+    cancel       one party Sync, the other Cancel            -> abort
+    late-cancel  a party Syncs, Cancels after --late-ms, and
+                 only then the counterpart Syncs             -> abort
+                 (PBBService.syncA_cancelA_SyncB)
+
+It reports throughput and p50/p99/p999 post-to-decision latency, overall
+and per ordering, and appends the run as one JSON line to --output so
+runs can be compared over time.
+
+usage: python -m fairExchange.PBB.loadgen --pairs 5000 --concurrency 200 --mix sync=0.8,cancel=0.1,late-cancel=0.1
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import time
+
+from fairExchange.PBB.async_pbb import start_async_server
+from fairExchange.PBB.bench_pbb import free_port, percentile, post
+from fairExchange.PBB.main_pbb import start_server
+
+ORDERINGS = ('sync', 'cancel', 'late-cancel')
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        ordering, _, weight = part.partition('=')
+        if ordering not in ORDERINGS:
+            raise argparse.ArgumentTypeError(f"unknown ordering {ordering}, expected one of {', '.join(ORDERINGS)}")
+        mix[ordering] = float(weight or 1)
+    return mix
+
+
+class LoadGenerator:
+
+    def __init__(self, host, port, late_ms=20, timeout=10):
+        self.host = host
+        self.port = port
+        self.late = late_ms / 1000
+        self.timeout = timeout
+        # ordering -> post-to-decision latencies in seconds
+        self.latencies = {ordering: [] for ordering in ORDERINGS}
+        self.failures = {ordering: 0 for ordering in ORDERINGS}
+        self.wrong = {ordering: 0 for ordering in ORDERINGS}
+
+    async def timed_post(self, ordering, client_name, hex_dig, option):
+        start = time.perf_counter()
+        response = await post(self.host, self.port, client_name, hex_dig, option, self.timeout)
+        if response is not None:
+            self.latencies[ordering].append(time.perf_counter() - start)
+        return response
+
+    async def run_pair(self, i, ordering):
+        hex_dig = hashlib.sha256(f'loadgen-{os.getpid()}-{i}'.encode()).hexdigest()
+        alice, bob = f"Alice{i}", f"Bob{i}"
+        sides = [(alice, 'A'), (bob, 'B')]
+        random.shuffle(sides)
+        (first, first_side), (second, second_side) = sides
+
+        if ordering == 'sync':
+            responses = await asyncio.gather(self.timed_post(ordering, first, hex_dig, f"Sync_{first_side}"),
+                                             self.timed_post(ordering, second, hex_dig, f"Sync_{second_side}"))
+        elif ordering == 'cancel':
+            responses = await asyncio.gather(self.timed_post(ordering, first, hex_dig, f"Sync_{first_side}"),
+                                             self.timed_post(ordering, second, hex_dig, f"Cancel_{second_side}"))
+        else:
+            synced = asyncio.ensure_future(self.timed_post(ordering, first, hex_dig, f"Sync_{first_side}"))
+            await asyncio.sleep(self.late)
+            cancelled = await self.timed_post(ordering, first, hex_dig, f"Cancel_{first_side}")
+            responses = [await synced, cancelled,
+                         await self.timed_post(ordering, second, hex_dig, f"Sync_{second_side}")]
+
+        if None in responses:
+            self.failures[ordering] += 1
+        elif any(("cancel" in response.lower()) != (ordering != 'sync') for response in responses):
+            self.wrong[ordering] += 1
+
+    async def run(self, pairs, concurrency, mix):
+        orderings = random.choices(list(mix), weights=list(mix.values()), k=pairs)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(i, ordering):
+            async with semaphore:
+                await self.run_pair(i, ordering)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(i, ordering) for i, ordering in enumerate(orderings)))
+        return time.perf_counter() - start
+
+    def summary(self, elapsed):
+        def stats(latencies):
+            return {'posts': len(latencies),
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                    'p999_ms': percentile(latencies, 99.9) * 1000}
+
+        every = [latency for latencies in self.latencies.values() for latency in latencies]
+        result = stats(every)
+        result['posts_per_sec'] = len(every) / elapsed
+        result['elapsed_s'] = elapsed
+        result['failed_pairs'] = sum(self.failures.values())
+        result['wrong_outcomes'] = sum(self.wrong.values())
+        result['orderings'] = {ordering: dict(stats(latencies), failed_pairs=self.failures[ordering],
+                                              wrong_outcomes=self.wrong[ordering])
+                               for ordering, latencies in self.latencies.items() if latencies or self.failures[ordering]}
+        return result
+
+
+def wait_until_ready(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            # an empty post is rejected by the server, the connect is all we need
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PBB load generator")
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100, help="pairs in flight")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("sync=0.8,cancel=0.1,late-cancel=0.1"),
+                        help="weights of the orderings, e.g. sync=0.8,cancel=0.1,late-cancel=0.1")
+    parser.add_argument("--late-ms", type=float, default=20, help="delay of the late cancel")
+    parser.add_argument("--server", default="blocking", choices=["blocking", "async"],
+                        help="which local server to start")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="use the PBB already running on this port")
+    parser.add_argument("--output", default="loadgen-results.jsonl", help="JSON lines file the run is appended to")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = None
+    port = args.port
+    with tempfile.TemporaryDirectory() as tmp:
+        if port is None:
+            port = free_port(args.host)
+            target = start_server if args.server == "blocking" else start_async_server
+            server = multiprocessing.get_context('fork').Process(
+                target=target, args=(args.host, port, os.path.join(tmp, "loadgen.txt"), False), daemon=True)
+            server.start()
+        try:
+            wait_until_ready(args.host, port)
+            generator = LoadGenerator(args.host, port, args.late_ms)
+            elapsed = asyncio.run(generator.run(args.pairs, args.concurrency, args.mix))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+
+    result = generator.summary(elapsed)
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'revision': git_revision(),
+           'server': args.server if args.port is None else f"{args.host}:{args.port}",
+           'pairs': args.pairs, 'concurrency': args.concurrency, 'mix': args.mix, 'late_ms': args.late_ms,
+           'result': result}
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(run) + "\n")
+
+    print(f"{args.pairs} pairs, {args.concurrency} in flight, server {run['server']}")
+    print(f"{result['posts_per_sec']:10.0f} posts/sec   p50 {result['p50_ms']:8.2f} ms   "
+          f"p99 {result['p99_ms']:8.2f} ms   p999 {result['p999_ms']:8.2f} ms   "
+          f"{result['failed_pairs']} failed pairs   {result['wrong_outcomes']} wrong outcomes")
+    for ordering, stats in result['orderings'].items():
+        print(f"{ordering:>14}: {stats['posts']:8d} posts   p50 {stats['p50_ms']:8.2f} ms   "
+              f"p99 {stats['p99_ms']:8.2f} ms   p999 {stats['p999_ms']:8.2f} ms")
+    print(f"appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
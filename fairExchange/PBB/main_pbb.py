@@ -1,79 +1,533 @@
+import collections
+import gc
+import itertools
 import socket
 import os
+import threading
+import time
+from concurrent.futures import Future
+
+from fairExchange.PBB.board_index import BoardIndex
+from fairExchange.PBB.protocol import (FrameDecoder, is_binary, recv_frame, decode_post, encode_result,
+                                       BATCH, decode_batch, encode_batch_result, retry_result, failed_result,
+                                       conflict_result)
+from fairExchange.PBB import metrics
+from fairExchange.PBB.snapshot import BoardStore
+from fairExchange.PBB.timing_wheel import TimingWheel
 
 def load_messages(file_path):
+    messages = BoardIndex()
     if not os.path.exists(file_path):
-        return {}
+        return messages
     with open(file_path, 'r') as file:
-        lines = file.readlines()
-    messages = {}
-    for line in lines:
-        parts = line.strip().split(',')
-        if len(parts) != 3:
-            print(f"Invalid line format: {line.strip()}")
-            continue
-        client_name, client_hash, message = parts
-        if client_name not in messages:
-            messages[client_name] = {}
-        if client_hash not in messages[client_name]:
-            messages[client_name][client_hash] = set()
-        messages[client_name][client_hash].add(message)
+        for line in file:
+            parts = line.strip().split(',')
+            if len(parts) != 3:
+                print(f"Invalid line format: {line.strip()}")
+                continue
+            client_name, client_hash, message = parts
+            messages.add(client_name, client_hash, message)
+    return messages
+
+def load_wal(wal):
+    if isinstance(wal, BoardStore):
+        return wal.load_index()
+    messages = BoardIndex()
+    for _, client_name, client_hash, message in wal.replay():
+        messages.add(client_name, client_hash, message)
     return messages
 
 def save_message(file_path, client_name, client_hash, message):
     with open(file_path, 'a') as file:
         file.write(f"{client_name},{client_hash},{message}\n")
 
-def start_server():
-    host = socket.gethostname()
-    port = 12345
+
+class Board:
+    """
+    Post/match state of the PBB, shared by the blocking and asyncio
+    servers. It knows nothing about sockets: a post comes with an opaque
+    conn and the board returns the (conn, result) pairs to notify.
+
+    Posts are logged as text lines, or to a WAL or BoardStore when one is
+    given; post() then also returns the group commit Future, and results
+    must wait for it. With a post_timeout (seconds), expire() cancels a
+    post left waiting that long. Decisions get offsets in a decision log
+    and are pushed to the watchers; a post with conn None is detached and
+    only watchers hear of it. An admission may refuse a post with
+    retry_result(), without logging or parking it.
+    """
+
+    def __init__(self, sent_messages_file='sent_messages.txt', wal=None, post_timeout=None,
+                 decision_retention=100000, admission=None):
+        self.sent_messages_file = sent_messages_file
+        self.wal = wal
+        if wal is None:
+            self.sent_messages = load_messages(sent_messages_file)
+        else:
+            self.sent_messages = load_wal(wal)
+        self.client_messages = {}
+        self.client_sockets = {}
+        self.post_timeout = post_timeout
+        self.client_timers = {}
+        # token -> perf_counter() of its pending post, for the match latency
+        self.client_since = {}
+        # token -> WAL commit of its pending post
+        self.client_commits = {}
+        # (commit, post, next offset when it was logged) of the posts on the
+        # board whose commit has not succeeded yet, in posting order
+        self.unconfirmed = collections.deque()
+        self.deadlines = TimingWheel(time.monotonic()) if post_timeout else None
+        # text log lines of the batch being applied, written in one go
+        self.unsaved = None
+        self.next_offset = 0
+        self.decision_retention = decision_retention
+        # (offset, client_hash, result) of the most recent decisions
+        self.decisions = collections.deque()
+        # client_hash -> (offset, result) of the decisions still in self.decisions
+        self.decided = {}
+        # client_hash -> watchers waiting for its decision
+        self.watchers = {}
+        # watchers of every decision
+        self.feed_watchers = []
+        self.admission = admission
+
+    def log(self, client_name, client_hash, message):
+        # logged first: a post the log refuses must not be on the board either,
+        # and one whose commit fails later is taken off by unlog_failed()
+        if self.wal is None:
+            if self.unsaved is None:
+                start = time.perf_counter()
+                save_message(self.sent_messages_file, client_name, client_hash, message)
+                metrics.LOG_WRITE.observe(time.perf_counter() - start)
+            else:
+                self.unsaved.append(f"{client_name},{client_hash},{message}\n")
+            self.sent_messages.add(client_name, client_hash, message)
+            return None
+        commit = self.wal.append(client_name, client_hash, message)
+        if self.sent_messages.add(client_name, client_hash, message) and commit is not None:
+            self.unconfirmed.append((commit, (client_name, client_hash, message), self.next_offset))
+        while self.unconfirmed and self.unconfirmed[0][0].done() and self.unconfirmed[0][0].exception() is None:
+            self.unconfirmed.popleft()
+        if isinstance(self.wal, BoardStore):
+            self.sent_messages.touch(client_hash, self.wal.seq)
+        return commit
+
+    def unlog_failed(self):
+        """
+        Take the posts whose commit failed back off the board, so nobody is
+        matched against a post the log does not hold, and undo the
+        decisions made on them. Returns the outcomes telling their parked
+        parties.
+        """
+        outcomes = []
+        unconfirmed = collections.deque()
+        for commit, post, offset in self.unconfirmed:
+            if not commit.done():
+                unconfirmed.append((commit, post, offset))
+                continue
+            error = commit.exception()
+            if error is None:
+                continue
+            client_name, client_hash, message = post
+            self.sent_messages.remove(client_name, client_hash, message)
+            if self.client_messages.get(client_hash) == post:
+                del self.client_messages[client_hash]
+                conn = self.client_sockets.pop(client_hash)
+                del self.client_since[client_hash]
+                self.client_commits.pop(client_hash, None)
+                if self.deadlines is not None:
+                    self.deadlines.cancel(self.client_timers.pop(client_hash))
+                if conn is not None:
+                    outcomes.append((conn, failed_result(error)))
+            if self.decided.get(client_hash, (-1,))[0] >= offset:
+                del self.decided[client_hash]
+                self.decisions = collections.deque(decision for decision in self.decisions
+                                                   if decision[1] != client_hash or decision[0] < offset)
+        self.unconfirmed = unconfirmed
+        metrics.PENDING.value = len(self.client_messages)
+        return outcomes
+
+    def admit(self, client_name, client_hash, message):
+        """None if the post may go on the board, else the result that refuses it."""
+        if self.admission is None:
+            return None
+        # once a token has two posts, any further post is answered at once
+        parks = client_hash not in self.client_messages and self.sent_messages.count(client_hash) < 2
+        # a withdrawal, or the counterpart of a parked post, is never rate limited
+        rated = message != 'remove' and client_hash not in self.client_messages
+        refusal = self.admission.admit(client_name, parks, len(self.client_messages), rated=rated)
+        if refusal is None:
+            return None
+        reason, seconds = refusal
+        metrics.REJECTED.labels(reason).value += 1
+        return retry_result(seconds)
+
+    def post(self, client_name, client_hash, message, conn, admitted=False):
+        """Put a post on the board; admitted skips admission control, when the caller already did it."""
+        if not admitted:
+            refusal = self.admit(client_name, client_hash, message)
+            if refusal is not None:
+                return ([(conn, refusal)] if conn is not None else []), None
+        if isinstance(self.wal, BoardStore):
+            self.wal.maintain(self.sent_messages)
+        metrics.count_post(message)
+        posted = self.sent_messages.count(client_hash)
+        commit = self.log(client_name, client_hash, message)
+
+        # Check if there are more than 2 messages with the same hash, or
+        # the post repeats one of a token that is already decided
+        count = self.sent_messages.count(client_hash)
+        if count > 2 or (count == posted >= 2):
+            result = conflict_result(self.sent_messages.messages_with_hash(client_hash))
+            metrics.CONFLICTS.value += 1
+            return ([(conn, result)] if conn is not None else []), commit
+
+        if client_hash in self.client_messages:
+            result = process_messages([self.client_messages[client_hash], (client_name, client_hash, message)])
+            waiting = self.client_sockets[client_hash]
+            del self.client_messages[client_hash]
+            del self.client_sockets[client_hash]
+            # the result only stands once both posts are logged
+            commit = joined(self.client_commits.pop(client_hash, None), commit)
+            if self.deadlines is not None:
+                self.deadlines.cancel(self.client_timers.pop(client_hash))
+            metrics.MATCH_LATENCY.observe(time.perf_counter() - self.client_since.pop(client_hash))
+            metrics.MATCHES.value += 1
+            metrics.PENDING.value = len(self.client_messages)
+            outcomes = [(party, result) for party in (waiting, conn) if party is not None]
+            return outcomes + self.decide(client_hash, result), commit
+
+        self.client_messages[client_hash] = (client_name, client_hash, message)
+        self.client_sockets[client_hash] = conn
+        self.client_since[client_hash] = time.perf_counter()
+        if commit is not None:
+            self.client_commits[client_hash] = commit
+        metrics.PENDING.value = len(self.client_messages)
+        if self.deadlines is not None:
+            self.client_timers[client_hash] = self.deadlines.schedule(time.monotonic() + self.post_timeout, client_hash)
+        return [], commit
+
+    def post_batch(self, posts):
+        """
+        Apply posts [(client_name, client_hash, message, conn)] in order,
+        with no other post in between; a post may match an earlier one of
+        the same batch. Returns the outcomes of all of them and the commit
+        of the last one, like post().
+        """
+        outcomes = []
+        commit = None
+        if self.wal is None:
+            self.unsaved = []
+        try:
+            for client_name, client_hash, message, conn in posts:
+                post_outcomes, commit = self.post(client_name, client_hash, message, conn)
+                outcomes.extend(post_outcomes)
+        finally:
+            if self.unsaved:
+                start = time.perf_counter()
+                with open(self.sent_messages_file, 'a') as file:
+                    file.writelines(self.unsaved)
+                metrics.LOG_WRITE.observe(time.perf_counter() - start)
+            self.unsaved = None
+        return outcomes, commit
+
+    def expire(self, now=None):
+        """
+        Resolve the posts whose deadline has passed. The waiting party is
+        logged as having sent Cancel (Sync_A expires as Cancel_A, a waiting
+        Cancel_A as remove), so a late counterpart finds three messages on
+        the token and is told to cancel too. Returns (outcomes, commit) like
+        post(); commit is the last WAL append, which is durable only once
+        the earlier ones are.
+        """
+        if self.deadlines is None:
+            return [], None
+        outcomes = []
+        commit = None
+        for client_hash in self.deadlines.advance(time.monotonic() if now is None else now):
+            del self.client_timers[client_hash]
+            client_name, _, message = self.client_messages.pop(client_hash)
+            waiting = self.client_sockets.pop(client_hash)
+            del self.client_since[client_hash]
+            posted = self.client_commits.pop(client_hash, None)
+            metrics.EXPIRED.value += 1
+            side = message.partition('_')[2]
+            cancel = f"Cancel_{side}" if side else "Cancel"
+            if cancel == message:
+                # a waiting Cancel is withdrawn, so the board gets a second post
+                cancel = "remove"
+            commit = joined(posted, self.log(client_name, client_hash, cancel)) or commit
+            result = process_messages([(client_name, client_hash, message), (client_name, client_hash, cancel)])
+            if waiting is not None:
+                outcomes.append((waiting, result))
+            outcomes.extend(self.decide(client_hash, result))
+        metrics.PENDING.value = len(self.client_messages)
+        return outcomes, commit
+
+    def pending(self):
+        return len(self.client_messages)
+
+    def decide(self, client_hash, result):
+        """Log a decision and return the (watcher, event) pairs to push it to."""
+        offset = self.next_offset
+        self.next_offset += 1
+        self.decisions.append((offset, client_hash, result))
+        self.decided[client_hash] = (offset, result)
+        if len(self.decisions) > self.decision_retention:
+            old_offset, old_hash, _ = self.decisions.popleft()
+            if self.decided.get(old_hash, (None,))[0] == old_offset:
+                del self.decided[old_hash]
+        event = (offset, client_hash, result)
+        return [(watcher, event) for watcher in self.watchers.pop(client_hash, ())] + \
+               [(watcher, event) for watcher in self.feed_watchers]
+
+    def decision(self, client_hash):
+        """(offset, result) of the decision on a token, offset None once it left the log; None if undecided."""
+        decided = self.decided.get(client_hash)
+        if decided is not None:
+            return decided
+        if client_hash in self.client_messages:
+            return None
+        # the first two posts of a token always decide it
+        posted = self.sent_messages.posted(client_hash)
+        if len(posted) < 2:
+            return None
+        return None, process_messages([(client_name, client_hash, message) for client_name, message in posted[:2]])
+
+    def watch(self, client_hash, watcher):
+        """Push the decision on a token to watcher, now if it is already decided."""
+        decision = self.decision(client_hash)
+        if decision is not None:
+            return [(watcher, (decision[0], client_hash, decision[1]))]
+        self.watchers.setdefault(client_hash, []).append(watcher)
+        return []
+
+    def watch_feed(self, watcher, offset=0):
+        """Push every decision from offset on to watcher, starting with the retained ones."""
+        outcomes = []
+        if self.decisions:
+            first = self.decisions[0][0]
+            for event in itertools.islice(self.decisions, max(0, offset - first), None):
+                outcomes.append((watcher, event))
+        self.feed_watchers.append(watcher)
+        return outcomes
+
+    def unwatch(self, watcher, client_hash=None):
+        if client_hash is None:
+            if watcher in self.feed_watchers:
+                self.feed_watchers.remove(watcher)
+            return
+        watchers = self.watchers.get(client_hash)
+        if watchers and watcher in watchers:
+            watchers.remove(watcher)
+            if not watchers:
+                del self.watchers[client_hash]
+
+
+class SocketReply:
+    """A legacy post: the result is written as text and the socket closed."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, result):
+        self.sock.send(result.encode())
+        self.sock.close()
+
+
+class BinarySocketReply:
+    """A post that came as a binary frame: answered with a RESULT frame."""
+
+    def __init__(self, sock, request_id):
+        self.sock = sock
+        self.request_id = request_id
+
+    def send(self, result):
+        self.sock.sendall(encode_result(self.request_id, result))
+        self.sock.close()
+
+
+class BatchReply:
+    """
+    The posts of a BATCH frame. Posts decided while the batch is applied
+    are collected and sent in its BATCH_RESULT once send() is called;
+    the others are answered later with a RESULT frame of their own, and
+    close is called when the last one is.
+    """
+
+    def __init__(self, request_id, size, write, close=None):
+        self.request_id = request_id
+        self.results = [None] * size
+        self.undecided = size
+        self.sent = False
+        self.write = write
+        self.close = close
+
+    def item(self, index):
+        return BatchItemReply(self, index)
+
+    def decide(self, index, result):
+        self.undecided -= 1
+        if self.sent:
+            self.write(encode_result(self.request_id + index, result))
+            self.finish()
+        else:
+            self.results[index] = result
+
+    def send(self, result=None):
+        self.sent = True
+        self.write(encode_batch_result(self.request_id, self.results))
+        self.finish()
+
+    def finish(self):
+        if self.undecided == 0 and self.close is not None:
+            self.close()
+
+
+class BatchItemReply:
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def send(self, result):
+        self.batch.decide(self.index, result)
+
+
+def read_post(client_socket):
+    """
+    Read the posts of a connection in the legacy text or the binary format.
+    Returns the list of (client_name, client_hash, message, reply) and, for
+    a BATCH, the BatchReply that answers once the batch is applied.
+    """
+    data = client_socket.recv(1024)
+    if not data:
+        # connected and closed without a post, e.g. a readiness probe
+        client_socket.close()
+        return [], None
+    if is_binary(data):
+        decoder = FrameDecoder(1024)
+        decoder.ready.extend(decoder.feed(data))
+        frame_type, arg, request_id, body = recv_frame(client_socket, decoder)
+        if frame_type == BATCH:
+            posts = decode_batch(body)
+            batch = BatchReply(request_id, len(posts), client_socket.sendall, client_socket.close)
+            return [post + (batch.item(i),) for i, post in enumerate(posts)], batch
+        client_name, client_hash, message = decode_post(frame_type, arg, body)
+        return [(client_name, client_hash, message, BinarySocketReply(client_socket, request_id))], None
+    client_name, client_hash, message = data.decode().split(',')
+    return [(client_name, client_hash, message, SocketReply(client_socket))], None
+
+
+def failed_outcomes(outcomes, error):
+    """
+    What to send instead of outcomes whose commit failed: every party
+    waiting on a result is told so, and watchers get nothing, since the
+    decision is not durable.
+    """
+    failure = failed_result(error)
+    return [(replyIt, failure if isinstance(result, str) else result)
+            for replyIt, result in outcomes if not isinstance(result, tuple)]
+
+
+def joined(first, second):
+    """A commit that is done once both are, and fails if either does."""
+    if first is None or first is second or (first.done() and first.exception() is None):
+        return second
+    if second is None:
+        return first
+    both = Future()
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            if first.done() and second.done() and not both.done():
+                error = first.exception() or second.exception()
+                if error is None:
+                    both.set_result(second.result())
+                else:
+                    both.set_exception(error)
+
+    first.add_done_callback(done)
+    second.add_done_callback(done)
+    return both
+
+
+def deliver(outcomes, commit, board=None):
+    if commit is not None and commit.exception() is not None:
+        print(f"Could not log post: {commit.exception()}")
+        outcomes = failed_outcomes(outcomes, commit.exception())
+        if board is not None:
+            outcomes += board.unlog_failed()
+    for replyIt, result in outcomes:
+        try:
+            replyIt.send(result)
+        except OSError as e:
+            # the party may have given up on an expired post already
+            metrics.SEND_ERRORS.value += 1
+            print(f"Could not send result: {e}")
+
+
+def freeze_startup():
+    """
+    Called once by a server process after its board is loaded. The board
+    is not tracked by the collector (see board_index), but the ~14,000
+    objects alive at startup are, and each full collection walks them
+    (3.8 ms with a 1M-post board loaded, 0.0 ms once frozen). Not for
+    Boards built in passing: every freeze pins all live objects for good.
+    """
+    gc.freeze()
+
+
+# connections the kernel queues while the board is busy with a post
+BACKLOG = 128
+
+
+def start_server(host=None, port=12345, sent_messages_file='sent_messages.txt', verbose=True, wal=None,
+                 post_timeout=None, metrics_port=None, backlog=BACKLOG, admission=None):
+    if metrics_port is not None:
+        metrics.start_metrics_server(metrics_port)
+    if host is None:
+        host = socket.gethostname()
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((host, port))
-    server_socket.listen(5)
+    server_socket.listen(backlog)
 
-    client_messages = {}
-    client_sockets = {}
-    sent_messages_file = 'sent_messages.txt'
-    sent_messages = load_messages(sent_messages_file)
+    # every parked post holds its socket, so admission.max_pending also
+    # bounds the descriptors the server keeps open
+    board = Board(sent_messages_file, wal, post_timeout, admission=admission)
+    freeze_startup()
+    if post_timeout:
+        # wake up now and then to expire abandoned posts
+        server_socket.settimeout(board.deadlines.tick)
 
     while True:
-        client_socket, addr = server_socket.accept()
-        print("Got a connection from %s" % str(addr))
         try:
-            data = client_socket.recv(1024)
-            client_name, client_hash, message = data.decode().split(',')
-
-            print(f"The PBB Received the {message} message from {client_name} with token {client_hash}")
-
-            if client_name not in sent_messages:
-                sent_messages[client_name] = {}
-            if client_hash not in sent_messages[client_name]:
-                sent_messages[client_name][client_hash] = set()
-            sent_messages[client_name][client_hash].add(message)
-            save_message(sent_messages_file, client_name, client_hash, message)
-
-            # Check if there are more than 2 messages with the same hash
-            all_messages_with_hash = [msg for msgs in sent_messages.values() for hash_msgs in msgs.values() for msg in hash_msgs if client_hash in msgs]
-            if len(all_messages_with_hash) > 2:
-                result = ', '.join(all_messages_with_hash)
-                client_socket.send(result.encode())
-                client_socket.close()
-                continue
+            client_socket, addr = server_socket.accept()
+        except socket.timeout:
+            deliver(*board.expire(), board)
+            continue
+        client_socket.settimeout(None)
+        if verbose:
+            print("Got a connection from %s" % str(addr))
+        try:
+            posts, batch = read_post(client_socket)
 
-            if client_hash in client_messages:
-                result = process_messages([client_messages[client_hash], (client_name, client_hash, message)])
-                for socketIt in [client_sockets[client_hash], client_socket]:
-                    socketIt.send(result.encode())
-                    socketIt.close()
-                del client_messages[client_hash]
-                del client_sockets[client_hash]
-            else:
-                client_messages[client_hash] = (client_name, client_hash, message)
-                client_sockets[client_hash] = client_socket
+            if verbose:
+                for client_name, client_hash, message, _ in posts:
+                    print(f"The PBB Received the {message} message from {client_name} with token {client_hash}")
+
+            outcomes, commit = board.post_batch(posts)
+            if batch is not None:
+                outcomes.append((batch, None))
+            deliver(outcomes, commit, board)
         except Exception as e:
+            metrics.CLIENT_ERRORS.value += 1
             print(f"Error handling client {addr}: {e}")
             client_socket.close()
+        if post_timeout:
+            deliver(*board.expire(), board)
 
     return server_socket
 
@@ -82,4 +536,4 @@ def process_messages(messages):
     return result
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    start_server()
@@ -0,0 +1,78 @@
+"""
+In-memory transport for the PBB board.
+
+main_pbb.Board knows nothing about sockets: a post comes with a reply
+object and the board answers with the (reply, result) pairs to notify.
+This module plugs it into plain Python objects instead of a network, so
+any ordering of posts can be replayed exactly, with no ports, threads or
+sleeps:
+
+    transport = MemoryTransport()
+    alice = transport.post("Alice", token, "Sync_A")
+    bob = transport.post("Bob", token, "Sync_B")
+    alice.results, bob.results    ->  [' Sync_A,  Sync_B'], [' Sync_A,  Sync_B']
+
+The board's log is kept in memory as well (MemoryLog).
+"""
+import time
+
+from fairExchange.PBB.main_pbb import Board
+
+
+class MemoryLog:
+    """A board log that only keeps the posts in a list."""
+
+    def __init__(self):
+        self.posts = []
+
+    def replay(self):
+        return iter(())
+
+    def append(self, client_name, client_hash, message, timestamp=None):
+        self.posts.append((client_name, client_hash, message))
+        return None
+
+
+class MemoryReply:
+    """A post sent over the in-memory transport; results collects what the board answered it."""
+    __slots__ = ('transport', 'client_name', 'client_hash', 'message', 'results')
+
+    def __init__(self, transport, client_name, client_hash, message):
+        self.transport = transport
+        self.client_name = client_name
+        self.client_hash = client_hash
+        self.message = message
+        self.results = []
+
+    def send(self, result):
+        self.results.append(result)
+        self.transport.replies.append((self, result))
+
+    def __repr__(self):
+        return f"{self.client_name}:{self.message}"
+
+
+class MemoryTransport:
+
+    def __init__(self, post_timeout=None):
+        self.log = MemoryLog()
+        self.board = Board(None, self.log, post_timeout)
+        # (reply, result) in the order the board answered
+        self.replies = []
+
+    def post(self, client_name, client_hash, message):
+        reply = MemoryReply(self, client_name, client_hash, message)
+        outcomes, _ = self.board.post(client_name, client_hash, message, reply)
+        self.deliver(outcomes)
+        return reply
+
+    def expire(self, now=None):
+        """Expire pending posts as if now (default: the deadline of every pending post) had come."""
+        if now is None:
+            now = time.monotonic() + (self.board.post_timeout or 0) + self.board.deadlines.tick
+        outcomes, _ = self.board.expire(now)
+        self.deliver(outcomes)
+
+    def deliver(self, outcomes):
+        for reply, result in outcomes:
+            reply.send(result)
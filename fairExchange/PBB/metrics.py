@@ -0,0 +1,194 @@
+"""
+Live metrics of the PBB in the Prometheus text format.
+
+Every metric is a module-level object that is updated in place. A metric
+only ever has one writer (the board's thread, or the WAL writer thread
+for the log metrics), so updating it is a plain integer or float add:
+no lock and no string formatting on the per-post path. Label values are
+fixed when a child is created and the text exposition is only rendered
+when the endpoint is scraped.
+
+    start_metrics_server(9100)    then    curl localhost:9100/metrics
+"""
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from 50 us to 10 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+class Counter:
+    __slots__ = ('labels', 'value')
+
+    def __init__(self, labels=''):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ('labels', 'bounds', 'counts', 'sum')
+
+    def __init__(self, labels='', bounds=LATENCY_BUCKETS):
+        self.labels = labels
+        self.bounds = bounds
+        # counts[i] observations <= bounds[i], the last one above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Family:
+    """A metric with one child per value of its label (or a single child without a label)."""
+
+    def __init__(self, kind, name, help_text, child_class, label=None):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.child_class = child_class
+        self.label = label
+        self.children = {}
+        REGISTRY.append(self)
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = self.child_class(f'{self.label}="{value}"' if self.label else '')
+        return child
+
+    def single(self):
+        return self.labels(None) if self.label is None else None
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for child in list(self.children.values()):
+            labels = child.labels
+            if isinstance(child, Histogram):
+                cumulative = 0
+                for bound, count in zip(child.bounds, child.counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+                cumulative += child.counts[-1]
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {cumulative}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{self.name}_sum{suffix} {child.sum}")
+                lines.append(f"{self.name}_count{suffix} {cumulative}")
+            else:
+                lines.append(f"{self.name}{{{labels}}} {child.value}" if labels else f"{self.name} {child.value}")
+
+
+def counter(name, help_text, label=None):
+    return Family('counter', name, help_text, Counter, label)
+
+
+def gauge(name, help_text, label=None):
+    return Family('gauge', name, help_text, Gauge, label)
+
+
+def histogram(name, help_text, label=None):
+    return Family('histogram', name, help_text, Histogram, label)
+
+
+POSTS = counter('pbb_posts_total', 'Posts received, by signal.', 'signal')
+CONFLICTS = counter('pbb_conflicts_total', 'Posts answered with the messages of an already used token.').single()
+MATCHES = counter('pbb_matches_total', 'Pending posts matched by their counterpart.').single()
+EXPIRED = counter('pbb_expired_total', 'Pending posts resolved as Cancel after their deadline.').single()
+PENDING = gauge('pbb_pending_posts', 'Posts waiting for their counterpart.').single()
+MATCH_LATENCY = histogram('pbb_match_latency_seconds', 'Time a post waited for its counterpart.').single()
+LOG_WRITE = histogram('pbb_log_write_seconds', 'Time to write posts to the log, per write.').single()
+LOG_FSYNC = histogram('pbb_log_fsync_seconds', 'Time of each fsync of the write-ahead log.').single()
+ERRORS = counter('pbb_errors_total', 'Errors, by kind.', 'kind')
+REJECTED = counter('pbb_rejected_total', 'Posts and connections refused by admission control, by reason.', 'reason')
+
+CLIENT_ERRORS = ERRORS.labels('client')
+SEND_ERRORS = ERRORS.labels('send')
+LOG_ERRORS = ERRORS.labels('log')
+
+REJECTED_CONNECTIONS = REJECTED.labels('connections')
+
+SIGNALS = ('Sync', 'Cancel', 'remove')
+# message -> its child of POSTS; only well-formed signals are cached, so
+# arbitrary messages cannot grow it
+post_counters = {}
+
+
+def count_post(message):
+    posts = post_counters.get(message)
+    if posts is None:
+        signal = message.partition('_')[0]
+        if signal not in SIGNALS:
+            POSTS.labels('other').value += 1
+            return
+        posts = post_counters[message] = POSTS.labels(signal)
+    posts.value += 1
+
+
+def open_sockets():
+    """Sockets open in this process, counted at scrape time (Linux only)."""
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}').startswith('socket:'):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def render():
+    lines = []
+    for family in REGISTRY:
+        family.render(lines)
+    sockets = open_sockets()
+    if sockets is not None:
+        lines.append("# HELP pbb_open_sockets Sockets open in the PBB process.")
+        lines.append("# TYPE pbb_open_sockets gauge")
+        lines.append(f"pbb_open_sockets {sockets}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=9100, host='127.0.0.1'):
+    """Serve /metrics from a daemon thread. Port 0 picks a free port, see server.server_port."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="pbb_metrics", daemon=True).start()
+    return server
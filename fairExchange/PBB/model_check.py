@@ -0,0 +1,194 @@
+"""
+Exhaustive interleaving checker for the PBB board.
+
+Every party runs one of the PROGRAMS below on a single token: the posts
+it sends, in its own order. For every combination of programs of two or
+three parties (up to --max-posts posts in all) the checker replays every
+interleaving of their posts on a fresh board over the in-memory
+transport (memory_transport.py), optionally with the board's expiry
+firing at any point, and checks on each run:
+
+    one-answer   no post is answered more than once
+    decision     the first two posts on the board decide the exchange:
+                 every post among them is answered with that decision
+    late-abort   every later post is told to abort (a conflict), and a
+                 post repeating one already on the board gets the
+                 decision's verdict
+    validity     an exchange only succeeds on the Syncs of two parties
+    termination  at the end only a lone first post may still wait
+
+"Told to abort" is what the attestable acts on: anything but
+STATUS_SUCCESS, see protocol.result_status.
+
+usage: python -m fairExchange.PBB.model_check [--parties 2] [--max-posts 6] [--no-expiry] [--workers N]
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+from fairExchange.PBB.main_pbb import process_messages
+from fairExchange.PBB.memory_transport import MemoryTransport
+from fairExchange.PBB.protocol import result_status, STATUS_SUCCESS
+
+PROGRAMS = {
+    'idle': (),
+    'sync': ('Sync',),
+    'cancel': ('Cancel',),
+    'late-cancel': ('Sync', 'Cancel'),
+    'withdraw': ('Sync', 'remove'),
+}
+SIDES = 'ABC'
+NAMES = ('Alice', 'Bob', 'Carol')
+TOKEN = 'ab' * 32
+# the board's expiry takes part in an interleaving as one more step
+EXPIRE = -1
+
+
+def signal_message(signal, side):
+    return signal if signal == 'remove' else f"{signal}_{side}"
+
+
+def interleavings(lengths):
+    """Every order of the steps of programs of these lengths that keeps each program's own order."""
+    remaining = list(lengths)
+    order = []
+    total = sum(lengths)
+
+    def extend():
+        if len(order) == total:
+            yield tuple(order)
+            return
+        for party, left in enumerate(remaining):
+            if left:
+                remaining[party] -= 1
+                order.append(party)
+                yield from extend()
+                order.pop()
+                remaining[party] += 1
+
+    return extend()
+
+
+def replay(programs, order, expiry):
+    """
+    Run one interleaving. Returns the transport and (reply, position) of
+    every post in order, position being where the post went on the board,
+    None for a repeat the board already had.
+    """
+    transport = MemoryTransport(post_timeout=1 if expiry else None)
+    board = transport.board.sent_messages
+    steps = [iter(program) for program in programs]
+    posts = []
+    for party in order:
+        if expiry and party == len(programs):
+            transport.expire()
+            continue
+        message = signal_message(next(steps[party]), SIDES[party])
+        before = board.count(TOKEN)
+        reply = transport.post(NAMES[party], TOKEN, message)
+        posts.append((reply, before if board.count(TOKEN) > before else None))
+    return transport, posts
+
+
+def check(transport, posts):
+    """Names of the invariants the run breaks, with what broke them."""
+    violations = []
+    board = transport.board.sent_messages.posted(TOKEN)
+    decision = process_messages([(name, TOKEN, message) for name, message in board[:2]]) if len(board) >= 2 else None
+    succeeded = decision is not None and result_status(decision) == STATUS_SUCCESS
+
+    for reply, position in posts:
+        if len(reply.results) > 1:
+            violations.append(('one-answer', f"{reply} answered {reply.results}"))
+        if not reply.results:
+            continue
+        result = reply.results[0]
+        if position is not None and position < 2:
+            if result != decision:
+                violations.append(('decision', f"{reply} told {result!r}, the decision is {decision!r}"))
+        elif position is None:
+            if decision is None or (result_status(result) == STATUS_SUCCESS) != succeeded:
+                violations.append(('late-abort', f"{reply} repeats a post but was told {result!r}, "
+                                                 f"the decision is {decision!r}"))
+        elif result_status(result) == STATUS_SUCCESS:
+            violations.append(('late-abort', f"{reply} came after the decision but was told {result!r}"))
+
+    if succeeded:
+        (first_name, first), (second_name, second) = board[:2]
+        if first_name == second_name or not first.startswith('Sync') or not second.startswith('Sync'):
+            violations.append(('validity', f"{decision!r} succeeded"))
+
+    waiting = [reply for reply, _ in posts if not reply.results]
+    if waiting and (len(waiting) > 1 or len(board) > 1):
+        violations.append(('termination', f"{waiting} never answered with {len(board)} posts on the board"))
+    return violations
+
+
+def explore(job):
+    """Check every interleaving of one combination of programs."""
+    names, expiry = job
+    programs = [PROGRAMS[name] for name in names]
+    lengths = [len(program) for program in programs] + ([1] if expiry else [])
+    runs = steps = 0
+    counts = {}
+    examples = []
+    for order in interleavings(lengths):
+        transport, posts = replay(programs, order, expiry)
+        runs += 1
+        steps += len(order)
+        for invariant, detail in check(transport, posts):
+            counts[invariant] = counts.get(invariant, 0) + 1
+            if len(examples) < 3:
+                steps_text = ' '.join('expire' if expiry and party == len(programs)
+                                      else NAMES[party] for party in order)
+                examples.append((invariant, f"{'/'.join(names)}{' +expiry' if expiry else ''}: "
+                                            f"{steps_text}: {detail}"))
+    return runs, steps, counts, examples
+
+
+def jobs(parties, max_posts, expiry):
+    for names in itertools.product(PROGRAMS, repeat=parties):
+        if sum(len(PROGRAMS[name]) for name in names) <= max_posts:
+            yield names, False
+            if expiry:
+                yield names, True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check every interleaving of PBB posts against the fairness invariants")
+    parser.add_argument("--parties", type=int, default=2, choices=[2, 3])
+    parser.add_argument("--max-posts", type=int, default=6, help="posts of all parties together")
+    parser.add_argument("--no-expiry", action="store_true", help="leave the board's expiry out of the interleavings")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes to spread the programs over")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    runs = steps = 0
+    counts = {}
+    examples = []
+    work = list(jobs(args.parties, args.max_posts, not args.no_expiry))
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for job_runs, job_steps, job_counts, job_examples in pool.imap_unordered(explore, work):
+            runs += job_runs
+            steps += job_steps
+            for invariant, count in job_counts.items():
+                counts[invariant] = counts.get(invariant, 0) + count
+            examples.extend(job_examples)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(work)} program combinations, {runs} interleavings, {steps} steps in {elapsed:.2f} s "
+          f"({steps / elapsed:,.0f} steps/s on {args.workers} workers)")
+    for invariant, count in sorted(counts.items()):
+        print(f"VIOLATED {invariant}: {count} interleavings")
+    for invariant, example in examples[:10]:
+        print(f"  {invariant}: {example}")
+    if not counts:
+        print("all invariants hold")
+    sys.exit(1 if counts else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Multiplexed PBB client: one long-lived connection carries any number of
+concurrent posts, each tagged with a request id, and the server answers
+them in whatever order the board decides them (see async_pbb.MUX_PREFIX).
+"""
+import hashlib
+import itertools
+import socket
+import threading
+from concurrent.futures import Future
+
+
+class MuxConnection:
+
+    def __init__(self, host=None, port=12345):
+        if host is None:
+            host = socket.gethostname()
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request_ids = itertools.count()
+        self.pending = {}
+        # why the reader stopped, once it has
+        self.failure = None
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read_loop, name="pbb_mux_reader", daemon=True)
+        self.reader.start()
+
+    def post(self, client_name, key, option):
+        """Send one post and return a Future resolved with the PBB's response."""
+        hex_dig = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        future = Future()
+        with self.lock:
+            if self.failure is not None:
+                future.set_exception(ConnectionResetError(f"PBB connection closed: {self.failure}"))
+                return future
+            request_id = next(self.request_ids)
+            self.pending[request_id] = future
+            self.sock.sendall(f'@{request_id},{client_name},{hex_dig},{option}\n'.encode())
+        return future
+
+    def read_loop(self):
+        buffer = b''
+        failure = "closed by the PBB"
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                lines = buffer.split(b'\n')
+                buffer = lines.pop()
+                for line in lines:
+                    if not line.startswith(b'@'):
+                        raise ValueError(f"bad reply line {line[:64]!r}")
+                    request_id, response = line[1:].decode().split(',', 1)
+                    request_id = int(request_id)
+                    with self.lock:
+                        future = self.pending.pop(request_id, None)
+                    if future is not None:
+                        future.set_result(response)
+        except OSError as e:
+            failure = e
+            print(f"PBB connection lost: {e}")
+        except ValueError as e:
+            # a reply that cannot be parsed: the stream cannot be trusted past it
+            failure = e
+            print(f"PBB sent a malformed reply: {e}")
+            self.sock.close()
+        with self.lock:
+            self.failure = failure
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionResetError(f"PBB connection closed: {failure}"))
+
+    def close(self):
+        self.sock.close()
+
+
+class MuxPool:
+    """A handful of multiplexed connections used round-robin."""
+
+    def __init__(self, size=4, host=None, port=12345):
+        if size < 1:
+            raise ValueError(f"a pool needs at least one connection, not {size}")
+        self.connections = [MuxConnection(host, port) for _ in range(size)]
+        self.next = itertools.cycle(self.connections)
+        self.lock = threading.Lock()
+
+    def connection(self):
+        with self.lock:
+            return next(self.next)
+
+    def post(self, client_name, key, option):
+        return self.connection().post(client_name, key, option)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
@@ -0,0 +1,437 @@
+"""
+Binary wire protocol of the PBB, version 1.
+
+Every frame is a fixed 10-byte header followed by its body:
+
+    u8 magic (0xFB) | u8 version | u8 type | u8 arg | u32 request id | u16 body length
+
+    POST    type = SYNC / CANCEL / REMOVE, arg = party side ('A', 'B') or 0
+            body = 32-byte token digest | client name (utf-8)
+            With DETACHED or-ed into the type, the post is answered at once
+            with an ACK and its decision is only pushed to watchers.
+    ACK     type = ACK, body = u64 offset of the next decision of the board
+    WATCH   type = WATCH, body = u64 offset | 32-byte token digest (optional)
+            With a digest, the decision on that token is pushed as soon as
+            it exists, even if it was made before. Without one, every
+            decision from offset on is pushed, in order.
+    EVENT   type = EVENT, arg = status, request id = that of the WATCH
+            body = u64 offset (NO_OFFSET if no longer known) | 32-byte
+            token key | result text
+    RESULT  type = RESULT, arg = STATUS_SUCCESS / STATUS_CANCEL / STATUS_CONFLICT
+            body = the board's result text
+            A post the PBB refuses under load gets STATUS_RETRY and
+            "retry-after <seconds>"; it was not put on the board.
+            If the post or its decision could not be logged, every party
+            waiting on it gets STATUS_FAILED and "log-failed <error>".
+            A result text is at most MAX_RESULT_SIZE bytes: a conflict
+            lists the first messages of its token and "+<n> more".
+    BATCH   type = BATCH, arg = 0, request id = id of the first post
+            body = per post: u8 type | u8 side | u8 name length | digest | name
+    BATCH_RESULT
+            type = BATCH_RESULT, arg = 0, request id = that of the BATCH
+            body = per post: u8 status (STATUS_PENDING if undecided) |
+                   u16 result length | result text
+
+The posts of a BATCH take the request ids id, id + 1, ... in order. Its
+BATCH_RESULT frames (as many as the u16 body length needs) list the
+outcome of every post in order; posts still pending are answered later
+with an ordinary RESULT frame carrying their own request id.
+
+Client names must be printable and free of ',': the board logs posts as
+"name,hexhash,message" lines and multiplexed answers are ',' separated.
+A frame with any other name, or a side other than 'A' or 'B', is
+rejected with a ProtocolError and none of its posts reach the board.
+
+The magic byte can never start a legacy "name,hexhash,message" post or a
+multiplexed "@" line, so a server tells the three formats apart from the
+first byte of a connection. Binary connections are persistent and can
+pipeline any number of posts; results carry the request id of their post.
+
+usage: python -m fairExchange.PBB.protocol check
+sends the MALFORMED frames, names and side bytes that could forge lines
+of the board's log or of a multiplexed answer, to a local PBB: each must
+be rejected unanswered, with nothing logged.
+"""
+import asyncio
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = 0xFB
+VERSION = 1
+HEADER = struct.Struct('>BBBBIH')
+DIGEST_SIZE = 32
+
+SYNC = 1
+CANCEL = 2
+REMOVE = 3
+BATCH = 4
+WATCH = 5
+RESULT = 0x10
+BATCH_RESULT = 0x11
+ACK = 0x12
+EVENT = 0x13
+DETACHED = 0x40
+
+STATUS_PENDING = 0
+STATUS_SUCCESS = 1
+STATUS_CANCEL = 2
+STATUS_CONFLICT = 3
+STATUS_RETRY = 4
+STATUS_FAILED = 5
+
+RETRY_AFTER = 'retry-after'
+LOG_FAILED = 'log-failed'
+MAX_RESULT_SIZE = 1024
+# longest message a conflict summary shows, so that it always lists two
+MAX_SHOWN_MESSAGE = 256
+
+BATCH_ITEM = struct.Struct('>BBB')
+BATCH_OUTCOME = struct.Struct('>BH')
+# a BATCH may use the whole u16 body, whatever the limit for single posts
+MAX_BATCH_BODY = 0xFFFF
+OFFSET = struct.Struct('>Q')
+NO_OFFSET = 0xFFFFFFFFFFFFFFFF
+# an EVENT is the longest frame a client is sent outside of a BATCH_RESULT
+MAX_REPLY_BODY = OFFSET.size + DIGEST_SIZE + MAX_RESULT_SIZE
+
+OPCODES = {'Sync': SYNC, 'Cancel': CANCEL, 'remove': REMOVE}
+SIGNALS = {code: name for name, code in OPCODES.items()}
+SIDES = 'AB'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_binary(first_bytes):
+    return len(first_bytes) > 0 and first_bytes[0] == MAGIC
+
+
+def encode_signal(message):
+    """'Sync_A' -> (SYNC, ord('A')), 'remove' -> (REMOVE, 0)."""
+    name, _, side = message.partition('_')
+    if name not in OPCODES or len(side) > 1 or side not in SIDES:
+        raise ProtocolError(f"{message} has no binary opcode")
+    return OPCODES[name], ord(side) if side else 0
+
+
+def decode_signal(opcode, side):
+    if opcode not in SIGNALS:
+        raise ProtocolError(f"Unknown opcode {opcode}")
+    if side and chr(side) not in SIDES:
+        raise ProtocolError(f"Unknown side {side}")
+    return SIGNALS[opcode] + (f"_{chr(side)}" if side else "")
+
+
+def decode_name(raw):
+    """A client name off the wire, refused if it could break a log line or a multiplexed answer."""
+    try:
+        name = raw.decode()
+    except UnicodeDecodeError:
+        raise ProtocolError("Client name is not utf-8") from None
+    if not name or not name.isprintable() or ',' in name:
+        raise ProtocolError(f"Bad client name {name[:64]!r}")
+    return name
+
+
+def result_status(result):
+    """
+    A match answers with the two messages of the exchange; a token that
+    already has more than two answers with all of them (a conflict). An
+    exchange where either party sent Cancel, or withdrew with remove, is
+    cancelled. A refused post is told when to retry.
+    """
+    if result.startswith(RETRY_AFTER):
+        return STATUS_RETRY
+    if result.startswith(LOG_FAILED):
+        return STATUS_FAILED
+    if result.count(',') > 1:
+        return STATUS_CONFLICT
+    lowered = result.lower()
+    if "cancel" in lowered or "remove" in lowered:
+        return STATUS_CANCEL
+    return STATUS_SUCCESS
+
+
+def retry_result(seconds):
+    """The answer to a post refused by admission control."""
+    return f"{RETRY_AFTER} {seconds:.3f}"
+
+
+def failed_result(error):
+    """The answer to the posts of a commit that failed: their decision is not durable, so nobody may act on it."""
+    return f"{LOG_FAILED} {error}".encode()[:MAX_RESULT_SIZE].decode(errors='ignore')
+
+
+def conflict_result(messages):
+    """
+    The answer to a post on a token with more than two posts: its messages,
+    as many as fit in MAX_RESULT_SIZE, then how many were left out.
+    """
+    result = ', '.join(messages)
+    if len(result.encode()) <= MAX_RESULT_SIZE:
+        return result
+    tail = f", +{len(messages)} more"
+    room = MAX_RESULT_SIZE - len(tail)
+    shown = []
+    for message in messages:
+        text = message.encode()[:MAX_SHOWN_MESSAGE].decode(errors='ignore')
+        room -= len(text.encode()) + 2
+        if room < 0:
+            break
+        shown.append(text)
+    left_out = len(messages) - len(shown)
+    return ', '.join(shown) + (f", +{left_out} more" if left_out else "")
+
+
+def retry_after(result):
+    """Seconds to wait before posting again if result is a refusal, else None."""
+    if not result.startswith(RETRY_AFTER):
+        return None
+    return float(result[len(RETRY_AFTER):])
+
+
+def encode_post(request_id, client_name, digest, message, detached=False):
+    opcode, side = encode_signal(message)
+    if detached:
+        opcode |= DETACHED
+    body = digest + client_name.encode()
+    return HEADER.pack(MAGIC, VERSION, opcode, side, request_id, len(body)) + body
+
+
+def is_detached(frame_type):
+    return frame_type & DETACHED != 0
+
+
+def encode_result(request_id, result):
+    body = result.encode()
+    return HEADER.pack(MAGIC, VERSION, RESULT, result_status(result), request_id, len(body)) + body
+
+
+class FrameDecoder:
+    """
+    Incremental decoder: feed() it whatever the socket returned and get back
+    the frames completed so far, however TCP split or coalesced them. Only
+    the bytes of an incomplete frame are kept between calls.
+    """
+
+    def __init__(self, max_body=MAX_REPLY_BODY):
+        self.buffer = bytearray()
+        self.max_body = max_body
+        # frames decoded by recv_frame but not returned yet
+        self.ready = []
+
+    def feed(self, data):
+        """Return a list of (type, arg, request_id, body) for every complete frame."""
+        self.buffer += data
+        frames = []
+        pos = 0
+        view = memoryview(self.buffer)
+        try:
+            while len(self.buffer) - pos >= HEADER.size:
+                magic, version, frame_type, arg, request_id, length = HEADER.unpack_from(view, pos)
+                if magic != MAGIC or version != VERSION:
+                    raise ProtocolError(f"Bad frame header (magic {magic:#x}, version {version})")
+                if length > (MAX_BATCH_BODY if frame_type in (BATCH, BATCH_RESULT) else self.max_body):
+                    raise ProtocolError(f"Frame body of {length} bytes is too long")
+                end = pos + HEADER.size + length
+                if end > len(self.buffer):
+                    break
+                frames.append((frame_type, arg, request_id, bytes(view[pos + HEADER.size:end])))
+                pos = end
+        finally:
+            view.release()
+        del self.buffer[:pos]
+        return frames
+
+
+def decode_post(frame_type, arg, body):
+    """Return (client_name, hexhash, message) of a POST frame."""
+    if len(body) < DIGEST_SIZE:
+        raise ProtocolError("POST frame without a token digest")
+    return decode_name(body[DIGEST_SIZE:]), body[:DIGEST_SIZE].hex(), decode_signal(frame_type & ~DETACHED, arg)
+
+
+def decode_result(arg, body):
+    return arg, body.decode()
+
+
+def encode_ack(request_id, offset):
+    return HEADER.pack(MAGIC, VERSION, ACK, 0, request_id, OFFSET.size) + OFFSET.pack(offset)
+
+
+def decode_ack(body):
+    return OFFSET.unpack_from(body)[0]
+
+
+def encode_watch(request_id, digest=None, offset=0):
+    body = OFFSET.pack(offset) + (digest or b'')
+    return HEADER.pack(MAGIC, VERSION, WATCH, 0, request_id, len(body)) + body
+
+
+def decode_watch(body):
+    """Return (offset, hexhash or None) of a WATCH frame."""
+    if len(body) not in (OFFSET.size, OFFSET.size + DIGEST_SIZE):
+        raise ProtocolError("Bad WATCH frame")
+    digest = body[OFFSET.size:]
+    return OFFSET.unpack_from(body)[0], digest.hex() if digest else None
+
+
+def encode_event(request_id, offset, key, result):
+    body = OFFSET.pack(NO_OFFSET if offset is None else offset) + key + result.encode()
+    return HEADER.pack(MAGIC, VERSION, EVENT, result_status(result), request_id, len(body)) + body
+
+
+def decode_event(arg, body):
+    """Return (offset or None, token key, status, result) of an EVENT frame."""
+    offset = OFFSET.unpack_from(body)[0]
+    key = body[OFFSET.size:OFFSET.size + DIGEST_SIZE]
+    return (None if offset == NO_OFFSET else offset), key, arg, body[OFFSET.size + DIGEST_SIZE:].decode()
+
+
+def encode_batch(request_id, posts):
+    """A BATCH frame of posts [(client_name, digest, message)], all or nothing."""
+    body = bytearray()
+    for client_name, digest, message in posts:
+        opcode, side = encode_signal(message)
+        name = client_name.encode()
+        if len(digest) != DIGEST_SIZE or len(name) > 0xFF:
+            raise ProtocolError(f"Cannot batch the post of {client_name}")
+        body += BATCH_ITEM.pack(opcode, side, len(name)) + digest + name
+    if len(body) > MAX_BATCH_BODY:
+        raise ProtocolError(f"Batch of {len(posts)} posts is too long")
+    return HEADER.pack(MAGIC, VERSION, BATCH, 0, request_id, len(body)) + body
+
+
+def decode_batch(body):
+    """Return [(client_name, hexhash, message)] of a BATCH frame; a bad post rejects the whole batch."""
+    posts = []
+    pos = 0
+    while pos < len(body):
+        if pos + BATCH_ITEM.size + DIGEST_SIZE > len(body):
+            raise ProtocolError("Truncated post in batch")
+        opcode, side, name_len = BATCH_ITEM.unpack_from(body, pos)
+        pos += BATCH_ITEM.size
+        digest = body[pos:pos + DIGEST_SIZE]
+        name = body[pos + DIGEST_SIZE:pos + DIGEST_SIZE + name_len]
+        pos += DIGEST_SIZE + name_len
+        if len(name) != name_len:
+            raise ProtocolError("Truncated post in batch")
+        posts.append((decode_name(name), digest.hex(), decode_signal(opcode, side)))
+    return posts
+
+
+def encode_batch_result(request_id, results):
+    """BATCH_RESULT frames for results, None standing for a pending post."""
+    frames = []
+    body = bytearray()
+    for result in results:
+        if result is None:
+            outcome = BATCH_OUTCOME.pack(STATUS_PENDING, 0)
+        else:
+            text = result.encode()
+            outcome = BATCH_OUTCOME.pack(result_status(result), len(text)) + text
+        if len(body) + len(outcome) > MAX_BATCH_BODY:
+            frames.append(HEADER.pack(MAGIC, VERSION, BATCH_RESULT, 0, request_id, len(body)) + body)
+            body = bytearray()
+        body += outcome
+    frames.append(HEADER.pack(MAGIC, VERSION, BATCH_RESULT, 0, request_id, len(body)) + body)
+    return b''.join(frames)
+
+
+def decode_batch_result(body):
+    """Return [(status, result)] of one BATCH_RESULT frame; result is None while pending."""
+    outcomes = []
+    pos = 0
+    while pos < len(body):
+        status, length = BATCH_OUTCOME.unpack_from(body, pos)
+        pos += BATCH_OUTCOME.size
+        outcomes.append((status, None if status == STATUS_PENDING else body[pos:pos + length].decode()))
+        pos += length
+    return outcomes
+
+
+def recv_frame(sock, decoder):
+    """Blocking read of the next frame from a socket."""
+    while not decoder.ready:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionResetError("connection closed in the middle of a frame")
+        decoder.ready.extend(decoder.feed(data))
+    return decoder.ready.pop(0)
+
+
+MALFORMED_DIGEST = hashlib.sha256(b'malformed').digest()
+# what a forged log line would look like after the name
+FORGED = b',' + MALFORMED_DIGEST.hex().encode() + b',Sync_B'
+
+
+def post_frame(name, side=ord('A')):
+    body = MALFORMED_DIGEST + name
+    return HEADER.pack(MAGIC, VERSION, SYNC, side, 0, len(body)) + body
+
+
+def batch_frame(*items):
+    body = b''.join(BATCH_ITEM.pack(SYNC, side, len(name)) + MALFORMED_DIGEST + name for name, side in items)
+    return HEADER.pack(MAGIC, VERSION, BATCH, 0, 0, len(body)) + body
+
+
+MALFORMED = {
+    'name with a comma': post_frame(b'Mallory' + FORGED),
+    'name with a newline': post_frame(b'Mallory\nEve' + FORGED),
+    'name with a control byte': post_frame(b'Mallory\x00'),
+    'name not utf-8': post_frame(b'Mallory\xff'),
+    'empty name': post_frame(b''),
+    'side byte not A or B': post_frame(b'Mallory', ord('C')),
+    'side byte a newline': post_frame(b'Mallory', ord('\n')),
+    'batch name with a newline': batch_frame((b'Eve\nMallory' + FORGED, ord('A'))),
+    'batch side not A or B': batch_frame((b'Mallory', ord(','))),
+    'batch with one bad post': batch_frame((b'Alice', ord('A')), (b'Bob,', ord('B'))),
+}
+
+
+async def send_malformed(server, log_file, frame, timeout=5):
+    """Send one malformed frame; returns 'rejected' if the connection is closed unanswered and nothing is logged."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+    writer.write(frame)
+    reply = await asyncio.wait_for(reader.read(), timeout)
+    writer.close()
+    logged = server.board.sent_messages.count(MALFORMED_DIGEST.hex()) or \
+        (os.path.exists(log_file) and os.path.getsize(log_file))
+    return 'logged' if logged else 'answered' if reply else 'rejected'
+
+
+async def check():
+    """Returns the failed checks, as messages."""
+    from fairExchange.PBB.async_pbb import AsyncPBBServer
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        log_file = os.path.join(tmp, "malformed.txt")
+        server = AsyncPBBServer('127.0.0.1', 0, log_file, False)
+        await server.start()
+        try:
+            # one after the other, so nothing logged can hide behind another frame
+            for name, frame in MALFORMED.items():
+                try:
+                    status = await send_malformed(server, log_file, frame)
+                except (asyncio.TimeoutError, OSError) as e:
+                    status = repr(e)
+                if status != 'rejected':
+                    failures.append(f"{name}: {status}")
+        finally:
+            server.close()
+    return failures
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        failed = asyncio.run(check())
+        for failure in failed:
+            print(f"FAIL {failure}")
+        print(f"{len(failed)} failed")
+        sys.exit(1 if failed else 0)
+    else:
+        print(__doc__)
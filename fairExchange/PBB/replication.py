@@ -0,0 +1,529 @@
+"""
+Primary-backup replication of the PBB board by log shipping.
+
+The primary keeps its write-ahead log (wal.py) as usual and ships it, as
+the raw records, to every follower that connects to its replication
+port. A follower writes the records to its own copy of the log, fsyncs
+it, applies them to its board and acknowledges the end offset it now
+holds:
+
+    follower -> primary   u64 offset the follower's log ends at, once
+    primary -> follower   u32 length | that many bytes of the log, from
+                          the follower's offset on (length 0: heartbeat)
+    follower -> primary   u64 offset, after every chunk it made durable
+
+With min_acks > 0 (semi-synchronous), a post is only answered once its
+record is durable on the primary and on min_acks followers, so a
+follower that takes over holds every post any party was answered on.
+While fewer than min_acks followers are connected, posts wait. With
+min_acks = 0 the log is shipped asynchronously.
+
+A follower is a read-only PBB: it serves WATCH from its replica of the
+board, and refuses posts with a retry-after until it is promoted. It
+notices a dead primary when the stream ends or stays silent for three
+heartbeats; promote() then turns its copy of the log into a writable
+one and it starts taking posts.
+
+The replication port does not authenticate followers, so it listens on
+loopback unless --replicate-host says otherwise.
+
+usage: python -m fairExchange.PBB.async_pbb --wal primary.wal --replicate-port 12400 --min-acks 1
+       python -m fairExchange.PBB.replication follow 127.0.0.1:12400 follower.wal [--port 12346] [--takeover-after 2]
+       python -m fairExchange.PBB.replication harness [--followers 2] [--pairs 2000] [--min-acks 1]
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from fairExchange.PBB.async_pbb import AsyncPBBServer
+from fairExchange.PBB.protocol import ProtocolError
+from fairExchange.PBB.timing_wheel import TimingWheel
+from fairExchange.PBB.wal import WriteAheadLog, MAGIC, RECORD_HEADER, decode_payload, read_records, recover
+
+CHUNK = struct.Struct('>I')
+OFFSET = struct.Struct('>Q')
+MAX_CHUNK = 1 << 20
+HEARTBEAT = 0.5
+RETRY_AFTER = 1.0
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("replication connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def split_records(data):
+    """Return ([(timestamp, client_name, client_hash, message)], bytes used) of the whole records at the start of data."""
+    records = []
+    pos = 0
+    while len(data) - pos >= RECORD_HEADER.size:
+        length, crc = RECORD_HEADER.unpack_from(data, pos)
+        end = pos + RECORD_HEADER.size + length
+        if end > len(data):
+            break
+        payload = data[pos + RECORD_HEADER.size:end]
+        if zlib.crc32(payload) != crc:
+            raise ProtocolError(f"corrupt log record at {pos} of a replicated chunk")
+        records.append(decode_payload(payload))
+        pos = end
+    return records, pos
+
+
+class ReplicatedLog:
+    """
+    A WriteAheadLog that ships its records to followers. Commits resolve
+    once the record is durable locally and, with min_acks, on that many
+    followers too.
+    """
+
+    def __init__(self, wal, min_acks=1, host='127.0.0.1', port=0, heartbeat=HEARTBEAT):
+        self.wal = wal
+        self.min_acks = min_acks
+        self.heartbeat = heartbeat
+        self.cond = threading.Condition()
+        # end offset of the records durable on the primary
+        self.durable = wal.size
+        # follower socket -> offset it acknowledged
+        self.acked = {}
+        # (end offset, seq, future) of the commits waiting for acks
+        self.waiting = []
+        self.seq = itertools.count()
+        self.closed = False
+        self.listener = socket.create_server((host, port))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, name="pbb_replication", daemon=True).start()
+
+    @property
+    def size(self):
+        return self.wal.size
+
+    def replay(self):
+        return self.wal.replay()
+
+    def append(self, client_name, client_hash, message, timestamp=None):
+        local = self.wal.append(client_name, client_hash, message, timestamp)
+        future = Future()
+        local.add_done_callback(lambda done: self.written(done, future))
+        return future
+
+    def written(self, local, future):
+        if local.exception() is not None:
+            future.set_exception(local.exception())
+            return
+        end = local.result()
+        with self.cond:
+            self.durable = max(self.durable, end)
+            self.cond.notify_all()
+            if self.min_acks and self.quorum() < end:
+                heapq.heappush(self.waiting, (end, next(self.seq), future))
+                return
+        future.set_result(end)
+
+    def quorum(self):
+        """Offset held by at least min_acks followers; call with self.cond held."""
+        acked = sorted(self.acked.values(), reverse=True)
+        return acked[self.min_acks - 1] if len(acked) >= self.min_acks else 0
+
+    def acknowledged(self, follower, offset):
+        ready = []
+        with self.cond:
+            self.acked[follower] = max(offset, self.acked.get(follower, 0))
+            quorum = self.quorum()
+            while self.waiting and self.waiting[0][0] <= quorum:
+                ready.append(heapq.heappop(self.waiting))
+        for end, _, future in ready:
+            future.set_result(end)
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve_follower, args=(sock,), name="pbb_ship", daemon=True).start()
+
+    def serve_follower(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        fd = os.open(self.wal.file_path, os.O_RDONLY)
+        try:
+            sent = OFFSET.unpack(recv_exact(sock, OFFSET.size))[0]
+            with self.cond:
+                if not len(MAGIC) <= sent <= self.durable:
+                    # the follower holds records this log does not have
+                    print(f"Follower log ends at {sent}, beyond this log's {self.durable}")
+                    return
+            threading.Thread(target=self.read_acks, args=(sock,), name="pbb_acks", daemon=True).start()
+            while True:
+                with self.cond:
+                    if self.durable <= sent and not self.closed:
+                        self.cond.wait(self.heartbeat)
+                    durable = self.durable
+                    if self.closed:
+                        return
+                if durable <= sent:
+                    sock.sendall(CHUNK.pack(0))
+                    continue
+                data = os.pread(fd, min(durable - sent, MAX_CHUNK), sent)
+                sock.sendall(CHUNK.pack(len(data)) + data)
+                sent += len(data)
+        except OSError:
+            pass
+        finally:
+            with self.cond:
+                self.acked.pop(sock, None)
+            os.close(fd)
+            sock.close()
+
+    def read_acks(self, sock):
+        try:
+            while True:
+                self.acknowledged(sock, OFFSET.unpack(recv_exact(sock, OFFSET.size))[0])
+        except OSError:
+            # wakes up serve_follower, whose next send fails
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def flush(self):
+        self.wal.flush()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.listener.close()
+        self.wal.close()
+
+
+class ReplicaLog:
+    """
+    A follower's copy of the primary's log. Records arrive already
+    encoded and are written by write(); the board applying them has
+    nothing left to log.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.size = recover(file_path)
+        self.fd = os.open(file_path, os.O_WRONLY | os.O_APPEND)
+
+    def replay(self):
+        # the follower applies its records itself, see FollowerServer.catch_up
+        return iter(())
+
+    def append(self, client_name, client_hash, message, timestamp=None):
+        return None
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        os.fsync(self.fd)
+        self.size += len(data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ReadOnly:
+    """Admission of a follower: every post is refused until it takes over."""
+
+    def __init__(self, retry_after=RETRY_AFTER):
+        self.retry_after = retry_after
+
+    def admit(self, client_name, parks, pending, now=None):
+        return 'read-only', self.retry_after
+
+
+class FollowerServer(AsyncPBBServer):
+    """
+    Read-only PBB fed by a primary's log. Every record goes through the
+    board's post(), without a connection, so the replica has the same
+    pending posts and decisions as the primary, and its watchers get
+    them as they are applied.
+
+    When the primary is lost, primary_lost(follower) is called if set;
+    otherwise, with takeover_after (seconds), the follower promotes itself
+    once it has been without a primary that long, shipping its log on
+    replicate_host:replicate_port if given. Only let one follower take
+    over by itself.
+    """
+
+    def __init__(self, primary, wal_path, host=None, port=12346, verbose=True, retry_after=RETRY_AFTER,
+                 heartbeat=HEARTBEAT, takeover_after=None, replicate_port=None, admission=None,
+                 replicate_host='127.0.0.1'):
+        self.replica = ReplicaLog(wal_path)
+        super().__init__(host, port, None, verbose, self.replica, admission=ReadOnly(retry_after))
+        # (host, replication port) of the primary, None once promoted
+        self.primary = primary
+        self.heartbeat = heartbeat
+        self.takeover_after = takeover_after
+        self.replicate_port = replicate_port
+        self.replicate_host = replicate_host
+        # admission control once it is the primary
+        self.admission = admission
+        self.primary_lost = None
+        self.lost_since = None
+        self.following = None
+
+    async def start(self):
+        self.catch_up()
+        server = await super().start()
+        self.following = asyncio.ensure_future(self.follow())
+        return server
+
+    def catch_up(self):
+        for _, (_, client_name, client_hash, message) in read_records(self.replica.file_path):
+            self.apply(client_name, client_hash, message)
+
+    def apply(self, client_name, client_hash, message):
+        outcomes, _ = self.board.post(client_name, client_hash, message, None, admitted=True)
+        self.settle(outcomes, None)
+        if client_hash in self.post_waiters:
+            self.wake(client_hash)
+
+    async def follow(self):
+        loop = asyncio.get_running_loop()
+        while self.primary is not None:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(*self.primary)
+                writer.write(OFFSET.pack(self.replica.size))
+                pending = b''
+                while True:
+                    header = await asyncio.wait_for(reader.readexactly(CHUNK.size), self.heartbeat * 3)
+                    self.lost_since = None
+                    length = CHUNK.unpack(header)[0]
+                    if not length:
+                        continue
+                    pending += await asyncio.wait_for(reader.readexactly(length), self.heartbeat * 3)
+                    records, used = split_records(pending)
+                    if not used:
+                        continue
+                    await loop.run_in_executor(None, self.replica.write, pending[:used])
+                    pending = pending[used:]
+                    for _, client_name, client_hash, message in records:
+                        self.apply(client_name, client_hash, message)
+                    writer.write(OFFSET.pack(self.replica.size))
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ProtocolError) as e:
+                if self.verbose:
+                    print(f"Lost the primary at {self.primary}: {e!r}")
+            finally:
+                if writer is not None:
+                    writer.close()
+            if self.lost():
+                return
+            await asyncio.sleep(self.heartbeat)
+
+    def lost(self):
+        """Called while the primary is unreachable; True once the follower took over."""
+        now = time.monotonic()
+        if self.lost_since is None:
+            self.lost_since = now
+        if self.primary_lost is not None:
+            self.primary_lost(self)
+        elif self.takeover_after is not None and now - self.lost_since >= self.takeover_after:
+            self.promote(self.replicate_port)
+        return self.primary is None
+
+    def promote(self, replicate_port=None, min_acks=0, post_timeout=None):
+        """
+        Take over as the primary: the replica becomes a writable log, and
+        with replicate_port it is shipped to the remaining followers.
+        """
+        self.primary = None
+        if self.following is not None and self.following is not asyncio.current_task():
+            self.following.cancel()
+        self.replica.close()
+        wal = WriteAheadLog(self.replica.file_path)
+        if replicate_port is not None:
+            wal = ReplicatedLog(wal, min_acks, self.replicate_host, replicate_port, self.heartbeat)
+        board = self.board
+        board.wal = wal
+        board.admission = self.admission
+        if post_timeout:
+            # the posts parked on the replica get their deadline from now
+            now = time.monotonic()
+            board.post_timeout = post_timeout
+            board.deadlines = TimingWheel(now)
+            for client_hash in board.client_messages:
+                board.client_timers[client_hash] = board.deadlines.schedule(now + post_timeout, client_hash)
+            self.watch_deadlines()
+        print(f"Promoted to primary with {board.pending()} pending posts")
+        return wal
+
+
+def run_primary(port, repl_port, wal_path, min_acks):
+    from fairExchange.PBB.async_pbb import start_async_server
+    wal = ReplicatedLog(WriteAheadLog(wal_path), min_acks, port=repl_port)
+    start_async_server('127.0.0.1', port, None, False, wal)
+
+
+class Recorder:
+    """Feed watcher of a follower: when each token's decision was applied there."""
+
+    def __init__(self):
+        self.applied = {}
+
+    def send(self, event):
+        self.applied.setdefault(event[1], time.perf_counter())
+
+
+async def harness(followers=2, pairs=2000, concurrency=20, min_acks=1):
+    import hashlib
+    import multiprocessing
+
+    from fairExchange.PBB.async_client import AsyncPBBClient, SUCCESS
+    from fairExchange.PBB.bench_pbb import free_port, percentile
+    from fairExchange.PBB.loadgen import wait_until_ready
+
+    with tempfile.TemporaryDirectory() as tmp:
+        port, repl_port = free_port('127.0.0.1'), free_port('127.0.0.1')
+        primary = multiprocessing.get_context('fork').Process(
+            target=run_primary, args=(port, repl_port, os.path.join(tmp, "primary.wal"), min_acks), daemon=True)
+        primary.start()
+        wait_until_ready('127.0.0.1', port)
+
+        replicas = []
+        for i in range(followers):
+            follower = FollowerServer(('127.0.0.1', repl_port), os.path.join(tmp, f"follower{i}.wal"),
+                                      '127.0.0.1', 0, False, heartbeat=0.1)
+            recorder = Recorder()
+            follower.board.watch_feed(recorder)
+            await follower.start()
+            replicas.append((follower, recorder))
+
+        # the address posts go to, switched on failover
+        target = {'port': port, 'promoted': None}
+        clients = {}
+        answered = {}
+        cut_off = [0]
+        failed = [0]
+        kill = {}
+
+        def promote_best(follower):
+            if target['promoted'] is not None:
+                return
+            # the most advanced follower takes over, the others follow it
+            best = max((replica for replica, _ in replicas), key=lambda replica: replica.replica.size)
+            new_repl_port = free_port('127.0.0.1')
+            # one follower fewer is left to acknowledge
+            best.promote(new_repl_port, min(min_acks, followers - 1))
+            target['promoted'] = time.perf_counter()
+            target['port'] = best.port
+            for replica, _ in replicas:
+                if replica is not best:
+                    replica.primary = ('127.0.0.1', new_repl_port)
+
+        for follower, _ in replicas:
+            follower.primary_lost = promote_best
+
+        async def worker(w):
+            i = w
+            while i < pairs:
+                if i >= pairs // 2 and 'at' not in kill:
+                    # halfway through, the primary dies without warning
+                    kill['at'] = time.perf_counter()
+                    os.kill(primary.pid, signal.SIGKILL)
+                key = f"replica-{os.getpid()}-{i}"
+                client = clients.get(target['port'])
+                if client is None:
+                    client = clients[target['port']] = AsyncPBBClient('127.0.0.1', target['port'], pool_size=2)
+                try:
+                    outcomes = await client.exchange([(f"Alice{i}", key, "Sync_A"), (f"Bob{i}", key, "Sync_B")],
+                                                     timeout=5)
+                except OSError:
+                    if 'at' in kill:
+                        cut_off[0] += 1
+                    else:
+                        failed[0] += 1
+                    await asyncio.sleep(0.01)
+                    i += concurrency
+                    continue
+                if all(outcome.status == SUCCESS for outcome in outcomes):
+                    answered[hashlib.sha256(key.encode()).hexdigest()] = (time.perf_counter(), outcomes[0].response,
+                                                                       target['port'] == port)
+                    if 'at' in kill and 'first' not in kill and target['port'] != port:
+                        kill['first'] = time.perf_counter()
+                else:
+                    # refused by a follower or cut off: try again with the next token
+                    await asyncio.sleep(0.01)
+                i += concurrency
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        new_primary = next(replica for replica, _ in replicas if replica.primary is None)
+        lost = [token for token, (_, result, _) in answered.items()
+                if new_primary.board.decision(token) is None or new_primary.board.decision(token)[1] != result]
+        print(f"{followers} followers, min_acks {min_acks}, {len(answered)} exchanges answered in {elapsed:.1f} s")
+        for i, (follower, recorder) in enumerate(replicas):
+            lags = [recorder.applied[token] - answered_at for token, (answered_at, _, on_primary) in answered.items()
+                    if on_primary and token in recorder.applied]
+            if lags:
+                print(f"follower {i}: applied p50 {percentile(lags, 50) * 1000:+.2f} ms, "
+                      f"p99 {percentile(lags, 99) * 1000:+.2f} ms, max {max(lags) * 1000:+.2f} ms "
+                      f"relative to the primary's answer")
+        if target['promoted'] is not None:
+            print(f"failover: promoted {(target['promoted'] - kill['at']) * 1000:.1f} ms after the kill, "
+                  f"first exchange on the new primary after {(kill.get('first', float('nan')) - kill['at']) * 1000:.1f} ms")
+        print(f"{cut_off[0]} exchanges cut off by the failover, {failed[0]} failed before it, "
+              f"{len(lost)} answered exchanges missing on the new primary")
+
+        for client in clients.values():
+            await client.close()
+        for follower, _ in replicas:
+            follower.close()
+            if follower.following is not None:
+                follower.following.cancel()
+        primary.join()
+        return lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PBB log-shipping replication")
+    sub = parser.add_subparsers(dest="command", required=True)
+    follow = sub.add_parser("follow", help="run a follower of a primary")
+    follow.add_argument("primary", help="host:port of the primary's replication port")
+    follow.add_argument("wal", help="the follower's copy of the log")
+    follow.add_argument("--port", type=int, default=12346, help="port the follower serves on")
+    follow.add_argument("--takeover-after", type=float, help="promote itself after this many seconds without a primary")
+    follow.add_argument("--replicate-port", type=int, help="once promoted, ship the log to followers on this port")
+    follow.add_argument("--replicate-host", default='127.0.0.1',
+                        help="interface of that port; followers are not authenticated, "
+                             "so only widen it on a trusted network")
+    bench = sub.add_parser("harness", help="measure lag and failover on localhost")
+    bench.add_argument("--followers", type=int, default=2)
+    bench.add_argument("--pairs", type=int, default=2000)
+    bench.add_argument("--concurrency", type=int, default=20)
+    bench.add_argument("--min-acks", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "harness":
+        asyncio.run(harness(args.followers, args.pairs, args.concurrency, args.min_acks))
+        return
+    host, _, port = args.primary.rpartition(':')
+    follower = FollowerServer((host, int(port)), args.wal, port=args.port, takeover_after=args.takeover_after,
+                              replicate_port=args.replicate_port, replicate_host=args.replicate_host)
+    asyncio.run(follower.serve_forever())
+
+
+if __name__ == "__main__":
+    main()
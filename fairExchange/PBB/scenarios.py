@@ -0,0 +1,144 @@
+"""
+Scenario runner for the eight PBB outcome cases of PBBService.
+
+Every case runs against its own AsyncPBBServer on an ephemeral port,
+started in-process, and all of them run in parallel. Instead of sleeping
+between the steps of a case, the runner waits on the server's
+wait_for_posts() until the previous post is on the board, so a case
+takes milliseconds and its ordering is exact.
+
+With --variants N it also runs N randomized variants of the cases, with
+fresh party names and tokens and with the roles of Alice and Bob swapped
+at random, spread over --servers servers.
+
+usage: python -m fairExchange.PBB.scenarios [--variants 10000] [--servers 4] [--seed 1]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fairExchange.PBB.async_client import AsyncPBBClient, SUCCESS, CANCEL, CONFLICT
+from fairExchange.PBB.async_pbb import AsyncPBBServer
+from fairExchange.PBB.bench_pbb import percentile
+
+# case -> ([(party, signal)] in the order they reach the board, expected status of each post)
+CASES = {
+    'syncA_syncB': ([('A', 'Sync'), ('B', 'Sync')], [SUCCESS, SUCCESS]),
+    'syncA_cancelB': ([('A', 'Sync'), ('B', 'Cancel')], [CANCEL, CANCEL]),
+    'syncA_cancelA_SyncB': ([('A', 'Sync'), ('A', 'Cancel'), ('B', 'Sync')], [CANCEL, CANCEL, CONFLICT]),
+    'cancelA_syncB': ([('A', 'Cancel'), ('B', 'Sync')], [CANCEL, CANCEL]),
+    'syncB_syncA': ([('B', 'Sync'), ('A', 'Sync')], [SUCCESS, SUCCESS]),
+    'syncB_cancelA': ([('B', 'Sync'), ('A', 'Cancel')], [CANCEL, CANCEL]),
+    'syncB_cancelB_SyncA': ([('B', 'Sync'), ('B', 'Cancel'), ('A', 'Sync')], [CANCEL, CANCEL, CONFLICT]),
+    'cancelB_syncA': ([('B', 'Cancel'), ('A', 'Sync')], [CANCEL, CANCEL]),
+}
+
+SWAPPED = {'A': 'B', 'B': 'A'}
+
+class ScenarioResult:
+
+    def __init__(self, name, passed, elapsed, statuses, expected, error=None):
+        self.name = name
+        self.passed = passed
+        self.elapsed = elapsed
+        self.statuses = statuses
+        self.expected = expected
+        self.error = error
+
+    def __str__(self):
+        verdict = "PASS" if self.passed else "FAIL"
+        detail = f"  got {self.statuses}, expected {self.expected}" if not self.passed else ""
+        if self.error:
+            detail += f"  ({self.error})"
+        return f"{verdict} {self.name:<24} {self.elapsed * 1000:8.2f} ms{detail}"
+
+
+async def run_case(server, client, name, steps, expected, key, names, timeout=5):
+    """Send the steps of a case one after the other and check the status of every post."""
+    client_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    start = time.perf_counter()
+    posts = []
+    try:
+        for i, (party, signal) in enumerate(steps):
+            posts.append(asyncio.ensure_future(client.post(names[party], key, f"{signal}_{party}")))
+            await asyncio.wait_for(server.wait_for_posts(client_hash, i + 1), timeout)
+        outcomes = await asyncio.wait_for(asyncio.gather(*posts), timeout)
+    except (asyncio.TimeoutError, OSError) as e:
+        for post in posts:
+            post.cancel()
+        return ScenarioResult(name, False, time.perf_counter() - start, None, expected, repr(e))
+    statuses = [outcome.status for outcome in outcomes]
+    return ScenarioResult(name, statuses == expected, time.perf_counter() - start, statuses, expected)
+
+
+async def start_pbb(tmp, index):
+    server = AsyncPBBServer('127.0.0.1', 0, os.path.join(tmp, f"scenario{index}.txt"), False)
+    # start() returns once the server is listening on its port
+    await server.start()
+    return server, AsyncPBBClient('127.0.0.1', server.port, pool_size=1)
+
+
+def variant(rng, index):
+    name = rng.choice(list(CASES))
+    steps, expected = CASES[name]
+    if rng.random() < 0.5:
+        steps = [(SWAPPED[party], signal) for party, signal in steps]
+        name += " (swapped)"
+    names = {'A': f"Alice{index}-{rng.getrandbits(32):08x}", 'B': f"Bob{index}-{rng.getrandbits(32):08x}"}
+    return name, steps, expected, f"variant-{index}-{rng.getrandbits(64):016x}", names
+
+
+async def run(variants=0, servers=4, seed=None):
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        pbbs = await asyncio.gather(*(start_pbb(tmp, i) for i in range(len(CASES) + servers)))
+        try:
+            start = time.perf_counter()
+            cases = await asyncio.gather(*(run_case(server, client, name, steps, expected, f"case-{name}",
+                                                    {'A': 'Alice', 'B': 'Bob'})
+                                           for (server, client), (name, (steps, expected))
+                                           in zip(pbbs, CASES.items())))
+            cases_elapsed = time.perf_counter() - start
+
+            shared = pbbs[len(CASES):]
+            start = time.perf_counter()
+            randomized = await asyncio.gather(*(run_case(*shared[i % servers], *variant(rng, i))
+                                                for i in range(variants)))
+            variants_elapsed = time.perf_counter() - start
+        finally:
+            for server, client in pbbs:
+                await client.close()
+                server.close()
+    return cases, cases_elapsed, randomized, variants_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the PBB outcome scenarios")
+    parser.add_argument("--variants", type=int, default=0, help="randomized variants to run as well")
+    parser.add_argument("--servers", type=int, default=4, help="servers the variants are spread over")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    cases, cases_elapsed, randomized, variants_elapsed = asyncio.run(run(args.variants, max(1, args.servers), args.seed))
+    for result in cases:
+        print(result)
+    failed = [result for result in cases + randomized if not result.passed]
+    print(f"{len(cases)} cases in {cases_elapsed * 1000:.1f} ms")
+    if randomized:
+        elapsed = [result.elapsed for result in randomized]
+        print(f"{len(randomized)} variants in {variants_elapsed * 1000:.1f} ms, "
+              f"p50 {percentile(elapsed, 50) * 1000:.2f} ms, p99 {percentile(elapsed, 99) * 1000:.2f} ms per case")
+        for result in failed[:10]:
+            if result in randomized:
+                print(result)
+    print(f"{len(failed)} failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Multi-process PBB with token-affinity sharding.
+
+N worker processes share one listening socket, each running an
+AsyncPBBServer over its own main_pbb.Board and log. Whichever worker
+accepts a connection reads the post and, if the token belongs to another
+shard, hands the connection itself to the owner: the file descriptor and
+the bytes already read travel over a Unix datagram socket (SCM_RIGHTS).
+Both parties of an exchange therefore always meet on the same board, and
+each board stays single-threaded.
+
+usage: python -m fairExchange.PBB.sharded_pbb [shards] [port]
+       python -m fairExchange.PBB.sharded_pbb bench [pairs] [concurrency]
+"""
+import asyncio
+import collections
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import zlib
+
+from fairExchange.PBB.async_pbb import AsyncPBBServer, BACKLOG, MAX_POST_SIZE, decode_legacy_post
+from fairExchange.PBB.main_pbb import freeze_startup
+from fairExchange.PBB.bench_pbb import run_pairs, report
+from fairExchange.PBB.protocol import ProtocolError, DIGEST_SIZE, MAX_RESULT_SIZE
+
+HANDOFF = b'F'
+RELAY = b'R'
+RESULT = b'A'
+# The longest datagram: a relayed post (whose digest may have doubled in
+# hex) or a capped result, plus the kind byte, shard and relay ids.
+DATAGRAM_SIZE = max(MAX_POST_SIZE + DIGEST_SIZE, MAX_RESULT_SIZE) + 64
+
+
+def shard_of(client_hash, shards):
+    return zlib.crc32(client_hash.encode()) % shards
+
+
+class Outbox:
+    """
+    Non-blocking sender to one shard's inbox. Its datagram queue is short,
+    so when it is full the datagrams wait here until the inbox drains;
+    blocking instead could deadlock two shards relaying to each other.
+    """
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self.queue = collections.deque()
+
+    def transmit(self, data, fds):
+        if fds:
+            socket.send_fds(self.sock, [data], list(fds))
+        else:
+            self.sock.send(data)
+        # the receiver got its own copies of the descriptors
+        for fd in fds:
+            os.close(fd)
+
+    def send(self, data, fds=()):
+        if not self.queue:
+            try:
+                self.transmit(data, fds)
+                return
+            except BlockingIOError:
+                self.loop.add_writer(self.sock.fileno(), self.flush)
+        self.queue.append((data, fds))
+
+    def flush(self):
+        while self.queue:
+            data, fds = self.queue[0]
+            try:
+                self.transmit(data, fds)
+            except BlockingIOError:
+                return
+            self.queue.popleft()
+        self.loop.remove_writer(self.sock.fileno())
+
+
+class RelayReply:
+    """A post relayed from another shard's multiplexed connection; the result goes back to that shard."""
+
+    def __init__(self, outbox, relay_id):
+        self.outbox = outbox
+        self.relay_id = relay_id
+
+    def send(self, result):
+        # results are capped at MAX_RESULT_SIZE, so this always fits in DATAGRAM_SIZE
+        self.outbox.send(RESULT + f"{self.relay_id},{result}".encode())
+
+
+class ShardWorker(AsyncPBBServer):
+    """
+    Shard inboxes carry three kinds of datagrams:
+        HANDOFF + post bytes, with the connection's descriptor attached
+        RELAY   + "origin shard,relay id,name,hexhash,message"
+        RESULT  + "relay id,result"
+    Legacy connections carry a single post and are handed off whole.
+    Multiplexed connections mix tokens of every shard, so their foreign
+    posts are relayed one by one and the results come back the same way.
+    """
+
+    def __init__(self, shard, shards, listen_socket, inboxes, sent_messages_file, verbose=True):
+        super().__init__(None, 0, sent_messages_file, verbose)
+        self.shard = shard
+        self.shards = shards
+        self.listen_socket = listen_socket
+        # inboxes[i] = (receiving end, sending end) of shard i
+        self.inboxes = inboxes
+        self.outboxes = None
+        self.relayed = {}
+        self.next_relay_id = 0
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_client, sock=self.listen_socket,
+                                                 limit=MAX_POST_SIZE, backlog=BACKLOG)
+        inbox = self.inboxes[self.shard][0]
+        inbox.setblocking(False)
+        self.loop.add_reader(inbox.fileno(), self.receive, inbox)
+        self.outboxes = []
+        for _, sending in self.inboxes:
+            sending.setblocking(False)
+            self.outboxes.append(Outbox(self.loop, sending))
+        self.watch_deadlines()
+        return self.server
+
+    async def handle_post(self, data, writer):
+        _, client_hash, _ = decode_legacy_post(data)
+        owner = shard_of(client_hash, self.shards)
+        if owner == self.shard:
+            await super().handle_post(data, writer)
+            return
+        sock = writer.get_extra_info('socket')
+        self.outboxes[owner].send(HANDOFF + data, [os.dup(sock.fileno())])
+        # the duplicate travels to the owner, the transport can let go of ours
+        writer.transport.abort()
+
+    def submit(self, client_name, client_hash, message, reply):
+        owner = shard_of(client_hash, self.shards)
+        if owner == self.shard or isinstance(reply, RelayReply):
+            super().submit(client_name, client_hash, message, reply)
+            return
+        relay_id = self.next_relay_id
+        self.next_relay_id += 1
+        data = RELAY + f"{self.shard},{relay_id},{client_name},{client_hash},{message}".encode()
+        if len(data) > DATAGRAM_SIZE:
+            raise ProtocolError(f"Post of {len(data)} bytes is too long to relay")
+        self.relayed[relay_id] = reply
+        self.outboxes[owner].send(data)
+
+    def submit_detached(self, client_name, client_hash, message, ack):
+        raise ProtocolError("detached posts are not supported by the sharded PBB")
+
+    def watch(self, watcher, client_hash=None, offset=0):
+        # decisions are spread over the shards, there is no single log to follow
+        raise ProtocolError("WATCH is not supported by the sharded PBB")
+
+    def apply_batch(self, posts):
+        # only the local posts of a batch are applied together, the others
+        # are relayed and come back as RESULT frames once decided
+        local = []
+        for client_name, client_hash, message, reply in posts:
+            if shard_of(client_hash, self.shards) == self.shard:
+                local.append((client_name, client_hash, message, reply))
+            else:
+                self.submit(client_name, client_hash, message, reply)
+        return super().apply_batch(local)
+
+    def receive(self, inbox):
+        while True:
+            try:
+                data, fds, flags, _ = socket.recv_fds(inbox, DATAGRAM_SIZE, 1)
+            except BlockingIOError:
+                return
+            kind, data = data[:1], data[1:]
+            try:
+                if flags & socket.MSG_TRUNC:
+                    for fd in fds:
+                        os.close(fd)
+                    raise ProtocolError(f"{kind!r} datagram longer than {DATAGRAM_SIZE} bytes")
+                if kind == HANDOFF:
+                    for fd in fds:
+                        self.loop.create_task(self.adopt(socket.socket(fileno=fd), data))
+                elif kind == RELAY:
+                    origin, relay_id, client_name, client_hash, message = data.decode().split(',')
+                    self.submit(client_name, client_hash, message, RelayReply(self.outboxes[int(origin)], relay_id))
+                elif kind == RESULT:
+                    relay_id, result = data.decode().split(',', 1)
+                    self.relayed.pop(int(relay_id)).send(result)
+            except Exception as e:
+                print(f"Error handling shard message: {e}")
+
+    async def adopt(self, sock, data):
+        sock.setblocking(False)
+        _, writer = await asyncio.open_connection(sock=sock, limit=MAX_POST_SIZE)
+        try:
+            await super().handle_post(data, writer)
+        except Exception as e:
+            print(f"Error handling handed-off post: {e}")
+            writer.close()
+
+
+def run_worker(shard, shards, listen_socket, inboxes, sent_messages_file, verbose):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker = ShardWorker(shard, shards, listen_socket, inboxes, sent_messages_file, verbose)
+    freeze_startup()
+    asyncio.run(worker.serve_forever())
+
+
+def start_sharded_server(shards=None, host=None, port=12345, sent_messages_file='sent_messages.txt', verbose=True):
+    """
+    Start the shard workers and return them. Shard i logs to
+    sent_messages_file with '.shard<i>' inserted before the extension.
+    """
+    if shards is None:
+        shards = os.cpu_count()
+    if host is None:
+        host = socket.gethostname()
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(BACKLOG)
+
+    inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(shards)]
+    root, ext = os.path.splitext(sent_messages_file)
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for shard in range(shards):
+        worker = context.Process(target=run_worker, name=f"pbb_shard_{shard}",
+                                 args=(shard, shards, listen_socket, inboxes, f"{root}.shard{shard}{ext}", verbose),
+                                 daemon=True)
+        worker.start()
+        workers.append(worker)
+    port = listen_socket.getsockname()[1]
+    listen_socket.close()
+    return workers, port
+
+
+def bench_client(host, port, pairs, concurrency, first):
+    return asyncio.run(run_pairs(host, port, pairs, concurrency, first))
+
+
+def bench(pairs, concurrency):
+    """Throughput of 1, 2, 4, ... shards up to the core count, driven by one client process per core."""
+    host = "127.0.0.1"
+    cores = os.cpu_count()
+    shard_counts = [1]
+    while shard_counts[-1] * 2 <= cores:
+        shard_counts.append(shard_counts[-1] * 2)
+    print(f"{pairs} pairs, {concurrency} pairs in flight per client, {cores} cores")
+    with tempfile.TemporaryDirectory() as tmp:
+        for shards in shard_counts:
+            workers, port = start_sharded_server(shards, host, 0, os.path.join(tmp, f"bench{shards}.txt"), False)
+            time.sleep(0.5)
+            clients = max(1, cores)
+            per_client = pairs // clients
+            with multiprocessing.get_context('fork').Pool(clients) as pool:
+                start = time.perf_counter()
+                results = pool.starmap(bench_client, [(host, port, per_client, concurrency, c * per_client)
+                                                      for c in range(clients)])
+                elapsed = time.perf_counter() - start
+            latencies = [latency for _, client_latencies, _ in results for latency in client_latencies]
+            failures = sum(failed for _, _, failed in results)
+            report(f"{shards} shards", per_client * clients, elapsed, latencies, failures)
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 20000,
+              int(sys.argv[3]) if len(sys.argv) > 3 else 100)
+    else:
+        shards = int(sys.argv[1]) if len(sys.argv) > 1 else None
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 12345
+        workers, _ = start_sharded_server(shards, port=port)
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,338 @@
+"""
+Snapshots and log compaction for the PBB board.
+
+A board directory holds WAL segments and at most one current snapshot:
+
+    wal-00000003.log        segments, written by wal.WriteAheadLog
+    snapshot-00000003.pbb   every post of the segments before 3
+
+A snapshot is a sorted array of fixed-size records followed by a string
+table, and is memory-mapped rather than loaded:
+
+    header  = magic | u64 covered segment | u64 records | u64 strings
+    records = (32-byte token key | u32 name | u32 message) * records,
+              sorted by token key, posting order within a token
+    strings = u64 offsets * (strings + 1) | utf-8 heap
+
+Opening a board therefore costs one mmap plus replaying the segments
+written after the snapshot, whatever the size of the history. Lookups
+binary-search the mapped records, and BoardIndex pulls a token into
+memory the first time a post touches it.
+
+The Compactor thread periodically seals the active segment and merges
+the previous snapshot with the sealed segments into a new snapshot. It
+only reads files, so posts keep flowing while it runs; the new snapshot
+is handed to the board at its next post.
+
+usage: python -m fairExchange.PBB.snapshot bench [posts]
+builds a snapshot of synthetic posts and times a restart on top of it.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from fairExchange.PBB.board_index import BoardIndex, token_key
+from fairExchange.PBB.wal import WriteAheadLog, read_records, FSYNC_ALWAYS
+
+MAGIC = b'PBBSNAP1'
+HEADER = struct.Struct('<8sQQQ')
+RECORD = struct.Struct('<32sII')
+OFFSET = struct.Struct('<Q')
+
+SEGMENT_PREFIX = 'wal-'
+SEGMENT_SUFFIX = '.log'
+SNAPSHOT_PREFIX = 'snapshot-'
+SNAPSHOT_SUFFIX = '.pbb'
+
+
+def segment_path(data_dir, seq):
+    return os.path.join(data_dir, f"{SEGMENT_PREFIX}{seq:08d}{SEGMENT_SUFFIX}")
+
+
+def snapshot_path(data_dir, seq):
+    return os.path.join(data_dir, f"{SNAPSHOT_PREFIX}{seq:08d}{SNAPSHOT_SUFFIX}")
+
+
+def list_files(data_dir, prefix, suffix):
+    """Sequence numbers of the files of one kind in the board directory, in order."""
+    seqs = []
+    for name in os.listdir(data_dir):
+        if name.startswith(prefix) and name.endswith(suffix):
+            seqs.append(int(name[len(prefix):-len(suffix)]))
+    return sorted(seqs)
+
+
+class Snapshot:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.covered, self.records, self.strings = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a PBB snapshot")
+        self.offsets = HEADER.size + self.records * RECORD.size
+        self.heap = self.offsets + (self.strings + 1) * OFFSET.size
+        self.string = lru_cache(maxsize=4096)(self.read_string)
+
+    def read_string(self, i):
+        start, = OFFSET.unpack_from(self.mm, self.offsets + i * OFFSET.size)
+        end, = OFFSET.unpack_from(self.mm, self.offsets + (i + 1) * OFFSET.size)
+        return self.mm[self.heap + start:self.heap + end].decode()
+
+    def key_at(self, i):
+        pos = HEADER.size + i * RECORD.size
+        return self.mm[pos:pos + 32]
+
+    def lookup(self, client_hash):
+        """[(client_name, message)] posted under a token, in posting order."""
+        key = token_key(client_hash)
+        lo, hi = 0, self.records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        entries = []
+        while lo < self.records:
+            record_key, name, message = RECORD.unpack_from(self.mm, HEADER.size + lo * RECORD.size)
+            if record_key != key:
+                break
+            entries.append((self.string(name), self.string(message)))
+            lo += 1
+        return entries
+
+    def groups(self):
+        """Yield (key, [(client_name, message)]) for every token, in key order."""
+        key, entries = None, []
+        for i in range(self.records):
+            record_key, name, message = RECORD.unpack_from(self.mm, HEADER.size + i * RECORD.size)
+            if record_key != key:
+                if entries:
+                    yield key, entries
+                key, entries = record_key, []
+            entries.append((self.string(name), self.string(message)))
+        if entries:
+            yield key, entries
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+def write_snapshot(file_path, covered, groups):
+    """Write the sorted (key, [(client_name, message)]) groups as a snapshot, atomically."""
+    strings = {}
+    heap = []
+    heap_size = 0
+    records = 0
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, covered, 0, 0))
+        for key, entries in groups:
+            for client_name, message in entries:
+                ids = []
+                for text in (client_name, message):
+                    i = strings.get(text)
+                    if i is None:
+                        i = strings[text] = len(heap)
+                        data = text.encode()
+                        heap.append(data)
+                        heap_size += len(data)
+                    ids.append(i)
+                file.write(RECORD.pack(key, ids[0], ids[1]))
+                records += 1
+        offset = 0
+        for data in heap:
+            file.write(OFFSET.pack(offset))
+            offset += len(data)
+        file.write(OFFSET.pack(offset))
+        for data in heap:
+            file.write(data)
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, covered, records, len(heap)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def merge_groups(old_groups, new_groups):
+    """Merge two key-sorted group streams; posts already in the old group are dropped from the new one."""
+    old = next(old_groups, None)
+    new = next(new_groups, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old
+            old = next(old_groups, None)
+        elif old is None or new[0] < old[0]:
+            yield new
+            new = next(new_groups, None)
+        else:
+            entries = list(old[1])
+            entries.extend(entry for entry in new[1] if entry not in old[1])
+            yield old[0], entries
+            old = next(old_groups, None)
+            new = next(new_groups, None)
+
+
+def compact(data_dir, old_snapshot, segments, covered):
+    """Fold the sealed segments into the previous snapshot and publish the result."""
+    new = {}
+    for seq in segments:
+        for _, (_, client_name, client_hash, message) in read_records(segment_path(data_dir, seq)):
+            entries = new.setdefault(token_key(client_hash), [])
+            if (client_name, message) not in entries:
+                entries.append((client_name, message))
+    new_groups = iter(sorted(new.items()))
+    if old_snapshot is not None:
+        reader = Snapshot(old_snapshot)
+        try:
+            write_snapshot(snapshot_path(data_dir, covered), covered, merge_groups(reader.groups(), new_groups))
+        finally:
+            reader.close()
+        os.remove(old_snapshot)
+    else:
+        write_snapshot(snapshot_path(data_dir, covered), covered, new_groups)
+    for seq in segments:
+        os.remove(segment_path(data_dir, seq))
+
+
+class BoardStore:
+    """
+    A board directory used in place of a single WriteAheadLog: posts go to
+    the active segment, and load_index() opens the latest snapshot and
+    replays the segments after it.
+    """
+
+    def __init__(self, data_dir, fsync=FSYNC_ALWAYS, fsync_interval_ms=10):
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.fsync = fsync
+        self.fsync_interval_ms = fsync_interval_ms
+        self.lock = threading.Lock()
+
+        for name in os.listdir(data_dir):
+            if name.endswith('.tmp'):
+                # a compaction that did not finish
+                os.remove(os.path.join(data_dir, name))
+        snapshots = list_files(data_dir, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+        for seq in snapshots[:-1]:
+            os.remove(snapshot_path(data_dir, seq))
+        self.snapshot = Snapshot(snapshot_path(data_dir, snapshots[-1])) if snapshots else None
+        covered = self.snapshot.covered if self.snapshot else 0
+        for seq in list_files(data_dir, SEGMENT_PREFIX, SEGMENT_SUFFIX):
+            if seq < covered:
+                os.remove(segment_path(data_dir, seq))
+
+        segments = list_files(data_dir, SEGMENT_PREFIX, SEGMENT_SUFFIX)
+        self.seq = segments[-1] if segments else covered
+        self.active = self.open_segment(self.seq)
+        self.installable = None
+
+    def open_segment(self, seq):
+        return WriteAheadLog(segment_path(self.data_dir, seq), self.fsync, self.fsync_interval_ms)
+
+    def load_index(self):
+        index = BoardIndex(self.snapshot)
+        for seq in list_files(self.data_dir, SEGMENT_PREFIX, SEGMENT_SUFFIX):
+            for _, (_, client_name, client_hash, message) in read_records(segment_path(self.data_dir, seq)):
+                index.add(client_name, client_hash, message)
+                index.touch(client_hash, seq)
+        return index
+
+    def append(self, client_name, client_hash, message, timestamp=None):
+        with self.lock:
+            return self.active.append(client_name, client_hash, message, timestamp)
+
+    def maintain(self, index):
+        """Called by the board before a post: swap in a snapshot the compactor has finished."""
+        installable = self.installable
+        if installable is None:
+            return
+        self.installable = None
+        old = index.base
+        index.install(*installable)
+        if old is not None:
+            old.close()
+
+    def rotate(self):
+        """Seal the active segment and start a new one. Returns the sealed log."""
+        with self.lock:
+            sealed = self.active
+            self.seq += 1
+            self.active = self.open_segment(self.seq)
+        return sealed
+
+    def compact(self):
+        sealed = self.rotate()
+        # posts appended to the sealed segment before the swap are committed here
+        sealed.close()
+        covered = self.seq
+        segments = [seq for seq in list_files(self.data_dir, SEGMENT_PREFIX, SEGMENT_SUFFIX) if seq < covered]
+        old_snapshot = None
+        snapshots = list_files(self.data_dir, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+        if snapshots:
+            old_snapshot = snapshot_path(self.data_dir, snapshots[-1])
+        compact(self.data_dir, old_snapshot, segments, covered)
+        self.installable = (Snapshot(snapshot_path(self.data_dir, covered)), covered)
+
+    def flush(self):
+        self.active.flush()
+
+    def close(self):
+        self.active.close()
+
+
+class Compactor(threading.Thread):
+    """Compacts a BoardStore every interval seconds once its active segment has grown past min_bytes."""
+
+    def __init__(self, store, interval=60, min_bytes=1 << 20):
+        super().__init__(name="pbb_compactor", daemon=True)
+        self.store = store
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.store.active.size >= self.min_bytes and self.store.installable is None:
+                try:
+                    self.store.compact()
+                except Exception as e:
+                    print(f"Compaction of {self.store.data_dir} failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def bench(posts):
+    with tempfile.TemporaryDirectory() as data_dir:
+        print(f"Writing a snapshot of {posts} posts...")
+        start = time.perf_counter()
+        keys = sorted(hashlib.sha256(str(i).encode()).digest() for i in range(posts // 2))
+        groups = ((key, [("Alice", "Sync_A"), ("Bob", "Sync_B")]) for key in keys)
+        write_snapshot(snapshot_path(data_dir, 1), 1, groups)
+        print(f"  built in {time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        store = BoardStore(data_dir)
+        index = store.load_index()
+        restart = time.perf_counter() - start
+        hex_dig = hashlib.sha256(b'42').hexdigest()
+        print(f"  restart in {restart * 1000:.1f} ms, token 42 -> {index.messages_with_hash(hex_dig)}")
+        store.close()
+        index.base.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 10_000_000)
+    else:
+        print(__doc__)
@@ -0,0 +1,108 @@
+"""
+Hierarchical timing wheel for the deadlines of pending PBB posts.
+
+Level 0 has one slot per tick, level L has one slot per slots**L ticks.
+A timer sits in the lowest level whose span covers its deadline, and is
+moved down a level each time the wheel reaches the start of its slot, so
+schedule() and cancel() are O(1) and advance() costs O(ticks + expired).
+Timers further away than the whole wheel are parked in the top level and
+re-placed as the wheel turns.
+"""
+
+
+class Timer:
+    __slots__ = ('expires', 'payload', 'bucket')
+
+    def __init__(self, expires, payload):
+        self.expires = expires
+        self.payload = payload
+        self.bucket = None
+
+
+class TimingWheel:
+
+    def __init__(self, now, tick=0.1, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.current = int(now / tick)
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, payload):
+        """Fire payload at the first tick at or after deadline. Returns the timer, for cancel()."""
+        timer = Timer(max(int(-(-deadline // self.tick)), self.current + 1), payload)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.count -= 1
+
+    def place(self, timer):
+        expires = max(timer.expires, self.current)
+        delta = expires - self.current
+        if delta >= self.spans[self.levels]:
+            # out of range: stop over at the farthest slot, re-placed from there
+            expires = self.current + self.spans[self.levels] - 1
+            delta = expires - self.current
+        level = 0
+        while delta >= self.spans[level + 1]:
+            level += 1
+        bucket = self.wheels[level][(expires // self.spans[level]) % self.slots]
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def advance(self, now):
+        """Turn the wheel up to now and return the payloads of the timers that expired."""
+        target = int(now / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            for level in range(1, self.levels):
+                if self.current % self.spans[level]:
+                    break
+                bucket = self.wheels[level][(self.current // self.spans[level]) % self.slots]
+                timers = list(bucket)
+                bucket.clear()
+                for timer in timers:
+                    self.place(timer)
+            bucket = self.wheels[0][self.current % self.slots]
+            for timer in bucket:
+                timer.bucket = None
+                expired.append(timer.payload)
+            self.count -= len(bucket)
+            bucket.clear()
+        return expired
+
+
+if __name__ == "__main__":
+    # self-check: random deadlines across every level, a third cancelled,
+    # each of the others must fire on exactly the tick of its deadline
+    import random
+    import sys
+
+    timers = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    wheel = TimingWheel(0, tick=1, slots=16, levels=3)
+    due = {}
+    for i in range(timers):
+        deadline = random.randrange(1, 16 ** 3 * 2)
+        timer = wheel.schedule(deadline, i)
+        if i % 3 == 0:
+            wheel.cancel(timer)
+        else:
+            due[i] = deadline
+    now = 0
+    while len(wheel):
+        now += random.randrange(1, 5)
+        for i in wheel.advance(now):
+            assert now - 4 < due.pop(i) <= now, i
+    assert not due
+    print(f"{timers} timers OK")
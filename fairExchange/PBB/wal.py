@@ -0,0 +1,403 @@
+"""
+Binary write-ahead log of the PBB board.
+
+Every post becomes one record:
+
+    u32 payload length | u32 crc32(payload) | payload
+    payload = f64 timestamp | u32 name length | u32 message length |
+              u32 token length | token | name | message
+
+Tokens are the sha256 hex digests sent by the clients and are stored as
+their raw 32 bytes; anything that is not a 64 char hex digest is kept as
+text with the top bit of the token length set.
+
+Version 1 logs (PBBWAL1) had u8 name and message lengths and a u16
+token length. They are still read, and a version 1 log opened for
+writing is first rewritten in the current format.
+
+The log keeps one file descriptor open and a single writer thread. Posts
+that arrive while the writer is busy are coalesced into the next batch,
+which is written with one write() and made durable with one fsync(), so
+under burst load the per-post syscall cost amortises away.
+
+fsync policies:
+    always   - a post is acknowledged once its batch has been fsynced
+    interval - batches are written immediately and fsynced every N ms;
+               a crash of the host may lose the last N ms of posts
+    never    - the OS decides when to flush; survives a process crash
+               but not a host crash
+A torn or corrupt tail left by a crash is cut off when the log is opened.
+A batch whose write or fsync fails is cut off at once, so the records
+acknowledged after it are not left behind a torn one; if that fails
+too, the log refuses every later append.
+
+usage: python -m fairExchange.PBB.wal check
+injects write, fsync and truncate failures between batches and checks
+what is acknowledged, refused and recovered, by the log and by a board
+on top of it; and that a name too long for a version 1 record is
+replayed whole.
+"""
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from fairExchange.PBB import metrics
+from fairExchange.PBB.board_index import is_digest
+
+MAGIC = b'PBBWAL2\n'
+RECORD_HEADER = struct.Struct('<II')
+PAYLOAD_HEADER = struct.Struct('<dIII')
+TEXT_TOKEN = 0x80000000
+MAGIC_V1 = b'PBBWAL1\n'
+# magic -> (payload header, text token flag) of every version still read
+LAYOUTS = {MAGIC: (PAYLOAD_HEADER, TEXT_TOKEN), MAGIC_V1: (struct.Struct('<dBBH'), 0x8000)}
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+
+def encode_token(client_hash):
+    if is_digest(client_hash):
+        return bytes.fromhex(client_hash), 32
+    token = client_hash.encode()
+    return token, len(token) | TEXT_TOKEN
+
+
+def encode_record(client_name, client_hash, message, timestamp):
+    name = client_name.encode()
+    msg = message.encode()
+    token, token_len = encode_token(client_hash)
+    payload = PAYLOAD_HEADER.pack(timestamp, len(name), len(msg), token_len) + token + name + msg
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload, layout=LAYOUTS[MAGIC]):
+    payload_header, text_token = layout
+    timestamp, name_len, msg_len, token_len = payload_header.unpack_from(payload)
+    pos = payload_header.size
+    if token_len & text_token:
+        token_len &= ~text_token
+        client_hash = payload[pos:pos + token_len].decode()
+    else:
+        client_hash = payload[pos:pos + token_len].hex()
+    pos += token_len
+    client_name = payload[pos:pos + name_len].decode()
+    pos += name_len
+    message = payload[pos:pos + msg_len].decode()
+    return timestamp, client_name, client_hash, message
+
+
+def read_records(file_path, offset=len(MAGIC)):
+    """
+    Yield (end_offset, (timestamp, client_name, client_hash, message)) for
+    every intact record from offset on. Stops at the first torn or corrupt
+    record, which can only be the tail left by a crash.
+    """
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, 'rb') as file:
+        layout = LAYOUTS.get(file.read(len(MAGIC)))
+        if layout is None:
+            raise ValueError(f"{file_path} is not a PBB write-ahead log")
+        file.seek(offset)
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            offset += RECORD_HEADER.size + length
+            yield offset, decode_payload(payload, layout)
+
+
+def is_log(head):
+    """True if a file starting with head is a write-ahead log, of any version."""
+    return head[:len(MAGIC)] in LAYOUTS
+
+
+def upgrade(file_path):
+    """Rewrite a version 1 log in the current format, atomically; a torn tail is left behind."""
+    print(f"Rewriting {file_path} in the current log format")
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        for _, (timestamp, client_name, client_hash, message) in read_records(file_path):
+            file.write(encode_record(client_name, client_hash, message, timestamp))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def recover(file_path):
+    """Create the log if needed and cut off a torn tail. Returns the size of the intact log."""
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        with open(file_path, 'wb') as file:
+            file.write(MAGIC)
+            file.flush()
+            os.fsync(file.fileno())
+        return len(MAGIC)
+    with open(file_path, 'rb') as file:
+        if file.read(len(MAGIC)) == MAGIC_V1:
+            upgrade(file_path)
+    end = len(MAGIC)
+    for end, _ in read_records(file_path):
+        pass
+    if end < os.path.getsize(file_path):
+        print(f"Truncating torn tail of {file_path} at offset {end}")
+        with open(file_path, 'r+b') as file:
+            file.truncate(end)
+            os.fsync(file.fileno())
+    return end
+
+
+class WriteAheadLog:
+
+    def __init__(self, file_path, fsync=FSYNC_ALWAYS, fsync_interval_ms=10):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.file_path = file_path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+
+        self.size = self.recover()
+        self.fd = os.open(file_path, os.O_WRONLY | os.O_APPEND)
+
+        self.queue = []
+        self.last = None
+        self.cond = threading.Condition()
+        self.closed = False
+        # the error that left the file in an unknown state, if any
+        self.failed = None
+        self.writer = threading.Thread(target=self.write_loop, name="pbb_wal", daemon=True)
+        self.writer.start()
+
+    def recover(self):
+        return recover(self.file_path)
+
+    def replay(self):
+        """Yield (timestamp, client_name, client_hash, message) for every post in the log."""
+        for _, record in read_records(self.file_path):
+            yield record
+
+    def append(self, client_name, client_hash, message, timestamp=None):
+        """
+        Queue a post for the next group commit. Returns a Future that is
+        resolved with the end offset of the record once the fsync policy
+        considers it durable.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        record = encode_record(client_name, client_hash, message, timestamp)
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise ValueError("write-ahead log is closed")
+            if self.failed is not None:
+                raise OSError(f"write-ahead log failed: {self.failed}")
+            self.queue.append((record, future))
+            self.last = future
+            self.cond.notify()
+        return future
+
+    def write_loop(self):
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    if self.fsync == FSYNC_INTERVAL and dirty:
+                        self.cond.wait(max(0.0, last_sync + self.fsync_interval - time.monotonic()))
+                        break
+                    self.cond.wait()
+                batch, self.queue = self.queue, []
+                closed = self.closed
+
+            try:
+                if batch:
+                    start = time.perf_counter()
+                    data = b''.join(record for record, _ in batch)
+                    view = memoryview(data)
+                    while view:
+                        written = os.write(self.fd, view)
+                        view = view[written:]
+                    dirty = True
+                    metrics.LOG_WRITE.observe(time.perf_counter() - start)
+                now = time.monotonic()
+                if dirty and (self.fsync == FSYNC_ALWAYS or closed
+                              or (self.fsync == FSYNC_INTERVAL and now - last_sync >= self.fsync_interval)):
+                    start = time.perf_counter()
+                    os.fsync(self.fd)
+                    metrics.LOG_FSYNC.observe(time.perf_counter() - start)
+                    last_sync = now
+                    dirty = False
+            except OSError as e:
+                metrics.LOG_ERRORS.value += 1
+                self.rollback(e)
+                dirty = False
+                for _, future in batch:
+                    future.set_exception(e)
+                if closed:
+                    return
+                continue
+
+            for record, future in batch:
+                self.size += len(record)
+                future.set_result(self.size)
+            if closed:
+                return
+
+    def rollback(self, error):
+        """Cut the file back to the last committed record after a failed batch."""
+        try:
+            os.ftruncate(self.fd, self.size)
+            os.lseek(self.fd, self.size, os.SEEK_SET)
+        except OSError as e:
+            print(f"Could not cut {self.file_path} back to {self.size} after {error}: {e}")
+            with self.cond:
+                self.failed = e
+                failed, self.queue = self.queue, []
+            for _, future in failed:
+                future.set_exception(e)
+
+    def flush(self):
+        """Block until everything appended so far has been committed."""
+        last = self.last
+        if last is not None:
+            last.result()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+        os.close(self.fd)
+
+
+class Fault:
+    """Makes the next call of os.<name> fail, after doing half of a write."""
+
+    def __init__(self, name):
+        self.name = name
+        self.real = getattr(os, name)
+
+    def __enter__(self):
+        def fail(fd, *args):
+            setattr(os, self.name, self.real)
+            if self.name == 'write':
+                self.real(fd, args[0][:len(args[0]) // 2])
+            raise OSError(f"injected {self.name} failure")
+        setattr(os, self.name, fail)
+        return self
+
+    def __exit__(self, *exc):
+        setattr(os, self.name, self.real)
+
+
+class Reply:
+    """Collects what a board sends to a party."""
+
+    def __init__(self):
+        self.results = []
+
+    def send(self, result):
+        self.results.append(result)
+
+
+def check_board(tmp):
+    """
+    A parked post whose commit fails is taken off the board and its party
+    told, so a counterpart parks instead of matching it; and a match whose
+    commit fails is undone.
+    """
+    from fairExchange.PBB.main_pbb import Board, deliver
+    from fairExchange.PBB.protocol import LOG_FAILED
+    failures = []
+    path = os.path.join(tmp, 'board.wal')
+    log = WriteAheadLog(path)
+    board = Board(None, log)
+    token = f"{1:064x}"
+    alice, bob = Reply(), Reply()
+    with Fault('fsync'):
+        deliver(*board.post('Alice', token, 'Sync_A', alice), board)
+    deliver(*board.post('Bob', token, 'Sync_B', bob), board)
+    if not (len(alice.results) == 1 and alice.results[0].startswith(LOG_FAILED)) or bob.results \
+            or board.pending() != 1 or board.sent_messages.count(token) != 1:
+        failures.append(f"failed parked post: Alice got {alice.results}, Bob {bob.results}, "
+                        f"{board.pending()} pending, {board.sent_messages.count(token)} posts on the board")
+    carol = Reply()
+    with Fault('fsync'):
+        deliver(*board.post('Carol', token, 'Sync_A', carol), board)
+    if board.decision(token) is not None or board.sent_messages.count(token) != 1 \
+            or not all(reply.results and reply.results[-1].startswith(LOG_FAILED) for reply in (bob, carol)):
+        failures.append(f"failed match: decision {board.decision(token)}, Bob got {bob.results}, "
+                        f"Carol {carol.results}, {board.sent_messages.count(token)} posts on the board")
+    log.close()
+    recovered = [name for _, (_, name, _, _) in read_records(path)]
+    if recovered != ['Bob']:
+        failures.append(f"board: the log holds {recovered}, the board {board.sent_messages.parties(token)}")
+    return failures
+
+
+def check():
+    """Returns the failed checks, as messages."""
+    failures = []
+    posts = [(f"party{i}", f"{i:064x}", "Sync_A") for i in range(3)]
+    for fault in ('write', 'fsync'):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'board.wal')
+            log = WriteAheadLog(path)
+            first = log.append(*posts[0]).result()
+            with Fault(fault):
+                failed = log.append(*posts[1]).exception()
+            last = log.append(*posts[2]).result()
+            log.close()
+            recovered = [(name, token, message) for _, (_, name, token, message) in read_records(path)]
+            if failed is None:
+                failures.append(f"{fault} failure: the post was acknowledged")
+            if recovered != [posts[0], posts[2]] or last != os.path.getsize(path) or first >= last:
+                failures.append(f"{fault} failure: recovered {len(recovered)} posts of a {os.path.getsize(path)} byte "
+                                f"log, the last one acknowledged at {last}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'board.wal')
+        log = WriteAheadLog(path)
+        log.append(*posts[0]).result()
+        with Fault('fsync'), Fault('ftruncate'):
+            log.append(*posts[1]).exception()
+        try:
+            log.append(*posts[2])
+            failures.append("truncate failure: a later post was taken")
+        except OSError:
+            pass
+        log.close()
+    with tempfile.TemporaryDirectory() as tmp:
+        failures.extend(check_board(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'long-name.wal')
+        log = WriteAheadLog(path)
+        names = ['Alice' * 60, 'Bob']
+        for name, message in zip(names, ('Sync_A', 'Sync_B')):
+            log.append(name, f"{3:064x}", message).result()
+        log.close()
+        replayed = [name for _, (_, name, _, _) in read_records(path)]
+        if replayed != names:
+            failures.append(f"300-byte name: the log replays {[name[:8] + '...' for name in replayed]}")
+    return failures
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        failed = check()
+        for failure in failed:
+            print(f"FAIL {failure}")
+        print(f"{len(failed)} failed")
+        sys.exit(1 if failed else 0)
+    else:
+        print(__doc__)
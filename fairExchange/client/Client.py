@@ -3,9 +3,9 @@ import ssl
 import os
 import time
 
-from tqdm import tqdm
-
-from fairExchange.server.Utils.files2sockets import recv_store_file, read_send_file
+from fairExchange.server.Utils.aead_stream import ChunkDecryptor, ZLIB, DEFAULT_LEVEL
+from fairExchange.server.Utils.file_common import DOCUMENT_KEY
+from fairExchange.server.Utils.files2sockets import recv_store_file, read_send_file, send_recv_file
 
 
 class ClientSSL():
@@ -67,43 +67,25 @@ class ClientSSL():
             if self.conn is not None:
                 self.conn.close()
 
-    def send_and_receive_encrypted_file(self, file_path):
-        progress = None
+    def send_and_receive_encrypted_file(self, file_path, codec=ZLIB, level=DEFAULT_LEVEL[ZLIB]):
         try:
-            # Read the original file data
-            with open(file_path, 'rb') as file:
-                file_data = file.read()
-
-            file_size = os.path.getsize(file_path)
-
-            progress = tqdm(total=file_size, desc=F"{self.client_name} sends file to ATT for encryption", unit="B", unit_scale=True)
-
-            # send data file to server
-            block_size = 1024  # 1KB
-            for i in range(0, len(file_data), block_size):
-                data_block = file_data[i:i + block_size]
-                self.conn.sendall(data_block)
-                progress.update(len(data_block))
-
-            # Receive response from server
-            response = self.conn.recv(4096)  # Adjust buffer size as needed
-            print(f"Response from server")
-
             # Get the base name of the original file and add "_encrypted" to it
             base_name = os.path.basename(file_path)
             encrypted_file_name = f"{self.client_name}doc_encrypted{os.path.splitext(base_name)[1]}".lower()
 
-            # Write the original file data to a new file in the 'alice/files' directory
-            with open(f'{self.client_name}/files/{encrypted_file_name}'.lower(), 'wb') as temp_file:
-                temp_file.write(response)
+            # The document is streamed to the server and the encrypted reply
+            # straight to the 'alice/files' directory, neither is held in memory.
+            # The attestable compresses it first with codec if it supports it.
+            send_recv_file(file_path, f'{self.client_name}/files/{encrypted_file_name}'.lower(),
+                           F"{self.client_name} sends file to ATT for encryption", self.conn,
+                           codec=codec, level=level)
+            print(f"Response from server")
             return encrypted_file_name
         except Exception as e:
             print(f"erro to send file to server: {e}")
         finally:
             if self.conn is not None:
                 self.conn.close()
-            if progress is not None:
-                progress.close()
 
 
         # Return the new encrypted file name
@@ -135,7 +117,8 @@ class ClientSSL():
             filesize = int(filesize)
             # start receiving the file from the socket
             # and writing to the file stream
-            recv_store_file(self.config_client.configuration.path_file/filename, filesize, buffer_size, conn)
+            recv_store_file(self.config_client.configuration.path_file/filename, filesize, buffer_size, conn,
+                            ChunkDecryptor(DOCUMENT_KEY))
             print("cli_file_flie.py has received file from ser_file_file.py")
 
         finally:
@@ -1,7 +1,8 @@
 import ssl
 
-from fairExchange.server.Utils.file_common import FileCommon
-from fairExchange.server.Utils.files2sockets import read_send_file, recv_store_file, send_content
+from fairExchange.server.Utils.aead_stream import ChunkDecryptor, ChunkEncryptor, CHUNK_SIZE, negotiate, sealed_size
+from fairExchange.server.Utils.file_common import DOCUMENT_KEY
+from fairExchange.server.Utils.files2sockets import read_send_file, recv_store_file, recv_upload, recv_encrypt_send, UNKNOWN_SIZE
 import os
 
 class ClientHandler:
@@ -26,15 +27,17 @@ class ClientHandler:
   def uptloadFile(self):
     try:
 
-      cli_req = self.conn.recv(1024)
-      #print("client request: ", cli_req.decode("UTF-8"))
-
-      # In python sockets send and receive strings. Send a string
-      key = b"thisisaverysecretkey123"[:32].ljust(32, b'\0')
-
-      file_common = FileCommon()
-      encryptedContent = file_common.encrypt_file(cli_req, key)
-      send_content(encryptedContent,self.conf.client_name, self.conn)
+      # the upload is size-prefixed and encrypted as it arrives, so a
+      # document of any size is taken whole, in constant memory
+      filesize, codec, level = recv_upload(self.conn)
+      # compressed before it is sealed if the client offered a codec we have
+      codec, level = negotiate(codec, level)
+      reply_size = sealed_size(filesize, CHUNK_SIZE, codec)
+
+      # sealed in authenticated chunks, so the document's receiver can
+      # check it as it arrives (see aead_stream)
+      recv_encrypt_send(filesize, ChunkEncryptor(DOCUMENT_KEY, CHUNK_SIZE, codec, level), self.conf.client_name,
+                        self.conn, reply_size=UNKNOWN_SIZE if reply_size is None else reply_size)
       print("ser_file_file.py has sent a file to cli_file)flie.py")
 
       # print("ser_str.py will now send a string to cli_str.py")
@@ -66,7 +69,7 @@ class ClientHandler:
       # and writing to the file stream
 
       ########## server will receive from client ########
-      recv_store_file(self.conf.path_file/filename, filesize, buffer_size, self.conn)
+      recv_store_file(self.conf.path_file/filename, filesize, buffer_size, self.conn, ChunkDecryptor(DOCUMENT_KEY))
       print("ser_file_file.py server has read file from socket....")
 
       ########## server will send file to client ########
@@ -6,18 +6,37 @@ import os
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+from fairExchange.server.Utils import segment_cipher
+
+# the key the attestables encrypt deposited documents with
+DOCUMENT_KEY = b"thisisaverysecretkey123"[:32].ljust(32, b'\0')
+
 class FileCommon:
-    def encrypt_file(self, file_content, key):
+    def encryptor(self, key):
+        """AES-CFB encryptor to feed a document chunk by chunk: update() each chunk, then finalize()."""
+        cipher = Cipher(algorithms.AES(key), modes.CFB(b'\0' * 16), backend=default_backend())
+        return cipher.encryptor()
 
+    def decryptor(self, key):
         cipher = Cipher(algorithms.AES(key), modes.CFB(b'\0' * 16), backend=default_backend())
-        encryptor = cipher.encryptor()
+        return cipher.decryptor()
+
+    def encrypt_file(self, file_content, key):
+
+        encryptor = self.encryptor(key)
         ciphertext = encryptor.update(file_content) + encryptor.finalize()
 
         return ciphertext
 
     def decrypt_file(self, ciphertext, key):
-        cipher = Cipher(algorithms.AES(key), modes.CFB(b'\0' * 16), backend=default_backend())
-        decryptor = cipher.decryptor()
+        decryptor = self.decryptor(key)
         plaintext = decryptor.update(ciphertext) + decryptor.finalize()
 
         return plaintext
+
+    def encrypt_file_parallel(self, src_path, dst_path, key, workers=None):
+        """Encrypt a document on disk with segmented AES-CTR on a pool of workers (see segment_cipher)."""
+        segment_cipher.encrypt_file(src_path, dst_path, key, workers)
+
+    def decrypt_file_parallel(self, src_path, dst_path, key, workers=None):
+        segment_cipher.decrypt_file(src_path, dst_path, key, workers)
@@ -1,6 +1,8 @@
 
+import select
 import socket
 import ssl
+import struct
 
 import tqdm
 import os
@@ -8,6 +10,9 @@ import os
 import time
 import pickle
 
+from fairExchange.server.Utils.aead_stream import IntegrityError
+from fairExchange.server.Utils.pbb_records import send_pages
+
 def arit(a,b):
     print("arit in files2sockets has beeen called")
     r= a+b
@@ -70,28 +75,168 @@ def send_content(content, client_name, sock: socket.socket):
             break
 
 
+"""
+Streamed uploads are prefixed with their size, a u64 in network order,
+and the codec and level the uploader offers for compression (see
+aead_stream.negotiate). The reply is prefixed with its size, or with
+UNKNOWN_SIZE when it depends on how well the document compresses; it
+then ends when the attestable closes the connection, and the container
+itself tells a complete reply from a cut one.
+STREAM_BUFFER is how much is read, encrypted and sent at a time.
+"""
+SIZE = struct.Struct('>Q')
+UPLOAD = struct.Struct('>QBB')
+UNKNOWN_SIZE = 0xFFFFFFFFFFFFFFFF
+STREAM_BUFFER = 64 * 1024
+
+
+def recv_exact(sock: socket.socket, n: int):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError(f"connection closed after {len(data)} of {n} bytes")
+        data += chunk
+    return bytes(data)
+
+
+def recv_size(sock: socket.socket):
+    return SIZE.unpack(recv_exact(sock, SIZE.size))[0]
+
+
+def recv_upload(sock: socket.socket):
+    """(size, codec, level) of a streamed upload."""
+    return UPLOAD.unpack(recv_exact(sock, UPLOAD.size))
+
+
+def recv_encrypt_send(fsize: int, encryptor, client_name, sock: socket.socket, buffer_size=STREAM_BUFFER,
+                      reply_size=None):
+    """
+    Encrypt an upload of fsize bytes chunk by chunk as it arrives and
+    stream the ciphertext straight back, size-prefixed. reply_size is the
+    size of the ciphertext, known before the first byte is encrypted: by
+    default fsize, as with the stream cipher of FileCommon.encryptor, or
+    aead_stream.sealed_size(fsize) for an aead_stream.ChunkEncryptor.
+    With UNKNOWN_SIZE the caller closes the connection after the reply.
+    """
+    progress = tqdm.tqdm(range(fsize), F"ATT encrypts {client_name}'s file", unit="B", unit_scale=True, unit_divisor=1024)
+    sock.sendall(SIZE.pack(fsize if reply_size is None else reply_size))
+    nbytes = 0
+    while nbytes < fsize:
+        bytes_read = sock.recv(min(buffer_size, fsize - nbytes))
+        if not bytes_read:
+            raise ConnectionError(f"{client_name} closed the upload after {nbytes} of {fsize} bytes")
+        sock.sendall(encryptor.update(bytes_read))
+        progress.update(len(bytes_read))
+        nbytes += len(bytes_read)
+    tail = encryptor.finalize()
+    if tail:
+        sock.sendall(tail)
+    progress.close()
+
+
+def send_recv_file(fname, out_name, description, sock: socket.socket, buffer_size=STREAM_BUFFER,
+                   codec=0, level=0):
+    """
+    Upload fname size-prefixed, offering compression with codec at level,
+    and store the size-prefixed reply in out_name, both while they are
+    in flight. The peer answers while the
+    upload is still going, so sending and receiving are interleaved with
+    select(): if the client only read once it had sent everything, both
+    sides would block on full socket buffers as soon as the document is
+    larger than them. Returns the size of the reply.
+
+    The socket is non-blocking meanwhile: a readable TLS socket may only
+    have received a record without data (a session ticket), and a
+    blocking recv() would then wait for the server, which waits for the
+    upload.
+    """
+    fsize = os.path.getsize(fname)
+    progress = tqdm.tqdm(range(fsize), description, unit="B", unit_scale=True, unit_divisor=1024)
+    outgoing = memoryview(UPLOAD.pack(fsize, codec, level))
+    header = b''
+    reply_size = None
+    nbytes = 0
+    sock.setblocking(False)
+    try:
+        with open(fname, "rb") as src, open(out_name, "wb") as dst:
+            uploading = True
+            while reply_size is None or nbytes < reply_size:
+                # an SSL socket may hold decrypted bytes that select() cannot see
+                buffered = sock.pending() if isinstance(sock, ssl.SSLSocket) else 0
+                writers = [sock] if uploading else []
+                readable, writable, _ = select.select([sock], writers, [], 0 if buffered else None)
+                if readable or buffered:
+                    try:
+                        data = sock.recv(buffer_size)
+                    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                        data = None
+                    if data == b'':
+                        if reply_size == UNKNOWN_SIZE and not uploading:
+                            break
+                        raise ConnectionError(f"connection closed after {nbytes} bytes of the reply")
+                    if data and reply_size is None:
+                        header += data
+                        data = None
+                        if len(header) >= SIZE.size:
+                            reply_size, = SIZE.unpack(header[:SIZE.size])
+                            data = header[SIZE.size:]
+                    if data:
+                        dst.write(data)
+                        nbytes += len(data)
+                if writable:
+                    if not outgoing:
+                        chunk = src.read(buffer_size)
+                        if not chunk:
+                            uploading = False
+                            continue
+                        outgoing = memoryview(chunk)
+                        progress.update(len(chunk))
+                    try:
+                        sent = sock.send(outgoing)
+                    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                        sent = 0
+                    outgoing = outgoing[sent:]
+    finally:
+        sock.setblocking(True)
+    progress.close()
+    return nbytes
+
+
 """
 Receive a file from a socket and store it on disk under
 the give name. 
+With a verifier (an aead_stream.ChunkDecryptor), the file must be an
+authenticated container: every chunk is checked as it arrives, and the
+first bad one aborts the transfer with an IntegrityError and removes
+what was stored of it.
 """
-def recv_store_file(fname: str, fsize: int, buffer_size: int, sock: socket):
+def recv_store_file(fname: str, fsize: int, buffer_size: int, sock: socket, verifier=None):
 
     progress = tqdm.tqdm(range(fsize), f"Receiving {fname}", 
                unit="B", unit_scale=True, unit_divisor=1024)
     nbytes= 0
-    with open(fname, "wb") as f:
-     while nbytes < fsize :
-       # read 1024 bytes from the socket 
-       bytes_read = sock.recv(buffer_size)
-       if not bytes_read:
-           # nothing is received
-           # file transmitting is done
-           break
-       # write to the file the bytes we just received
-       f.write(bytes_read)
-       # update the progress bar
-       progress.update(len(bytes_read))
-       nbytes= nbytes + len(bytes_read)
+    try:
+     with open(fname, "wb") as f:
+      while nbytes < fsize :
+        # read 1024 bytes from the socket 
+        bytes_read = sock.recv(buffer_size)
+        if not bytes_read:
+            # nothing is received
+            # file transmitting is done
+            break
+        if verifier is not None:
+            verifier.feed(bytes_read)
+        # write to the file the bytes we just received
+        f.write(bytes_read)
+        # update the progress bar
+        progress.update(len(bytes_read))
+        nbytes= nbytes + len(bytes_read)
+      if verifier is not None:
+        verifier.close()
+    except IntegrityError:
+     os.remove(fname)
+     raise
 
 
 
@@ -156,6 +301,10 @@ def recvpicklemsg(clientsocket, headersize, buffer_size):
  sends it back to the client.
  If the request is post s_A or post c_A, the
  function appends the token to the pbbrecrds.
+ A retrieve with a query dict streams the records
+ in pages instead (see pbb_records); pbbrecrds
+ should then be a pbb_records.PBBRecords, so that
+ filters by token and party use its indexes.
 """
 def sendpicklemsg(clisocket, list, hsize, pbbrecrds):
   print("sendpicklemsh has been called")
@@ -173,6 +322,11 @@ def sendpicklemsg(clisocket, list, hsize, pbbrecrds):
 
      #clisocket.close()  
 
+  elif len(list) == 2 and list[0] == "retrieve" and isinstance(list[1], dict):
+     print("list[0]=", list[0], "query=", list[1])
+     cursor = send_pages(clisocket, hsize, pbbrecrds, list[1])
+     print("retrieve streamed up to record", cursor)
+
   # copy this code to a function
   elif len(list)== 1 and list[0] == "retrieve":
      print("list[0]=", list[0])
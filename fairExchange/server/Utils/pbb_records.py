@@ -0,0 +1,160 @@
+"""
+Paginated, filtered retrieve for the pickle-based bulletin board.
+
+The legacy ["retrieve"] request pickles the whole pbbrecrds list into one
+message. A ["retrieve", {...}] request instead streams the records as a
+sequence of bounded pages over the same header + pickle framing:
+
+    request   ["retrieve", {"cursor": 0, "limit": 500, "token": None, "party": None}]
+    response  one message per page: {"records": [...], "cursor": c, "more": bool}
+
+The cursor is the position on the board where the next page starts, so
+a reader that stops can resume later from the last cursor it got and
+then also sees the records posted since. token and party filter the
+records through secondary indexes kept by PBBRecords.
+
+A record is whatever the post carried. Tuples and lists are read as
+(party, token, ...), "party,token,message" strings like the lines of the
+PBB log; any other record is its own token.
+
+Nothing in the application sends a retrieve of either kind yet, and
+files2sockets.sendpicklemsg, which answers them, has no caller either:
+retrieve_pages is the client side for whoever does, and callers should
+use it rather than the legacy request.
+"""
+import bisect
+import pickle
+
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+def record_fields(record):
+    """Return (party, token) of a board record."""
+    if isinstance(record, (tuple, list)) and len(record) >= 2:
+        return record[0], record[1]
+    if isinstance(record, str) and record.count(',') >= 2:
+        party, token, _ = record.split(',', 2)
+        return party, token
+    return None, record
+
+
+class PBBRecords(list):
+    """
+    The board's record list, append-only, with the positions of the
+    records of every token and of every party.
+    """
+
+    def __init__(self, records=()):
+        super().__init__()
+        self.by_token = {}
+        self.by_party = {}
+        self.extend(records)
+
+    def append(self, record):
+        position = len(self)
+        super().append(record)
+        party, token = record_fields(record)
+        try:
+            self.by_token.setdefault(token, []).append(position)
+        except TypeError:
+            # an unhashable record cannot be looked up by token
+            pass
+        if party is not None:
+            self.by_party.setdefault(party, []).append(position)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def positions(self, token=None, party=None):
+        """Sorted positions of the records matching the filters, None when unfiltered."""
+        if token is None and party is None:
+            return None
+        candidates = []
+        if token is not None:
+            candidates.append(self.by_token.get(token, []))
+        if party is not None:
+            candidates.append(self.by_party.get(party, []))
+        return min(candidates, key=len)
+
+
+def retrieve_page(pbbrecrds, cursor=0, limit=PAGE_SIZE, token=None, party=None):
+    """Return (records, next cursor, more) of the page of pbbrecrds that starts at cursor."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = max(0, cursor)
+
+    def wanted(record):
+        record_party, record_token = record_fields(record)
+        return (token is None or record_token == token) and (party is None or record_party == party)
+
+    if isinstance(pbbrecrds, PBBRecords):
+        positions = pbbrecrds.positions(token, party)
+    else:
+        # a plain list has no index, filters fall back to a scan
+        positions = None
+    if positions is None:
+        positions = range(cursor, len(pbbrecrds))
+        start = 0
+    else:
+        start = bisect.bisect_left(positions, cursor)
+
+    records = []
+    index = start
+    while index < len(positions) and len(records) < limit:
+        record = pbbrecrds[positions[index]]
+        if wanted(record):
+            records.append(record)
+        index += 1
+    if index < len(positions):
+        return records, positions[index], True
+    return records, len(pbbrecrds), False
+
+
+def encode_page(records, cursor, more, hsize):
+    msg = pickle.dumps({"records": records, "cursor": cursor, "more": more})
+    return bytes(f"{len(msg):<{hsize}}", 'utf-8') + msg
+
+
+def send_pages(clisocket, hsize, pbbrecrds, query):
+    """Answer a ["retrieve", query] request with pages until the end of the board."""
+    cursor = query.get("cursor", 0)
+    limit = query.get("limit", PAGE_SIZE)
+    token = query.get("token")
+    party = query.get("party")
+    while True:
+        records, cursor, more = retrieve_page(pbbrecrds, cursor, limit, token, party)
+        clisocket.sendall(encode_page(records, cursor, more, hsize))
+        if not more:
+            return cursor
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 65536))
+        if not chunk:
+            raise ConnectionResetError("connection closed in the middle of a message")
+        data += chunk
+    return bytes(data)
+
+
+def recv_page(sock, hsize):
+    """Read exactly one header + pickle message, however the socket split or joined them."""
+    msglen = int(recv_exact(sock, hsize))
+    return pickle.loads(recv_exact(sock, msglen))
+
+
+def retrieve_pages(sock, hsize, cursor=0, limit=PAGE_SIZE, token=None, party=None):
+    """
+    Client side: ask for the records from cursor on and yield them page
+    by page, as (records, cursor). Only one page is held at a time; the
+    last cursor yielded resumes the walk in a later request.
+    """
+    request = pickle.dumps(["retrieve", {"cursor": cursor, "limit": limit, "token": token, "party": party}])
+    sock.sendall(bytes(f"{len(request):<{hsize}}", 'utf-8') + request)
+    while True:
+        page = recv_page(sock, hsize)
+        yield page["records"], page["cursor"]
+        if not page["more"]:
+            return
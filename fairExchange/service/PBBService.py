@@ -3,12 +3,19 @@ import socket
 import threading
 import time
 
-from fairExchange.PBB.client import start_client
+from fairExchange.PBB.async_pbb import start_async_server
+from fairExchange.PBB.client import start_client, response_action, send_batch
 from fairExchange.PBB.main_pbb import start_server
+from fairExchange.PBB.mux_client import MuxPool
 
 class PBBService():
-    def __init__(self):
+    def __init__(self, mux_connections=0):
         self.server_socket = None
+        # with mux_connections > 0, signals share that many long-lived
+        # connections to an async_pbb server instead of one socket each
+        self.mux_connections = mux_connections
+        self.mux_pool = None
+        self.mux_lock = threading.Lock()
 
     # def startProcess(self, list_of_options):
     #     print(f"-----------------------------------------------------------------------------------------")
@@ -39,11 +46,46 @@ class PBBService():
     #         self.server_socket.close()
 
     def startPbbServer(self):
+        if self.mux_connections:
+            # only the asyncio PBB speaks the multiplexed format
+            return start_async_server()
         return start_server()
 
+    def muxPool(self):
+        # the parties post from their own threads
+        with self.mux_lock:
+            if self.mux_pool is None:
+                self.mux_pool = MuxPool(self.mux_connections)
+            return self.mux_pool
+
     def upClienteToSendSignalToPBB(self, clientName, key, signal):
+        if self.mux_connections:
+            connection = self.muxPool().connection()
+            print(f"\n{clientName} sent: {signal} to PBB\n")
+            future = connection.post(clientName, key, signal)
+            response = future.result()
+            print(f"\n The PBB responded with: {response}. {response_action(clientName, response)}")
+            # like start_client; the connection is shared, so it is left open
+            return connection.sock, None
         return start_client(clientName, key, signal)
 
+    def sendSignalsToPBB(self, signals):
+        """Post every (clientName, key, signal) over the shared connections and wait for all responses."""
+        if not self.mux_connections:
+            # one start_client per signal would wait on the first parked one, a batch is answered in full
+            return send_batch(signals)
+        mux_pool = self.muxPool()
+        futures = []
+        for clientName, key, signal in signals:
+            print(f"\n{clientName} sent: {signal} to PBB\n")
+            futures.append(mux_pool.post(clientName, key, signal))
+        responses = []
+        for (clientName, _, _), future in zip(signals, futures):
+            response = future.result()
+            print(f"\n The PBB responded with: {response}. {response_action(clientName, response)}")
+            responses.append(response)
+        return responses
+
     def syncA_syncB(self):
         server_thread = threading.Thread(target=lambda: setattr(self, 'server_socket', self.startPbbServer()),name="pbb_server")
         server_thread.start()